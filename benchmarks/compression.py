@@ -0,0 +1,102 @@
+# Run from the repository root with: python -m benchmarks.compression
+from netmask.client.main import NetmaskClient
+from netmask.server.main import NetmaskServer
+import multiprocessing
+import threading
+import argparse
+import socket
+import time
+import sys
+import os
+
+# Variables
+COMMUNICATION_KEY = "benchmark"
+SERVER_PORT = 24125
+TRANSFER_BYTES = 250003
+SOURCE_CHUNK = 65536
+VISITOR_TIMEOUT = 10
+
+def runServer(port):
+	sys.stdout = open(os.devnull, "w")
+	NetmaskServer(COMMUNICATION_KEY, False, False, 1, "127.0.0.1", "-").start("127.0.0.1", "-", port)
+
+def transferData():
+	# Compressible but not trivially so, with an odd length so the last chunk is a partial one
+	return (b"netmask " * (TRANSFER_BYTES // 16) + os.urandom(TRANSFER_BYTES))[:TRANSFER_BYTES]
+
+def serveTCP(sock, data):
+	# Sends the data to every visitor and closes right away
+	def handle(conn):
+		try:
+			conn.sendall(data)
+			conn.shutdown(socket.SHUT_WR)
+		except OSError:
+			pass
+		conn.close()
+
+	while True:
+		conn, _address = sock.accept()
+		threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+def receiveAll(visitor):
+	received = bytearray()
+	while True:
+		data = visitor.recv(SOURCE_CHUNK)
+		if not data:
+			return bytes(received)
+		received += data
+
+def runRound(port, algorithm, engine, data):
+	service = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	service.bind(("127.0.0.1", 0))
+	service.listen(16)
+	threading.Thread(target=serveTCP, args=(service, data), daemon=True).start()
+
+	client = NetmaskClient(COMMUNICATION_KEY, service.getsockname()[1], 0, 4, engine=engine, compress=algorithm)
+	threading.Thread(target=client.connect, args=("127.0.0.1", port), daemon=True).start()
+	while not client.isConnected:
+		time.sleep(0.01)
+
+	host, bindPort = client.bindedAddress.split(":")
+	visitor = socket.create_connection((host, int(bindPort)), timeout=VISITOR_TIMEOUT)
+
+	# The local service closes right after sending, everything it sent must still arrive
+	startTime = time.perf_counter()
+	try:
+		received = receiveAll(visitor)
+	except socket.timeout:
+		received = b""
+	elapsed = time.perf_counter() - startTime
+	visitor.close()
+
+	passed = received == data
+	print((algorithm+" "+engine).ljust(24) + str(len(data)).rjust(10) + str(len(received)).rjust(12) + str(round(elapsed * 1000, 1)).rjust(10) + ("" if passed else "  TRUNCATED"))
+	return passed
+
+def main():
+	parser = argparse.ArgumentParser(description="Checks that compressed tunnels deliver everything a local service sent before closing.")
+	parser.add_argument("--port", type=int, default=SERVER_PORT, help="The server's port. (default: "+str(SERVER_PORT)+")")
+	args = parser.parse_args()
+
+	context = multiprocessing.get_context("fork")
+	serverProcess = context.Process(target=runServer, args=(args.port,), daemon=True)
+	serverProcess.start()
+	time.sleep(1)
+
+	data = transferData()
+	print("round".ljust(24) + "sent".rjust(10) + "received".rjust(12) + "ms".rjust(10))
+	passed = True
+	try:
+		for algorithm in ["zlib", "lzma"]:
+			for engine in ["threads", "asyncio"]:
+				passed &= runRound(args.port, algorithm, engine, data)
+	finally:
+		serverProcess.kill()
+		serverProcess.join()
+
+	if not passed:
+		print("[SYSTEM] A compressed tunnel lost the end of a transfer")
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
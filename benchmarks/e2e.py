@@ -0,0 +1,323 @@
+# Run from the repository root with: python -m benchmarks.e2e [--output results.json] [--baseline baseline.json]
+from netmask.client.main import NetmaskClient
+from netmask.server.main import NetmaskServer
+import multiprocessing
+import threading
+import platform
+import argparse
+import socket
+import json
+import time
+import sys
+import os
+
+# Variables
+COMMUNICATION_KEY = "benchmark"
+SERVER_PORT = 24124
+BULK_BYTES = 256 * 1024**2
+SOURCE_CHUNK = 262144
+CONNECTION_DURATION = 3
+LATENCY_DURATION = 3
+LATENCY_PAYLOAD = 64
+UDP_DATAGRAMS = 50000
+UDP_PAYLOAD = 512
+UDP_WINDOW = 32
+UDP_TIMEOUT = 0.5
+
+# Metric -> (unit, whether higher is better), in the order they are reported
+METRICS = {
+	"tcp_throughput": ("MB/s", True),
+	"tcp_connections": ("conn/s", True),
+	"tcp_first_byte_p50": ("ms", False),
+	"tcp_first_byte_p99": ("ms", False),
+	"tcp_latency_p50": ("ms", False),
+	"tcp_latency_p99": ("ms", False),
+	"tcp_latency_p999": ("ms", False),
+	"udp_packets": ("pkt/s", True),
+	"udp_loss": ("%", False),
+}
+
+def percentile(samples, fraction):
+	samples = sorted(samples)
+	return samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1000 if samples else 0
+
+def runServer(port, useSplice, workerCount):
+	sys.stdout = open(os.devnull, "w")
+	NetmaskServer(COMMUNICATION_KEY, False, useSplice, workerCount, "127.0.0.1", "-").start("127.0.0.1", "-", port)
+
+def serveTCP(sock, echo):
+	# Echoes or discards everything, closing once the other side is done
+	def handle(conn):
+		try:
+			while True:
+				data = conn.recv(SOURCE_CHUNK)
+				if not data:
+					break
+				if echo:
+					conn.sendall(data)
+		except OSError:
+			pass
+		conn.close()
+
+	while True:
+		conn, _address = sock.accept()
+		threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+def serveUDP(sock):
+	while True:
+		data, address = sock.recvfrom(65536)
+		sock.sendto(data, address)
+
+def runTunnels(port, options, addresses):
+	# The clients and the services behind them, in a process of their own so they don't share a GIL with the visitors
+	sys.stdout = open(os.devnull, "w")
+
+	services = {}
+	for name, kind in [("echo", socket.SOCK_STREAM), ("sink", socket.SOCK_STREAM), ("udp", socket.SOCK_DGRAM)]:
+		sock = socket.socket(socket.AF_INET, kind)
+		sock.bind(("127.0.0.1", 0))
+		if kind == socket.SOCK_STREAM:
+			sock.listen(1024)
+			threading.Thread(target=serveTCP, args=(sock, name == "echo"), daemon=True).start()
+		else:
+			threading.Thread(target=serveUDP, args=(sock,), daemon=True).start()
+		services[name] = sock.getsockname()[1]
+
+	clients = {}
+	for name, localPort in services.items():
+		if name == "udp":
+			client = NetmaskClient(COMMUNICATION_KEY, localPort, 1, 4, udpDemux=options["udpDemux"])
+		else:
+			client = NetmaskClient(COMMUNICATION_KEY, localPort, 0, 4, multiplex=options["multiplex"], poolSize=options["poolSize"], useSplice=options["splice"], engine=options["engine"])
+		threading.Thread(target=client.connect, args=("127.0.0.1", port), daemon=True).start()
+		clients[name] = client
+
+	while not all(client.isConnected for client in clients.values()):
+		time.sleep(0.01)
+
+	for name, client in clients.items():
+		host, bindPort = client.bindedAddress.split(":")
+		addresses.put((name, (host, int(bindPort))))
+
+	while True:
+		time.sleep(1)
+
+def measureThroughput(address):
+	visitor = socket.create_connection(address)
+	chunk = b"x" * SOURCE_CHUNK
+
+	startTime = time.perf_counter()
+	for _ in range(BULK_BYTES // SOURCE_CHUNK):
+		visitor.sendall(chunk)
+	visitor.shutdown(socket.SHUT_WR)
+
+	# The relay closes the visitor once the sink has everything
+	visitor.recv(1)
+	elapsed = time.perf_counter() - startTime
+	visitor.close()
+
+	return {"tcp_throughput": BULK_BYTES / elapsed / 1024**2}
+
+def measureConnections(address):
+	# Connect, send a byte and wait for it to come back, one visitor after the other
+	firstBytes = []
+	startTime = time.perf_counter()
+	while time.perf_counter() - startTime < CONNECTION_DURATION:
+		connectTime = time.perf_counter()
+		visitor = socket.create_connection(address)
+		visitor.sendall(b"x")
+		visitor.recv(1)
+		firstBytes.append(time.perf_counter() - connectTime)
+		visitor.close()
+
+	return {
+		"tcp_connections": len(firstBytes) / (time.perf_counter() - startTime),
+		"tcp_first_byte_p50": percentile(firstBytes, 0.5),
+		"tcp_first_byte_p99": percentile(firstBytes, 0.99),
+	}
+
+def measureLatency(address, concurrency):
+	# Every visitor keeps one connection and plays ping pong on it
+	roundTrips = []
+	barrier = threading.Barrier(concurrency + 1)
+	payload = b"x" * LATENCY_PAYLOAD
+
+	def visit():
+		visitor = socket.create_connection(address)
+		visitor.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+		samples = []
+
+		barrier.wait()
+		endTime = time.perf_counter() + LATENCY_DURATION
+		while time.perf_counter() < endTime:
+			sendTime = time.perf_counter()
+			visitor.sendall(payload)
+			received = 0
+			while received < LATENCY_PAYLOAD:
+				data = visitor.recv(LATENCY_PAYLOAD - received)
+				if not data:
+					return
+				received += len(data)
+			samples.append(time.perf_counter() - sendTime)
+
+		visitor.close()
+		roundTrips.extend(samples)
+
+	visitors = [threading.Thread(target=visit) for _ in range(concurrency)]
+	for visitor in visitors:
+		visitor.start()
+	barrier.wait()
+	for visitor in visitors:
+		visitor.join()
+
+	return {
+		"tcp_latency_p50": percentile(roundTrips, 0.5),
+		"tcp_latency_p99": percentile(roundTrips, 0.99),
+		"tcp_latency_p999": percentile(roundTrips, 0.999),
+	}
+
+def measureUDP(address):
+	# Keep a window of datagrams in flight, a datagram that doesn't come back in time is counted as lost
+	visitor = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	visitor.settimeout(UDP_TIMEOUT)
+	payload = b"x" * UDP_PAYLOAD
+
+	sent = 0
+	received = 0
+	inFlight = 0
+	startTime = time.perf_counter()
+	while sent < UDP_DATAGRAMS or inFlight > 0:
+		while sent < UDP_DATAGRAMS and inFlight < UDP_WINDOW:
+			visitor.sendto(payload, address)
+			sent += 1
+			inFlight += 1
+
+		try:
+			visitor.recvfrom(65536)
+			received += 1
+			inFlight -= 1
+		except socket.timeout:
+			inFlight = 0
+
+	elapsed = time.perf_counter() - startTime
+	visitor.close()
+
+	return {"udp_packets": received / elapsed, "udp_loss": (sent - received) / sent * 100}
+
+def runSuite(options):
+	context = multiprocessing.get_context("fork")
+	port = options["port"]
+
+	serverProcess = context.Process(target=runServer, args=(port, options["splice"], options["workers"]), daemon=True)
+	serverProcess.start()
+	time.sleep(1)
+
+	addressQueue = context.Queue()
+	tunnelProcess = context.Process(target=runTunnels, args=(port, options, addressQueue), daemon=True)
+	tunnelProcess.start()
+	addresses = dict(addressQueue.get(timeout=30) for _ in range(3))
+
+	try:
+		results = {}
+		results.update(measureThroughput(addresses["sink"]))
+		results.update(measureConnections(addresses["echo"]))
+		results.update(measureLatency(addresses["echo"], options["concurrency"]))
+		results.update(measureUDP(addresses["udp"]))
+	finally:
+		tunnelProcess.kill()
+		serverProcess.kill()
+		tunnelProcess.join()
+		serverProcess.join()
+
+	return results
+
+def compare(results, baseline, tolerance):
+	# Returns the metrics that got worse than the baseline by more than the tolerance
+	regressions = []
+
+	print("metric".ljust(22) + "baseline".rjust(12) + "current".rjust(12) + "change".rjust(10) + "unit".rjust(8))
+	for name, (unit, higherIsBetter) in METRICS.items():
+		if name not in results or name not in baseline:
+			continue
+
+		current = results[name]
+		previous = baseline[name]
+
+		# Loss is a percentage already, it is compared in points instead of relatively
+		if unit == "%":
+			change = current - previous
+			worse = change / 100
+			changeText = str(round(change, 1)) + "pt"
+		else:
+			change = (current - previous) / previous if previous else 0
+			worse = -change if higherIsBetter else change
+			changeText = str(round(change * 100, 1)) + "%"
+
+		flag = ""
+		if worse > tolerance:
+			regressions.append(name)
+			flag = "  REGRESSION"
+
+		print(name.ljust(22) + str(round(previous, 2)).rjust(12) + str(round(current, 2)).rjust(12) + (("+" if change >= 0 else "") + changeText).rjust(10) + unit.rjust(8) + flag)
+
+	return regressions
+
+def main():
+	parser = argparse.ArgumentParser(description="End-to-end loopback benchmarks of netmask tunnels.")
+	parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file.")
+	parser.add_argument("--baseline", type=str, default=None, help="Compare the results against a JSON file written by --output.")
+	parser.add_argument("--tolerance", type=float, default=0.1, help="How much worse than the baseline a metric may get. (default: 0.1)")
+	parser.add_argument("--concurrency", type=int, default=32, help="Visitors measuring latency at the same time. (default: 32)")
+	parser.add_argument("--port", type=int, default=SERVER_PORT, help="The server's port. (default: "+str(SERVER_PORT)+")")
+	parser.add_argument("--workers", type=int, default=1, help="Server worker processes. (default: 1)")
+	parser.add_argument("--splice", action="store_true", help="Relay with splice on both sides.")
+	parser.add_argument("--multiplex", action="store_true", help="Multiplex the TCP tunnels over the control connection.")
+	parser.add_argument("--pool", type=int, default=0, help="Pre-opened data connections per TCP tunnel. (default: 0)")
+	parser.add_argument("--engine", type=str, default="threads", choices=["threads", "asyncio"], help="The clients' forwarding engine. (default: threads)")
+	parser.add_argument("--udp-demux", action="store_true", help="Demultiplex the UDP tunnel's sessions.")
+	args = parser.parse_args()
+
+	options = {
+		"port": args.port,
+		"workers": args.workers,
+		"splice": args.splice,
+		"multiplex": args.multiplex,
+		"poolSize": args.pool,
+		"engine": args.engine,
+		"udpDemux": args.udp_demux,
+		"concurrency": args.concurrency,
+	}
+
+	results = runSuite(options)
+
+	print("metric".ljust(22) + "value".rjust(12) + "unit".rjust(8))
+	for name, (unit, _higherIsBetter) in METRICS.items():
+		print(name.ljust(22) + str(round(results[name], 2)).rjust(12) + unit.rjust(8))
+
+	if args.output != None:
+		report = {
+			"time": time.time(),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"cpus": os.cpu_count(),
+			"options": options,
+			"results": results,
+		}
+		with open(args.output, "w") as outputFile:
+			json.dump(report, outputFile, indent=4)
+
+	if args.baseline != None:
+		with open(args.baseline, "r") as baselineFile:
+			baseline = json.load(baselineFile)
+
+		if baseline.get("options", None) != options:
+			print("[SYSTEM] The baseline was measured with other options, the comparison may not be meaningful")
+
+		print()
+		regressions = compare(results, baseline["results"], args.tolerance)
+		if regressions:
+			print("[SYSTEM] "+str(len(regressions))+" metric(s) regressed by more than "+str(round(args.tolerance * 100))+"%")
+			sys.exit(1)
+
+if __name__ == "__main__":
+	main()
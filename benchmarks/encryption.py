@@ -0,0 +1,44 @@
+# Run from the repository root with: python -m benchmarks.encryption
+from netmask.utils.encryption import NetmaskEncryption
+import hashlib
+import time
+import os
+
+# Variables
+PAYLOAD_SIZES = [3, 32, 256, 2048, 16384, 65536]
+MIN_DURATION = 0.5
+
+def legacyEncryptDecrypt(encryption, data):
+	# The original per-byte implementation, kept as the reference for output and speed
+	encryptionKey = hashlib.shake_256(encryption.rollingKey).digest(len(data))
+	return bytes([data[i] ^ encryptionKey[i % len(encryptionKey)] for i in range(len(data))])
+
+def measure(function, data):
+	iterations = 0
+	startTime = time.perf_counter()
+	while True:
+		function(data)
+		iterations += 1
+		elapsed = time.perf_counter() - startTime
+		if elapsed >= MIN_DURATION:
+			break
+	return (iterations * len(data)) / elapsed / 1024**2
+
+def main():
+	encryption = NetmaskEncryption(b"0")
+
+	print("size".rjust(8) + "legacy MB/s".rjust(16) + "bulk MB/s".rjust(16) + "speedup".rjust(10))
+	for size in PAYLOAD_SIZES:
+		data = os.urandom(size)
+
+		# Both implementations must produce exactly the same bytes
+		if legacyEncryptDecrypt(encryption, data) != encryption.encryptDecrypt(data):
+			raise RuntimeError("Output mismatch for payload size "+str(size))
+
+		legacy = measure(lambda buffer: legacyEncryptDecrypt(encryption, buffer), data)
+		bulk = measure(encryption.encryptDecrypt, data)
+
+		print(str(size).rjust(8) + str(round(legacy, 2)).rjust(16) + str(round(bulk, 2)).rjust(16) + (str(round(bulk / legacy, 1))+"x").rjust(10))
+
+if __name__ == "__main__":
+	main()
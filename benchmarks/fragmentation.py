@@ -0,0 +1,109 @@
+# Run from the repository root with: python -m benchmarks.fragmentation [--seed 1]
+from benchmarks.packets import samplePacket
+import netmask.impl.packets as packets
+import threading
+import argparse
+import random
+import socket
+import time
+import sys
+
+# Variables
+PACKET_COUNT = 20000
+MAX_FRAGMENT = 64
+PAUSE_CHANCE = 0.001
+BURST_COUNT = 50000
+
+class FragmentingSocket:
+	# Counts the reads of the handler under test, and with a generator cuts them short at random like a loaded link
+	def __init__(self, sock, generator = None):
+		self.sock = sock
+		self.generator = generator
+		self.reads = 0
+
+	def recv_into(self, buffer):
+		self.reads += 1
+		if self.generator != None and self.generator.random() < 0.9:
+			return self.sock.recv_into(buffer, self.generator.randint(1, min(len(buffer), MAX_FRAGMENT)))
+		return self.sock.recv_into(buffer)
+
+def randomPacket(generator):
+	packetClass = generator.choice(list(packets.packetList.values()))
+	packet = samplePacket(packetClass)
+
+	# Stream data of any size, so packets end everywhere in the receive buffer
+	if packetClass == packets.StreamData:
+		packet.data = generator.randbytes(generator.randint(1, packets.STREAM_CHUNK))
+	return packet
+
+def matches(sent, received):
+	# Every field that was decoded must be the one that was sent (SBindResponse doesn't send its IP version)
+	if type(sent) != type(received):
+		return False
+	unset = type(received)()
+	return all(getattr(received, field) == getattr(sent, field) for field in type(received).__slots__ if getattr(received, field) != getattr(unset, field))
+
+def writeFragmented(sock, stream, generator):
+	# Cut the stream at random boundaries, mostly tiny ones, and sometimes wait so the reader sees a partial packet
+	position = 0
+	while position < len(stream):
+		length = generator.randint(1, MAX_FRAGMENT) if generator.random() < 0.9 else generator.randint(1, 4 * packets.STREAM_CHUNK)
+		sock.sendall(stream[position:position + length])
+		position += length
+
+		if generator.random() < PAUSE_CHANCE:
+			time.sleep(0.001)
+	sock.close()
+
+def runRound(label, sentPackets, writer, readGenerator = None):
+	encoder = packets.ProtocolHandler("benchmark", None)
+	stream = b"".join(encoder.encodePacket(packet) for packet in sentPackets)
+
+	senderSocket, receiverSocket = socket.socketpair()
+	fragmentingSocket = FragmentingSocket(receiverSocket, readGenerator)
+	receiver = packets.ProtocolHandler("benchmark", fragmentingSocket)
+
+	writerThread = threading.Thread(target=writer, args=(senderSocket, stream))
+	startTime = time.perf_counter()
+	writerThread.start()
+
+	mismatches = 0
+	for sent in sentPackets:
+		received = receiver.recvPacket()
+		if received == None or not matches(sent, received):
+			mismatches += 1
+			break
+
+	elapsed = time.perf_counter() - startTime
+	writerThread.join()
+	receiverSocket.close()
+
+	print(label.ljust(24) + str(len(sentPackets)).rjust(10) + str(len(stream)).rjust(12) + str(fragmentingSocket.reads).rjust(10) + str(round(fragmentingSocket.reads / len(sentPackets), 3)).rjust(12) + str(round(len(sentPackets) / elapsed)).rjust(12) + ("  MISMATCH" if mismatches else ""))
+	return mismatches == 0
+
+def main():
+	parser = argparse.ArgumentParser(description="Feeds ProtocolHandler.recvPacket streams cut at random boundaries and checks every packet.")
+	parser.add_argument("--seed", type=int, default=None, help="Seed of the packet sequence and of the cuts. (default: random)")
+	parser.add_argument("--rounds", type=int, default=3, help="Fragmented rounds to run. (default: 3)")
+	args = parser.parse_args()
+
+	seed = args.seed if args.seed != None else random.randrange(2**32)
+	print("[SYSTEM] Seed "+str(seed))
+	generator = random.Random(seed)
+
+	print("round".ljust(24) + "packets".rjust(10) + "bytes".rjust(12) + "reads".rjust(10) + "reads/pkt".rjust(12) + "pkt/s".rjust(12))
+	passed = True
+	for roundIndex in range(args.rounds):
+		sentPackets = [randomPacket(generator) for _ in range(PACKET_COUNT)]
+		passed &= runRound("fragmented "+str(roundIndex + 1), sentPackets, lambda sock, stream: writeFragmented(sock, stream, random.Random(generator.random())), random.Random(generator.random()))
+
+	# A burst of visitors written at once should take a handful of reads, not one per packet
+	sentPackets = [samplePacket(packets.SConnection) for _ in range(BURST_COUNT)]
+	passed &= runRound("SConnection burst", sentPackets, lambda sock, stream: (sock.sendall(stream), sock.close()))
+
+	if not passed:
+		print("[SYSTEM] A packet didn't decode to what was sent, rerun with --seed "+str(seed))
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
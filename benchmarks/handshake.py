@@ -0,0 +1,108 @@
+# Run from the repository root with: python -m benchmarks.handshake
+from netmask.server.main import NetmaskServer
+import netmask.server.main as server
+import netmask.impl.packets as packets
+import tracemalloc
+import threading
+import resource
+import asyncio
+import hashlib
+import socket
+import time
+
+# Variables
+CLIENT_COUNTS = [100, 1000, 5000, 10000]
+COMMUNICATION_KEY = "benchmark"
+
+class BenchmarkClient(packets.ProtocolHandler):
+	# Only the handshake and the bind of NetmaskClient.connect, on the loop
+	client = True
+	gui = None
+
+	def __init__(self, reader, writer):
+		super().__init__(COMMUNICATION_KEY, None)
+		self.reader = reader
+		self.writer = writer
+
+	async def handshake(self):
+		self.writer.write(b"\x00")
+
+		cHandshake = packets.CHandshakeRequest()
+		cHandshake.encryptionKey = self.encryptionKey
+		await self.sendPacketAsync(cHandshake)
+
+		POERequest = await self.recvPacketAsync(packets.SPOERequest)
+		POEResponse = packets.CPOEResponse()
+		POEResponse.proofOfEncryptionResult = hashlib.sha256(POERequest.proofOfEncryptionRequest).digest()
+		await self.sendPacketAsync(POEResponse)
+
+		await self.recvPacketAsync(packets.SHandshakeResponse)
+
+		BindRequest = packets.CBindRequest()
+		BindRequest.bindMode = 0
+		BindRequest.ipVersion = 4
+		await self.sendPacketAsync(BindRequest)
+
+		return await self.recvPacketAsync(packets.SBindResponse)
+
+def freePort():
+	sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sock.bind(("127.0.0.1", 0))
+	port = sock.getsockname()[1]
+	sock.close()
+	return port
+
+async def connectClient(port, latencies, writers):
+	startTime = time.perf_counter()
+	reader, writer = await asyncio.open_connection("127.0.0.1", port)
+	writers.append(writer)
+
+	if await BenchmarkClient(reader, writer).handshake() != None:
+		latencies.append(time.perf_counter() - startTime)
+
+async def measure(netmaskServer, clientCount):
+	port = freePort()
+	await netmaskServer.startAsync("127.0.0.1", "-", port)
+
+	latencies = []
+	writers = []
+	tracemalloc.start()
+	startTime = time.perf_counter()
+	await asyncio.gather(*[connectClient(port, latencies, writers) for _ in range(clientCount)])
+	elapsed = time.perf_counter() - startTime
+
+	# Memory held while every client is connected and bound, client side included
+	memory, _peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	threadCount = threading.active_count()
+
+	for client in netmaskServer.clients.copy():
+		client.terminateConnection()
+	for writer in writers:
+		writer.close()
+	await asyncio.sleep(0.5)
+
+	latencies.sort()
+	percentile = lambda fraction: latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+	return len(latencies), elapsed, percentile(0.5), percentile(0.99), memory / clientCount, threadCount
+
+def main():
+	server.loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(server.loop)
+	netmaskServer = NetmaskServer(COMMUNICATION_KEY, publicIPv4="127.0.0.1", publicIPv6="-")
+
+	# Every client needs its own socket, the server's side of it and a listener for its bind
+	_softLimit, hardLimit = resource.getrlimit(resource.RLIMIT_NOFILE)
+	resource.setrlimit(resource.RLIMIT_NOFILE, (hardLimit, hardLimit))
+
+	print("clients".rjust(10) + "bound".rjust(8) + "total s".rjust(10) + "p50 ms".rjust(10) + "p99 ms".rjust(10) + "KiB/client".rjust(12) + "threads".rjust(10))
+	for clientCount in CLIENT_COUNTS:
+		if clientCount * 3 + 256 > hardLimit:
+			print(str(clientCount).rjust(10) + "  skipped, needs a higher open file limit")
+			continue
+
+		bound, elapsed, p50, p99, memory, threadCount = server.loop.run_until_complete(measure(netmaskServer, clientCount))
+		print(str(clientCount).rjust(10) + str(bound).rjust(8) + str(round(elapsed, 2)).rjust(10) + str(round(p50, 1)).rjust(10) + str(round(p99, 1)).rjust(10) + str(round(memory / 1024, 1)).rjust(12) + str(threadCount).rjust(10))
+
+if __name__ == "__main__":
+	main()
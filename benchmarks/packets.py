@@ -0,0 +1,218 @@
+# Run from the repository root with: python -m benchmarks.packets
+from netmask.utils.encryption import NetmaskEncryption
+import netmask.impl.packets as packets
+import multiprocessing
+import tracemalloc
+import asyncio
+import socket
+import time
+import os
+
+# Variables
+PAYLOAD_SIZES = [3, 32, 256, 2048, 16384, 65536]
+MIN_DURATION = 0.5
+ALLOCATION_ITERATIONS = 200
+
+# SConnection packets pushed down one control connection, by this many visitors at once
+CONTROL_PACKETS = 100000
+CONTROL_CONCURRENCY = [1, 16, 256]
+
+def samplePacket(packetClass):
+	# A valid instance of every packet, with the largest payload it can carry
+	packet = packetClass()
+	if packetClass == packets.CHandshakeRequest:
+		packet.encryptionKey = os.urandom(32)
+	elif packetClass == packets.SPOERequest:
+		packet.proofOfEncryptionRequest = os.urandom(32)
+	elif packetClass == packets.CPOEResponse:
+		packet.proofOfEncryptionResult = os.urandom(32)
+	elif packetClass == packets.CBindRequest:
+		packet.bindMode = 0
+		packet.ipVersion = 4
+		packet.flags = packets.BIND_FLAG_MULTIPLEX
+	elif packetClass == packets.SBindResponse:
+		packet.ipVersion = 4
+		packet.serverIP = "127.0.0.1"
+		packet.serverPort = 1024
+		packet.flags = 0
+	elif packetClass == packets.CResumeRequest:
+		packet.token = os.urandom(32)
+	elif packetClass == packets.SSessionToken:
+		packet.token = os.urandom(32)
+		packet.grace = 65535
+	elif packetClass == packets.SConnection:
+		packet.uid = os.urandom(32)
+		packet.bindId = 0
+	elif packetClass in [packets.SStreamOpen, packets.StreamClose]:
+		packet.streamId = 1
+	elif packetClass == packets.StreamData:
+		packet.streamId = 1
+		packet.data = os.urandom(packets.STREAM_CHUNK)
+	elif packetClass == packets.StreamWindowUpdate:
+		packet.streamId = 1
+		packet.increment = packets.STREAM_CHUNK
+	return packet
+
+def measure(function):
+	# Returns the time per call, the memory a call allocates at its peak, the memory it leaves behind,
+	# and the allocations held by what it returns
+	iterations = 0
+	startTime = time.perf_counter()
+	while True:
+		function()
+		iterations += 1
+		elapsed = time.perf_counter() - startTime
+		if elapsed >= MIN_DURATION:
+			break
+
+	tracemalloc.start()
+
+	# Every block a call allocates is traced, including those too large for pymalloc, keeping what the calls
+	# return and counting the traces before and after gives the allocations that outlive a call
+	results = [None] * ALLOCATION_ITERATIONS
+	startTraces = len(tracemalloc.take_snapshot().traces)
+	for index in range(ALLOCATION_ITERATIONS):
+		results[index] = function()
+	allocations = len(tracemalloc.take_snapshot().traces) - startTraces
+	del results
+
+	peak = 0
+	startMemory, _startPeak = tracemalloc.get_traced_memory()
+	for _ in range(ALLOCATION_ITERATIONS):
+		before, _previousPeak = tracemalloc.get_traced_memory()
+		tracemalloc.reset_peak()
+		function()
+		_current, callPeak = tracemalloc.get_traced_memory()
+		peak += callPeak - before
+	endMemory, _endPeak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	return elapsed / iterations * 1e9, peak / ALLOCATION_ITERATIONS, max(0, endMemory - startMemory) / ALLOCATION_ITERATIONS, max(0, allocations) / ALLOCATION_ITERATIONS
+
+def printHeader(label):
+	print()
+	print(label.ljust(30) + "ns/op".rjust(12) + "peak B/op".rjust(12) + "kept B/op".rjust(12) + "allocs/op".rjust(12))
+
+def printRow(label, result):
+	nanoseconds, peak, kept, allocations = result
+	print(label.ljust(30) + str(round(nanoseconds)).rjust(12) + str(round(peak)).rjust(12) + str(round(kept)).rjust(12) + str(round(allocations, 1)).rjust(12))
+
+def benchmarkCodec():
+	handler = packets.ProtocolHandler("benchmark", None)
+
+	# A pack allocates only the packed bytes it returns, so it can't allocate less than before. Unpacking allocates
+	# the packet and whatever values Python can't share, larger ints, addresses and a UID followed by a bind ID
+	printHeader("packet codec")
+	for packetId, packetClass in packets.packetList.items():
+		packet = samplePacket(packetClass)
+		metadata = packet.packMetadata()
+		buffer = packet.packBuffer()
+		packetLength = int.from_bytes(metadata[1:3], byteorder='big')
+
+		# Packing must round trip, or the numbers below are meaningless
+		if handler.decodePacket(packetId, packetLength, buffer, None) == None:
+			raise RuntimeError("Couldn't decode "+packetClass.__name__)
+
+		printRow(packetClass.__name__+" pack", measure(lambda: packet.packMetadata() + packet.packBuffer()))
+		printRow(packetClass.__name__+" unpack", measure(lambda: handler.decodePacket(packetId, packetLength, buffer, None)))
+
+def benchmarkEncryption():
+	printHeader("encryption")
+
+	# A look-ahead of 0 derives every key when it is rolled, like a connection that is never idle long enough to refill
+	cached = NetmaskEncryption(b"benchmark")
+	uncached = NetmaskEncryption(b"benchmark", keyLookahead=0)
+	printRow("rollKey cached + refill", measure(lambda: (cached.rollKey(), cached.refill())))
+	printRow("rollKey uncached", measure(uncached.rollKey))
+
+	for size in PAYLOAD_SIZES:
+		data = os.urandom(size)
+		cached.rollKey()
+		printRow("encryptDecrypt "+str(size)+" B", measure(lambda: cached.encryptDecrypt(data)))
+		printRow("encryptDecrypt "+str(size)+" B uncached", measure(lambda: uncached.encryptDecrypt(data)))
+
+def benchmarkHandler():
+	printHeader("ProtocolHandler over a socketpair")
+
+	for packetClass in [packets.SConnection, packets.StreamWindowUpdate, packets.StreamData]:
+		senderSocket, receiverSocket = socket.socketpair()
+		sender = packets.ProtocolHandler("benchmark", senderSocket)
+		receiver = packets.ProtocolHandler("benchmark", receiverSocket)
+		packet = samplePacket(packetClass)
+
+		def roundTrip():
+			sender.sendPacket(packet)
+			if receiver.recvPacket(packetClass) == None:
+				raise RuntimeError("Couldn't receive "+packetClass.__name__)
+
+		printRow(packetClass.__name__+" send+recv", measure(roundTrip))
+
+		senderSocket.close()
+		receiverSocket.close()
+
+def measureControlLink(concurrency, decode):
+	# Returns SConnection packets per second sent on the loop by this many visitors at once, the client reads
+	# them in a process of its own, either decoding them or only draining the socket to measure the server alone
+	context = multiprocessing.get_context("fork")
+	senderSocket, receiverSocket = socket.socketpair()
+	packetCount = CONTROL_PACKETS // concurrency * concurrency
+
+	def receive():
+		# The sender's end was inherited, close it or the end of the stream would never be seen
+		senderSocket.close()
+
+		if not decode:
+			while receiverSocket.recv(1024**2):
+				pass
+			return
+
+		receiver = packets.ProtocolHandler("benchmark", receiverSocket)
+		for _ in range(packetCount):
+			if receiver.recvPacket(packets.SConnection) == None:
+				raise RuntimeError("Couldn't receive SConnection")
+
+	async def send():
+		sender = packets.ProtocolHandler("benchmark", senderSocket)
+		sender.reader, sender.writer = await asyncio.open_connection(sock=senderSocket)
+		packet = samplePacket(packets.SConnection)
+
+		async def visitors(count):
+			for _ in range(count):
+				await sender.sendPacketAsync(packet)
+
+		await asyncio.gather(*[visitors(packetCount // concurrency) for _ in range(concurrency)])
+
+		# Closing flushes what is still buffered before the loop goes away
+		sender.writer.close()
+		await sender.writer.wait_closed()
+
+	receiverProcess = context.Process(target=receive)
+	startTime = time.perf_counter()
+	receiverProcess.start()
+	receiverSocket.close()
+	asyncio.run(send())
+	receiverProcess.join()
+	elapsed = time.perf_counter() - startTime
+
+	if receiverProcess.exitcode != 0:
+		raise RuntimeError("The receiver failed")
+	return packetCount / elapsed
+
+def benchmarkControlLink():
+	# How many visitors per second a server can announce to one client
+	print()
+	print("SConnection over one control link".ljust(30) + "packets/s".rjust(12) + "decoded/s".rjust(12))
+
+	for concurrency in CONTROL_CONCURRENCY:
+		sent = measureControlLink(concurrency, False)
+		decoded = measureControlLink(concurrency, True)
+		print((str(concurrency)+" at once").ljust(30) + str(round(sent)).rjust(12) + str(round(decoded)).rjust(12))
+
+def main():
+	benchmarkCodec()
+	benchmarkEncryption()
+	benchmarkHandler()
+	benchmarkControlLink()
+
+if __name__ == "__main__":
+	main()
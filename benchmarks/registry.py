@@ -0,0 +1,60 @@
+# Run from the repository root with: python -m benchmarks.registry
+from netmask.server.main import NetmaskServer, ServerConnection, NetmaskBind
+import netmask.server.main as server
+import asyncio
+import time
+
+# Variables
+SESSION_COUNTS = [10, 100, 1000, 10000, 100000]
+DATAGRAMS = 200000
+
+class NullTransport:
+	def sendto(self, data, address):
+		pass
+
+	def close(self):
+		pass
+
+def measure(function, addresses, data):
+	addressCount = len(addresses)
+	startTime = time.perf_counter()
+	for i in range(DATAGRAMS):
+		function(data, addresses[i % addressCount])
+	return (time.perf_counter() - startTime) / DATAGRAMS * 1e9
+
+def main():
+	server.loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(server.loop)
+	netmaskServer = NetmaskServer(publicIPv4="127.0.0.1", publicIPv6="-")
+
+	print("sessions".rjust(10) + "visitor->client ns".rjust(22) + "client->visitor ns".rjust(22))
+	for sessionCount in SESSION_COUNTS:
+		connection = ServerConnection(netmaskServer, None)
+		binding = NetmaskBind(connection, 1, 0)
+
+		handler = NetmaskBind.UDPHandler(binding)
+		handler.connection_made(NullTransport())
+		udpServer = NetmaskServer.UDPServer(netmaskServer)
+		udpServer.connection_made(NullTransport())
+
+		# Create every session and attach it to a client data address, like a finished rendezvous would
+		visitorAddresses = []
+		clientAddresses = []
+		for i in range(sessionCount):
+			visitorAddress = ("10." + str(i >> 16) + "." + str((i >> 8) & 255) + "." + str(i & 255), 40000)
+			clientAddress = ("127.0.0.1", 1024 + i % 60000, i)
+			session = handler.UDPProtocol(handler, visitorAddress)
+			handler.clients[visitorAddress] = session
+			udpServer.datagram_received(session.uid, clientAddress)
+
+			visitorAddresses.append(visitorAddress)
+			clientAddresses.append(clientAddress)
+
+		visitorCost = measure(handler.datagram_received, visitorAddresses, b"x" * 64)
+		clientCost = measure(udpServer.datagram_received, clientAddresses, b"x" * 64)
+		print(str(sessionCount).rjust(10) + str(round(visitorCost)).rjust(22) + str(round(clientCost)).rjust(22))
+
+		handler.killServer()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,107 @@
+# Run from the repository root with: python -m benchmarks.relay
+from netmask.server.main import NetmaskBind
+import netmask.server.main as server
+import netmask.utils.splice as splice
+import asyncio
+import types
+import time
+
+# Variables
+TOTAL_BYTES = 256 * 1024**2
+SLOW_TOTAL_BYTES = 16 * 1024**2
+SOURCE_CHUNK = 262144
+
+async def legacyForward(reader, writer):
+	# The original relay loop: fixed reads and no drain(), kept as the reference
+	try:
+		while True:
+			data = await reader.read(server.PACKET_BUFFER)
+			if not data:
+				break
+			writer.write(data)
+	finally:
+		writer.close()
+
+async def spliceForward(reader, writer, sinkReader, sinkWriter):
+	sourceSocket, pending = splice.takeStreamSocket(reader, writer)
+	sinkSocket, _sinkPending = splice.takeStreamSocket(sinkReader, sinkWriter)
+	try:
+		await splice.spliceForward(sourceSocket, sinkSocket, pending)
+	finally:
+		sourceSocket.close()
+		sinkSocket.close()
+		sinkWriter.close()
+
+async def runRelay(forward, totalBytes, slowSink):
+	received = [0]
+	sinkDone = server.loop.create_future()
+	peakBuffered = [0]
+
+	async def handleSink(reader, writer):
+		while True:
+			data = await reader.read(65536)
+			if not data:
+				break
+			received[0] += len(data)
+
+			# A slow receiver, roughly 64 MB/s at most
+			if slowSink:
+				await asyncio.sleep(0.001)
+		sinkDone.set_result(True)
+
+	async def handleRelay(reader, writer):
+		sinkReader, sinkWriter = await asyncio.open_connection("127.0.0.1", sinkPort)
+		sinkWriter.transport.set_write_buffer_limits(server.RELAY_HIGH_WATER, server.RELAY_LOW_WATER)
+
+		async def sample():
+			while not sinkDone.done():
+				peakBuffered[0] = max(peakBuffered[0], sinkWriter.transport.get_write_buffer_size())
+				await asyncio.sleep(0.001)
+
+		sampler = server.loop.create_task(sample())
+		await forward(reader, writer, sinkReader, sinkWriter)
+		await sinkDone
+		sampler.cancel()
+
+	sinkServer = await asyncio.start_server(handleSink, "127.0.0.1", 0)
+	sinkPort = sinkServer.sockets[0].getsockname()[1]
+	relayServer = await asyncio.start_server(handleRelay, "127.0.0.1", 0, limit=server.RELAY_READ_MAX)
+	relayPort = relayServer.sockets[0].getsockname()[1]
+
+	startTime = time.perf_counter()
+	_sourceReader, sourceWriter = await asyncio.open_connection("127.0.0.1", relayPort)
+	chunk = b"x" * SOURCE_CHUNK
+	for _ in range(totalBytes // SOURCE_CHUNK):
+		sourceWriter.write(chunk)
+		await sourceWriter.drain()
+	sourceWriter.close()
+
+	await sinkDone
+	elapsed = time.perf_counter() - startTime
+
+	sinkServer.close()
+	relayServer.close()
+
+	return totalBytes / elapsed / 1024**2, peakBuffered[0]
+
+def main():
+	server.loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(server.loop)
+
+	# forward only counts bytes on the bind, a stand-in is enough
+	countingProtocol = types.SimpleNamespace(bindClass=types.SimpleNamespace(receivedBytes=0, sentBytes=0))
+	engines = [
+		("legacy", lambda reader, writer, sinkReader, sinkWriter: legacyForward(reader, sinkWriter)),
+		("current", lambda reader, writer, sinkReader, sinkWriter: NetmaskBind.TCPProtocol.forward(countingProtocol, reader, sinkWriter, True))
+	]
+	if splice.isAvailable():
+		engines.append(("splice", spliceForward))
+
+	print("engine".rjust(10) + "sink".rjust(8) + "MB/s".rjust(12) + "peak buffered KiB".rjust(20))
+	for slowSink in [False, True]:
+		for name, forward in engines:
+			throughput, peakBuffered = server.loop.run_until_complete(runRelay(forward, SLOW_TOTAL_BYTES if slowSink else TOTAL_BYTES, slowSink))
+			print(name.rjust(10) + ("slow" if slowSink else "fast").rjust(8) + str(round(throughput, 1)).rjust(12) + str(peakBuffered // 1024).rjust(20))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,78 @@
+# Run from the repository root with: python -m benchmarks.rendezvous
+from netmask.server.main import NetmaskBind
+import netmask.server.main as server
+import asyncio
+import time
+import os
+
+# Variables
+PENDING_COUNTS = [100, 1000, 5000, 10000]
+WINDOW = 2
+
+class PendingBind:
+	# Stands in for NetmaskBind, ServerConnection and NetmaskServer, the client never dials back
+	multiplexed = False
+	bindId = None
+
+	def __init__(self):
+		self.connectionClass = self
+		self.serverClass = self
+		self.pendingTCPConnections = {}
+
+	def newUID(self):
+		return os.urandom(32)
+
+	async def connectionHandler(self, uid, bindId = None):
+		return True
+
+	async def _stopServer(self):
+		pass
+
+class NullWriter:
+	def write(self, data):
+		pass
+
+	def close(self):
+		pass
+
+async def legacyRendezvous(tcpProtocol):
+	# The original 10ms polling loop, kept as the reference
+	timeoutCounter = 0
+	while tcpProtocol.server == None:
+		await asyncio.sleep(0.01)
+		if timeoutCounter >= round(server.MAX_TIMEOUT / 0.01):
+			return
+		timeoutCounter += 1
+
+def measure(pendingCount, legacy):
+	bindClass = PendingBind()
+	protocols = [NetmaskBind.TCPProtocol(bindClass) for _ in range(pendingCount)]
+	if legacy:
+		tasks = [server.loop.create_task(legacyRendezvous(protocol)) for protocol in protocols]
+	else:
+		tasks = [server.loop.create_task(protocol.handleClient(None, NullWriter())) for protocol in protocols]
+
+	# Let every task reach its waiting point, then measure CPU time while they all wait
+	server.loop.run_until_complete(asyncio.sleep(0.1))
+	startTime = time.process_time()
+	server.loop.run_until_complete(asyncio.sleep(WINDOW))
+	cpuTime = time.process_time() - startTime
+
+	for task in tasks:
+		task.cancel()
+	server.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+	return cpuTime / WINDOW * 100
+
+def main():
+	server.loop = asyncio.new_event_loop()
+	asyncio.set_event_loop(server.loop)
+
+	print("pending".rjust(10) + "polling CPU %".rjust(16) + "future CPU %".rjust(16))
+	for pendingCount in PENDING_COUNTS:
+		legacy = measure(pendingCount, True)
+		current = measure(pendingCount, False)
+		print(str(pendingCount).rjust(10) + str(round(legacy, 1)).rjust(16) + str(round(current, 1)).rjust(16))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,90 @@
+# Run from the repository root with: python -m benchmarks.workers
+from netmask.client.main import NetmaskClient
+from netmask.server.main import NetmaskServer
+import multiprocessing
+import threading
+import socket
+import time
+import os
+
+# Variables
+TUNNELS = 8
+BYTES_PER_TUNNEL = 128 * 1024**2
+SOURCE_CHUNK = 262144
+SERVER_PORT = 24024
+
+def runServer(port, workerCount):
+	NetmaskServer("benchmark", False, False, workerCount, "127.0.0.1", "-").start("127.0.0.1", "-", port)
+
+def runTunnel(port, barrier, results):
+	# One client, its local service and its visitor, in a process of their own so they don't share a GIL with the others
+	sink = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+	sink.bind(("127.0.0.1", 0))
+	sink.listen(1)
+
+	def drain():
+		conn, _address = sink.accept()
+		while conn.recv(SOURCE_CHUNK):
+			pass
+		conn.close()
+
+	threading.Thread(target=drain, daemon=True).start()
+
+	client = NetmaskClient("benchmark", sink.getsockname()[1], 0, 4)
+	threading.Thread(target=client.connect, args=("127.0.0.1", port), daemon=True).start()
+	while not client.isConnected:
+		time.sleep(0.01)
+
+	host, bindPort = client.bindedAddress.split(":")
+	barrier.wait()
+
+	startTime = time.perf_counter()
+	visitor = socket.create_connection((host, int(bindPort)))
+	chunk = b"x" * SOURCE_CHUNK
+	for _ in range(BYTES_PER_TUNNEL // SOURCE_CHUNK):
+		visitor.sendall(chunk)
+	visitor.shutdown(socket.SHUT_WR)
+
+	# The relay closes the visitor once the client side is done
+	visitor.recv(1)
+	results.put(time.perf_counter() - startTime)
+
+	# Flush the queue before skipping the client's non-daemon threads on exit
+	results.close()
+	results.join_thread()
+	os._exit(0)
+
+def measure(workerCount, port):
+	context = multiprocessing.get_context("fork")
+	serverProcess = context.Process(target=runServer, args=(port, workerCount), daemon=True)
+	serverProcess.start()
+	time.sleep(1)
+
+	barrier = context.Barrier(TUNNELS)
+	results = context.Queue()
+	tunnels = [context.Process(target=runTunnel, args=(port, barrier, results)) for _ in range(TUNNELS)]
+	for tunnel in tunnels:
+		tunnel.start()
+
+	elapsed = max(results.get() for _ in tunnels)
+	for tunnel in tunnels:
+		tunnel.join()
+
+	# Workers exit on their own once the main server process is gone
+	serverProcess.kill()
+	serverProcess.join()
+
+	return TUNNELS * BYTES_PER_TUNNEL / elapsed / 1024**2
+
+def main():
+	workerCounts = [1]
+	while workerCounts[-1] * 2 <= (os.cpu_count() or 1):
+		workerCounts.append(workerCounts[-1] * 2)
+
+	print("workers".rjust(10) + "tunnels".rjust(10) + "MB/s".rjust(12))
+	for index, workerCount in enumerate(workerCounts):
+		throughput = measure(workerCount, SERVER_PORT + index)
+		print(str(workerCount).rjust(10) + str(TUNNELS).rjust(10) + str(round(throughput, 1)).rjust(12))
+
+if __name__ == "__main__":
+	main()
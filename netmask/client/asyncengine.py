@@ -0,0 +1,262 @@
+import netmask.utils.compression as compression
+import netmask.impl.packets as packets
+import ipaddress
+import asyncio
+import socket
+import os
+
+# Variables
+PACKET_BUFFER = 65536
+
+class AsyncForwardingEngine:
+	# Runs the control channel and every forwarded connection of a NetmaskClient on a single event loop
+
+	class UDPForwardingProtocol(asyncio.DatagramProtocol):
+		def __init__(self, engine, uid, connClass, bind):
+			self.engine = engine
+			self.client = engine.client
+			self.uid = uid
+			self.connClass = connClass
+			self.isForwarding = False
+			self.transport = None
+
+			self.serverAddress = (self.client.host, self.client.port)
+			self.localAddress = (self.client.localHost, bind.localPort)
+
+		def connection_made(self, transport):
+			self.transport = transport
+
+			# Send UID
+			transport.sendto(self.uid, self.serverAddress)
+
+		def datagram_received(self, data, address):
+			if not self.isForwarding:
+				# Wait for the server's confirmation
+				if address != self.serverAddress:
+					return
+
+				if data != b"\x01":
+					if self.client.verbose:
+						print("[CLIENT] Forwarding socket failed.")
+					self.transport.close()
+					return
+
+				self.isForwarding = True
+				return
+
+			if address == self.serverAddress:
+				self.transport.sendto(data, self.localAddress)
+				self.connClass.downloadedBytes += len(data)
+			elif address == self.localAddress:
+				self.transport.sendto(data, self.serverAddress)
+				self.connClass.uploadedBytes += len(data)
+
+		def connection_lost(self, exc):
+			self.engine.removeConnection(self.connClass)
+
+	def __init__(self, client):
+		self.client = client
+
+		# The loop only keeps weak references to tasks, keep the forwarding ones alive until they finish
+		self.tasks = set()
+
+	def addConnection(self):
+		# Make connection class
+		connClass = self.client.Connection()
+		self.client.connections.add(connClass)
+		return connClass
+
+	def removeConnection(self, connClass):
+		self.client.connections.remove(connClass)
+
+	async def forward(self, reader, writer, connClass, isUpload):
+		try:
+			while True:
+				data = await reader.read(PACKET_BUFFER)
+				if not data:
+					break
+
+				if isUpload:
+					connClass.uploadedBytes += len(data)
+				else:
+					connClass.downloadedBytes += len(data)
+
+				writer.write(data)
+				await writer.drain()
+		except OSError:
+			pass
+		finally:
+			writer.close()
+
+	async def compressForward(self, reader, writer, connClass):
+		# Local service to server, flushed once the local service has nothing more buffered
+		algorithm, level = self.client.compressionSettings
+		compressor = compression.StreamCompressor(algorithm, level, connClass.compressionStats)
+		try:
+			while True:
+				data = await reader.read(PACKET_BUFFER)
+				if not data:
+					# The local service is done, what the compressor still holds has to reach the server first
+					output = compressor.compress(b"", True)
+					if output:
+						writer.write(output)
+						await writer.drain()
+					break
+
+				connClass.downloadedBytes += len(data)
+
+				output = compressor.compress(data, compression.isDrained(reader))
+				if output:
+					writer.write(output)
+					await writer.drain()
+		except OSError:
+			pass
+		finally:
+			writer.close()
+
+	async def decompressForward(self, reader, writer, connClass):
+		decompressor = compression.StreamDecompressor(self.client.compressionSettings[0], connClass.compressionStats)
+		try:
+			while True:
+				data = await reader.read(PACKET_BUFFER)
+				if not data:
+					break
+
+				for output in decompressor.decompressChunks(data, PACKET_BUFFER):
+					connClass.uploadedBytes += len(output)
+					writer.write(output)
+					await writer.drain()
+		except OSError:
+			pass
+		finally:
+			writer.close()
+
+	async def forwardTCP(self, uid, bind):
+		client = self.client
+		connClass = self.addConnection()
+		localWriter = None
+		serverWriter = None
+
+		try:
+			if client.verbose:
+				print("[CLIENT] Connecting to "+client.localHost+":"+str(bind.localPort))
+
+			try:
+				localReader, localWriter = await asyncio.open_connection(client.localHost, bind.localPort)
+			except OSError:
+				if client.verbose:
+					print("[SYSTEM] Connection to "+client.localHost+":"+str(bind.localPort)+" failed")
+				return
+
+			if client.verbose:
+				print("[SYSTEM] Connecting to "+client.host+":"+str(client.port))
+
+			try:
+				serverReader, serverWriter = await asyncio.open_connection(client.host, client.port)
+			except OSError:
+				if client.verbose:
+					print("[SYSTEM] Connection to "+client.host+":"+str(client.port)+" failed")
+				return
+
+			# Send the mode and the UID
+			serverWriter.write(b"\x01"+uid)
+
+			# Receive confirmation
+			try:
+				confirmation = await serverReader.readexactly(1)
+			except (asyncio.IncompleteReadError, OSError):
+				confirmation = b""
+
+			if confirmation != b"\x01":
+				if client.verbose:
+					print("[CLIENT] Forwarding socket failed.")
+				return
+
+			# Forward the connection between the two sockets
+			if bind.isCompressed:
+				connClass.compressionStats = compression.CompressionStats()
+				await asyncio.gather(self.compressForward(localReader, serverWriter, connClass), self.decompressForward(serverReader, localWriter, connClass))
+				client.reportCompression(connClass)
+				return
+
+			await asyncio.gather(self.forward(localReader, serverWriter, connClass, False), self.forward(serverReader, localWriter, connClass, True))
+		finally:
+			for writer in [localWriter, serverWriter]:
+				if writer != None:
+					writer.close()
+
+			self.removeConnection(connClass)
+
+	async def forwardUDP(self, uid, bind):
+		client = self.client
+		connClass = self.addConnection()
+
+		if client.verbose:
+			print("[SYSTEM] Connecting to "+client.host+":"+str(client.port))
+
+		family = socket.AF_INET6 if ipaddress.ip_network(client.localHost).version == 6 else socket.AF_INET
+		try:
+			await asyncio.get_event_loop().create_datagram_endpoint(lambda: self.UDPForwardingProtocol(self, uid, connClass, bind), family=family)
+		except OSError:
+			self.removeConnection(connClass)
+
+	async def attach(self):
+		client = self.client
+
+		# Hand the already authenticated control socket over to the loop, along with what was read past the bind
+		client.socket.settimeout(None)
+		loop = asyncio.get_event_loop()
+		client.reader = asyncio.StreamReader()
+		client.reader.feed_data(client.takeBuffered())
+		transport, protocol = await loop.create_connection(lambda: asyncio.StreamReaderProtocol(client.reader), sock=client.socket)
+		client.writer = asyncio.StreamWriter(transport, protocol, client.reader, loop)
+
+	async def serve(self):
+		client = self.client
+		await self.attach()
+
+		while True:
+			try:
+				connectionPacket = await client.recvPacketAsync(packets.SConnection)
+			except packets.ConnectionInterrupted:
+				# Resuming blocks, the forwarded connections keep going on the loop meanwhile
+				client.writer.close()
+				await asyncio.get_event_loop().run_in_executor(None, client.resumeSession)
+				await self.attach()
+				continue
+
+			if connectionPacket == None:
+				return
+
+			bind = client.getBind(connectionPacket)
+			if bind == None:
+				client.terminateConnection()
+				return
+
+			# Demultiplexed UDP binds are forwarded on their own thread
+			if bind.demultiplexer != None:
+				bind.demultiplexer.addSession(connectionPacket.uid)
+				continue
+
+			if bind.bindMode == 0:
+				task = asyncio.ensure_future(self.forwardTCP(connectionPacket.uid, bind))
+			else:
+				task = asyncio.ensure_future(self.forwardUDP(connectionPacket.uid, bind))
+
+			self.tasks.add(task)
+			task.add_done_callback(self.tasks.discard)
+
+	def run(self):
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		try:
+			loop.run_until_complete(self.serve())
+		except KeyboardInterrupt:
+			if self.client.gui != None:
+				while True:
+					try:
+						self.client.gui.quitProgram()
+					except:
+						pass
+			else:
+				os._exit(0)
@@ -1,29 +1,50 @@
+from netmask.client.asyncengine import AsyncForwardingEngine
+from netmask.client.udpdemux import UDPDemultiplexer
+import netmask.utils.compression as compression
+from netmask.utils.profiling import timers
 import netmask.impl.packets as packets
+import netmask.utils.splice as splice
+import itertools
 import threading
 import ipaddress
 import hashlib
 import socket
 import select
 import shutil
+import queue
 import time
 import sys
 import os
 
 # Variables
 PACKET_BUFFER = 2048
+POOL_REFILL_RATE = 10
+POOL_MAX_AGE = 30
+
+# Largest piece a compressed read from the server is decompressed into at once
+DECOMPRESS_CHUNK = 65536
+
+# Delay between attempts to resume a dropped session, doubled after every failed one
+RESUME_RETRY = 0.1
+RESUME_RETRY_MAX = 2
+
+# Frames drawn per second by the GUI, only changed cells are written to the terminal
+GUI_REFRESH_RATE = 4
 
 class NetmaskClientGUI:
-	def __init__(self, client):
+	def __init__(self, client, refreshRate = GUI_REFRESH_RATE):
 		self.client = client
-		self.lastUpdate = None
+		self.refreshRate = refreshRate
 
 		# Timer for download and upload
 		self.downloadSpeed = "0 B/s"
 		self.uploadSpeed = "0 B/s"
 		self.oldTime = time.time()
+		self.oldTotals = (0, 0)
 
-		self.currentBuffer = ""
-		self.currentLineLength = 0
+		# Lines currently on the terminal, only the cells that changed since are written again
+		self.screenLines = []
+		self.screenSize = None
 
 	def bytesToText(self, size):
 		if size < 1024:
@@ -35,16 +56,25 @@ class NetmaskClientGUI:
 		else:
 			return str(round(size / 1024**3, 2))+" GB"
 
-	def addToBuffer(self, text):
-		self.currentBuffer += text
-		if "\n" in text:
-			self.currentLineLength = len(text.split("\n", 1)[-1])
-		else:
-			self.currentLineLength += len(text)
+	def fitLine(self, text, columns):
+		# Pad or cut a line that starts with a border, and close it with one
+		return (text + " " * columns)[:columns - 1] + "|"
+
+	def splitLine(self, leftText, leftPosition, rightText, rightPosition, columns):
+		# A line split in the middle, with a text placed in each half
+		line = list("|" + " " * (columns - 2) + "|")
+		line[(columns - 1) // 2] = "|"
+
+		for text, position in [(leftText, leftPosition), (rightText, rightPosition)]:
+			position = max(1, position)
+			text = text[:max(0, columns - 1 - position)]
+			line[position:position + len(text)] = text
+
+		return "".join(line)
 
 	def drawInterface(self):
 		columns, rows = shutil.get_terminal_size()
-		self.currentBuffer = ""
+		lines = []
 
 		# +--------+
 		verticalBorder = "+" + ("-" * (columns - 2)) + "+"
@@ -53,7 +83,7 @@ class NetmaskClientGUI:
 		emptyLine = "|" + (" " * (columns - 2)) + "|"
 
 		# Add first vertical border
-		self.addToBuffer(verticalBorder + "\n")
+		lines.append(verticalBorder)
 
 		# Calculate offset on what line to put the other border
 		offset = round(rows/10) # 10%
@@ -65,143 +95,120 @@ class NetmaskClientGUI:
 		# Find the middle of the offset
 		middleOffset = round((offset+1)/2) - 1
 
-		for row in range(rows-2):
-			try:
-				if row == offset:
-					# Draw top bar border
-					self.addToBuffer(verticalBorder)
-				elif row == middleOffset - 1:
-					# Draw download and upload names
-					downloadPosition = round(columns / 4)
-					uploadPosition = downloadPosition * 3
-
-					# Apply offset for text
-					downloadPosition -= 4
-					uploadPosition -= 3
-
-					# Draw with the download and upload name positions
-					self.addToBuffer("|")
-
-					self.addToBuffer(" " * (downloadPosition - self.currentLineLength))
-
-					self.addToBuffer("DOWNLOAD")
-
-					centerOffset = ((columns - 1) // 2) - self.currentLineLength
-
-					self.addToBuffer((" " * centerOffset) + "|")
-
-					self.addToBuffer(" " * (uploadPosition - self.currentLineLength))
-
-					self.addToBuffer("UPLOAD")
-
-					self.addToBuffer((" " * (columns - self.currentLineLength - 1)) + "|")
-				elif row == middleOffset + 1:
-					# Draw download and upload speed
-					downloadPosition = round(columns / 4)
-					uploadPosition = downloadPosition * 3
-
-					# Apply offset for text
-					downloadPosition -= round(len(self.downloadSpeed)/2)
-					uploadPosition -= round(len(self.uploadSpeed)/2)
-
-					# Draw with the download and upload speed positions
-					self.addToBuffer("|")
-					self.addToBuffer(" " * (downloadPosition - self.currentLineLength))
-					self.addToBuffer(self.downloadSpeed)
-
-					centerOffset = ((columns - 1) // 2) - self.currentLineLength
-
-					self.addToBuffer((" " * centerOffset) + "|")
-					self.addToBuffer(" " * (uploadPosition - self.currentLineLength))
-					self.addToBuffer(self.uploadSpeed)
-					self.addToBuffer((" " * (columns - self.currentLineLength - 1)) + "|")
-
-				elif row == rows - 4:
-					# This is the line above the status line (which is located at the bottom)
-					self.addToBuffer(verticalBorder)
-					
-				elif row == rows - 3:
-					# This is the status line, we will get the current connection status and binded IP (if any)
-					self.addToBuffer("| ")
-					self.addToBuffer("STATUS: ")
-					self.addToBuffer("Connected" if self.client.isConnected else "Connecting")
-
-					if self.client.isConnected:
-						self.addToBuffer(" | ")
-						self.addToBuffer("IP: ")
-						self.addToBuffer(self.client.bindedAddress)
+		# Only the connections that fit on the screen are read
+		visibleConnections = self.client.connections.visible(max(0, rows - 5 - offset))
 
-					self.addToBuffer((" " * (columns - self.currentLineLength - 1)) + "|")
-
-				elif row < offset:
-					# Draw the lines to split between download and upload
-					centerOffset = (columns - 1) // 2
+		for row in range(rows-2):
+			if row == offset:
+				# Draw top bar border
+				lines.append(verticalBorder)
+			elif row == middleOffset - 1:
+				# Draw download and upload names
+				downloadPosition = round(columns / 4)
+				uploadPosition = downloadPosition * 3
+				lines.append(self.splitLine("DOWNLOAD", downloadPosition - 4, "UPLOAD", uploadPosition - 3, columns))
+			elif row == middleOffset + 1:
+				# Draw download and upload speed
+				downloadPosition = round(columns / 4)
+				uploadPosition = downloadPosition * 3
+				lines.append(self.splitLine(self.downloadSpeed, downloadPosition - round(len(self.downloadSpeed)/2), self.uploadSpeed, uploadPosition - round(len(self.uploadSpeed)/2), columns))
+			elif row == rows - 4:
+				# This is the line above the status line (which is located at the bottom)
+				lines.append(verticalBorder)
+			elif row == rows - 3:
+				# This is the status line, we will get the current connection status and binded IP (if any)
+				status = ["| STATUS: ", "Connected" if self.client.isConnected else "Connecting"]
+
+				if self.client.isConnected:
+					status.append(" | IP: "+self.client.bindedAddress)
+
+				if self.client.connectionPool != None:
+					poolStats = self.client.connectionPool.stats()
+					status.append(" | POOL: "+str(poolStats["available"])+"/"+str(poolStats["size"]))
+					status.append(" (HITS: "+str(poolStats["hits"])+", MISSES: "+str(poolStats["misses"])+")")
+
+				if self.client.isCompressed:
+					compressionStats = self.client.connections.compressionTotals()
+					status.append(" | RATIO: "+str(round(compressionStats.ratio(), 3))+" ("+str(round(compressionStats.seconds, 2))+" s CPU)")
+
+				if self.client.resumeCount != 0:
+					status.append(" | RESUMED: "+str(self.client.resumeCount)+" (LAST: "+str(round(self.client.lastResumeTime * 1000))+" ms)")
+
+				lines.append(self.fitLine("".join(status), columns))
+			elif row < offset:
+				# Draw the lines to split between download and upload
+				lines.append(self.splitLine("", 0, "", 0, columns))
+			elif row - offset - 1 < len(visibleConnections):
+				connection = visibleConnections[row - offset - 1]
+
+				connectionIDString = str(connection.connectionID)
+				leadingSpaces = (7 - len(connectionIDString)) // 2
+				trailingSpaces = 7 - len(connectionIDString) - leadingSpaces
+				lines.append(self.fitLine("|" + " " * leadingSpaces + connectionIDString + " " * trailingSpaces + "|   " + str(connection.downloadedBytes) + " - " + str(connection.uploadedBytes), columns))
+			else:
+				lines.append(emptyLine)
 
-					self.addToBuffer("|")
-					self.addToBuffer((" " * (centerOffset - 1)))
-					self.addToBuffer("|")
-					self.addToBuffer((" " * (columns - centerOffset - 2)))
-					self.addToBuffer("|")
-				else:
-					if len(self.client.connections) < row - offset:
-						self.addToBuffer(emptyLine)
-					else:
-						connection = self.client.connections[row - offset - 1]
+		lines.append(verticalBorder)
+		self.renderLines(lines, (columns, rows))
 
-						self.addToBuffer("|")
+	def renderLines(self, lines, size):
+		output = []
 
-						connectionIDString = str(connection.connectionID)
-						leadingSpaces = (7 - len(connectionIDString)) // 2
-						trailingSpaces = 7 - len(connectionIDString) - leadingSpaces
-						self.addToBuffer(" " * leadingSpaces + connectionIDString + " " * trailingSpaces)
-						self.addToBuffer("|   ")
+		# Start over on a cleared screen when the terminal was resized
+		if size != self.screenSize:
+			output.append("\033[2J")
+			self.screenLines = []
+			self.screenSize = size
 
-						self.addToBuffer(str(connection.downloadedBytes))
-						#connection.downloadedBytes = 0
+		for row, line in enumerate(lines):
+			previousLine = self.screenLines[row] if row < len(self.screenLines) else ""
+			if line == previousLine:
+				continue
 
-						self.addToBuffer(" - ")
+			# Only rewrite the span between the first and the last changed cell
+			start = 0
+			while start < len(previousLine) and start < len(line) and line[start] == previousLine[start]:
+				start += 1
 
-						self.addToBuffer(str(connection.uploadedBytes))
-						#connection.uploadedBytes = 0
+			end = len(line)
+			if len(previousLine) == len(line):
+				while end > start and line[end - 1] == previousLine[end - 1]:
+					end -= 1
 
-						self.addToBuffer(" " * (columns - self.currentLineLength - 1))
-						self.addToBuffer("|")
-			finally:
-				self.addToBuffer("\n")
+			output.append("\033["+str(row + 1)+";"+str(start + 1)+"H"+line[start:end])
 
-		self.addToBuffer(verticalBorder + "\r")
-		sys.stdout.write(self.currentBuffer)
+		self.screenLines = lines
 
+		if output:
+			sys.stdout.write("".join(output))
+			sys.stdout.flush()
 
 	def displayGUI(self):
 		try:
 			self.oldTime = time.time()
 
-			while True:
-				# Move the cursor on the top of the screen
-				sys.stdout.write("\033[H")
-				sys.stdout.flush()
-
-				# Hide cursor
-				sys.stdout.write("\033[?25l")
-				sys.stdout.flush()
-
-				# Sleep a bit to not consume too many CPU cycles
-				time.sleep(0.03)
+			# Hide cursor
+			sys.stdout.write("\033[?25l")
+			sys.stdout.flush()
 
+			while True:
 				# Every second, update download and upload speed
-				if self.oldTime + 1 <= time.time():
-					self.downloadSpeed = self.bytesToText(self.client.downloadedBytesBuffer)+"/s"
-					self.uploadSpeed = self.bytesToText(self.client.uploadedBytesBuffer)+"/s"
-
-					self.client.downloadedBytesBuffer = 0
-					self.client.uploadedBytesBuffer = 0
+				currentTime = time.time()
+				if self.oldTime + 1 <= currentTime:
+					totals = self.client.connections.totals()
+					elapsed = currentTime - self.oldTime
+					self.downloadSpeed = self.bytesToText(round((totals[0] - self.oldTotals[0]) / elapsed))+"/s"
+					self.uploadSpeed = self.bytesToText(round((totals[1] - self.oldTotals[1]) / elapsed))+"/s"
 
-					self.oldTime = time.time()
+					self.oldTotals = totals
+					self.oldTime = currentTime
 
 				# Draw the interface
 				self.drawInterface()
 
+				# Sleep between frames to not consume too many CPU cycles
+				time.sleep(1 / self.refreshRate)
+
 		except KeyboardInterrupt:
 			self.quitProgram()
 
@@ -225,25 +232,219 @@ class NetmaskClientGUI:
 				pass
 
 
+class DataConnectionPool:
+	def __init__(self, client, size, refillRate):
+		self.client = client
+		self.size = size
+		self.refillRate = refillRate
+
+		# Pairs of (socket, time opened), newest last
+		self.connections = []
+		self.lock = threading.Lock()
+
+		self.hits = 0
+		self.misses = 0
+		self.opened = 0
+		self.discarded = 0
+
+	def isAlive(self, conn):
+		# The server never writes on an unclaimed data connection, so readable means closed
+		try:
+			readSockets, _writeSockets, errorSockets = select.select([conn], [], [conn], 0)
+			return not readSockets and not errorSockets
+		except (OSError, ValueError):
+			return False
+
+	def acquire(self):
+		with self.lock:
+			while self.connections:
+				conn, openedTime = self.connections.pop()
+				if openedTime + POOL_MAX_AGE > time.time() and self.isAlive(conn):
+					self.hits += 1
+					return conn
+
+				conn.close()
+				self.discarded += 1
+
+			self.misses += 1
+			return None
+
+	def expire(self):
+		with self.lock:
+			currentTime = time.time()
+			for conn, openedTime in self.connections.copy():
+				if openedTime + POOL_MAX_AGE <= currentTime or not self.isAlive(conn):
+					self.connections.remove((conn, openedTime))
+					conn.close()
+					self.discarded += 1
+
+	def refillThread(self):
+		while True:
+			# Open at most one connection per tick, so a burst of claims can't hammer the server
+			time.sleep(1 / self.refillRate)
+			self.expire()
+
+			if len(self.connections) >= self.size:
+				continue
+
+			conn = self.client.openDataConnection()
+			if conn == None:
+				continue
+
+			try:
+				# Send the mode right away, the UID is sent once a visitor arrives
+				conn.sendall(b"\x01")
+			except OSError:
+				conn.close()
+				continue
+
+			with self.lock:
+				self.connections.append((conn, time.time()))
+				self.opened += 1
+
+	def stats(self):
+		claims = self.hits + self.misses
+		return {
+			"size": self.size,
+			"available": len(self.connections),
+			"hits": self.hits,
+			"misses": self.misses,
+			"hitRate": self.hits / claims if claims != 0 else 0.0,
+			"opened": self.opened,
+			"discarded": self.discarded
+		}
+
+class ConnectionRegistry:
+	# Connections by ID, their counters are only written by their own forwarding threads and summed up when read
+	def __init__(self):
+		self.connections = {}
+		self.connectionCounter = 0
+		self.lock = threading.Lock()
+
+		# Totals of the connections that already closed
+		self.closedDownloadedBytes = 0
+		self.closedUploadedBytes = 0
+		self.closedCompressionStats = compression.CompressionStats()
+
+	def add(self, connClass):
+		with self.lock:
+			connClass.connectionID = self.connectionCounter
+			self.connectionCounter += 1
+			self.connections[connClass.connectionID] = connClass
+
+	def remove(self, connClass):
+		with self.lock:
+			if self.connections.pop(connClass.connectionID, None) is connClass:
+				self.closedDownloadedBytes += connClass.downloadedBytes
+				self.closedUploadedBytes += connClass.uploadedBytes
+				if connClass.compressionStats != None:
+					self.closedCompressionStats.merge(connClass.compressionStats)
+
+	def visible(self, count):
+		# The oldest connections first, like they are listed
+		with self.lock:
+			return list(itertools.islice(self.connections.values(), count))
+
+	def totals(self):
+		with self.lock:
+			downloadedBytes = self.closedDownloadedBytes
+			uploadedBytes = self.closedUploadedBytes
+			for connClass in self.connections.values():
+				downloadedBytes += connClass.downloadedBytes
+				uploadedBytes += connClass.uploadedBytes
+		return downloadedBytes, uploadedBytes
+
+	def compressionTotals(self):
+		totals = compression.CompressionStats()
+		with self.lock:
+			totals.merge(self.closedCompressionStats)
+			for connClass in self.connections.values():
+				if connClass.compressionStats != None:
+					totals.merge(connClass.compressionStats)
+		return totals
+
+	def __len__(self):
+		return len(self.connections)
+
 class NetmaskClient(packets.ProtocolHandler):
 	class Connection:
 		connectionID = 0
 		downloadedBytes = 0
 		uploadedBytes = 0
 
-	def __init__(self, communicationKey, localPort, bindMode, ipVersion, verbose = False):
+		# Only set on compressed tunnels, written by the connection's own thread like the byte counters
+		compressionStats = None
+
+	class Stream:
+		def __init__(self, streamId):
+			self.streamId = streamId
+			self.incoming = queue.Queue()
+			self.closed = False
+
+			# How many bytes the server still accepts on this stream
+			self.sendWindow = packets.STREAM_WINDOW
+			self.windowCondition = threading.Condition()
+
+	class Bind:
+		def __init__(self, bindMode, localPort, ipVersion):
+			self.bindMode = bindMode
+			self.localPort = localPort
+			self.ipVersion = ipVersion
+
+			# Known once the server answered the bind request
+			self.bindedAddress = None
+			self.isCompressed = False
+
+			# Forwards the UDP sessions of this bind when the server demultiplexes them
+			self.demultiplexer = None
+
+	def __init__(self, communicationKey, localPort, bindMode, ipVersion, verbose = False, multiplex = False, poolSize = 0, poolRefillRate = POOL_REFILL_RATE, useSplice = False, engine = "threads", udpDemux = False, compress = None, compressLevel = compression.DEFAULT_LEVEL, extraBinds = None, resume = False):
 		self.client = True
 
 		self.localHost = "127.0.0.1"
 		self.localPort = localPort
 		self.bindMode = bindMode
 		self.ipVersion = ipVersion
+
+		# Every bind requested over the control connection, (bindMode, localPort, ipVersion) of the extra ones follow the first
+		self.binds = [self.Bind(bindMode, localPort, ipVersion)] + [self.Bind(*bind) for bind in extraBinds or []]
 		self.verbose = verbose
-		self.connections = []
-		self.connectionCounter = 0
+		self.connections = ConnectionRegistry()
+
+		# Carry TCP streams over the control connection instead of opening a data connection per visitor
+		self.multiplex = multiplex
+		self.streams = {}
+
+		# Pre-opened data connections (TCP only, not used when multiplexing)
+		self.poolSize = poolSize
+		self.poolRefillRate = poolRefillRate
+		self.connectionPool = None
+
+		# Forward every UDP session through a single socket to the server instead of one socket and thread each
+		self.udpDemux = udpDemux
+
+		# Compress the data connections of a TCP tunnel ("zlib" or "lzma"), only used once the server accepts it
+		self.compressionSettings = (compression.ALGORITHMS[compress], compressLevel) if compress != None else None
+		self.isCompressed = False
+
+		# "threads" forwards each connection on its own thread, "asyncio" forwards all of them on one event loop
+		self.engine = engine
+
+		# Ask the server to keep the binds when the control connection drops, and come back to them with a token
+		self.resume = resume
+		self.isResumable = False
+		self.resumeGrace = 0
+		self.resumeCount = 0
+		self.lastResumeTime = None
+
+		# Relay TCP connections with os.splice when the platform supports it
+		self.useSplice = useSplice and splice.isAvailable()
+		if useSplice and not self.useSplice and self.verbose:
+			print("[SYSTEM] Zero-copy relay isn't available on this platform, falling back to copying")
 
 		self.bindedAddress = None
 		self.isConnected = False
+		self.isMultiplexed = False
 
 		self.gui = None
 		self.host = None
@@ -257,16 +458,35 @@ class NetmaskClient(packets.ProtocolHandler):
 		self.socket.close()
 		sys.exit()
 
-	def forwardingThreadTCP(self, uid):
+	def openDataConnection(self):
+		if self.verbose:
+			print("[SYSTEM] Connecting to "+self.host+":"+str(self.port))
+
+		# Connect to server
+		if ipaddress.ip_network(self.host).version == 6:
+			conn = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+		else:
+			conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+		try:
+			conn.connect((self.host, self.port))
+		except:
+			if self.verbose:
+				print("[SYSTEM] Connection to "+self.host+":"+str(self.port)+" failed")
+			conn.close()
+			return None
+
+		return conn
+
+	def forwardingThreadTCP(self, uid, bind):
 		# Make connection class
 		connClass = self.Connection()
-		connClass.connectionID = self.connectionCounter
-		self.connectionCounter += 1
-		self.connections.append(connClass)
+		self.connections.add(connClass)
+		pipes = None
 
 		try:
 			if self.verbose:
-				print("[CLIENT] Connecting to "+self.localHost+":"+str(self.localPort))
+				print("[CLIENT] Connecting to "+self.localHost+":"+str(bind.localPort))
 
 			if ipaddress.ip_network(self.localHost).version == 6:
 				localConn = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
@@ -274,30 +494,25 @@ class NetmaskClient(packets.ProtocolHandler):
 				localConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 			try:
-				localConn.connect((self.localHost, self.localPort))
+				localConn.connect((self.localHost, bind.localPort))
 			except:
 				if self.verbose:
-					print("[SYSTEM] Connection to "+self.localHost+":"+str(self.localPort)+" failed")
+					print("[SYSTEM] Connection to "+self.localHost+":"+str(bind.localPort)+" failed")
 				return
 
-			if self.verbose:
-				print("[SYSTEM] Connecting to "+self.host+":"+str(self.port))
+			# Try to claim an already open data connection first
+			conn = self.connectionPool.acquire() if self.connectionPool != None else None
 
-			# Connect to server
-			if ipaddress.ip_network(self.host).version == 6:
-				conn = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+			if conn != None:
+				# The mode was already sent when the connection was opened
+				conn.sendall(uid)
 			else:
-				conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-			try:
-				conn.connect((self.host, self.port))
-			except:
-				if self.verbose:
-					print("[SYSTEM] Connection to "+self.host+":"+str(self.port)+" failed")
-				return
+				conn = self.openDataConnection()
+				if conn == None:
+					return
 
-			# Send the mode and the UID
-			conn.send(b"\x01"+uid)
+				# Send the mode and the UID
+				conn.send(b"\x01"+uid)
 
 			# Receive confirmation
 			if conn.recv(1) != b"\x01":
@@ -305,6 +520,15 @@ class NetmaskClient(packets.ProtocolHandler):
 					print("[CLIENT] Forwarding socket failed.")
 				return
 
+			# Compressed data can't be spliced, it has to go through the compressor
+			if bind.isCompressed:
+				self.forwardCompressed(localConn, conn, connClass)
+				return
+
+			# With splice, each direction moves data through its own pipe without copying it into Python
+			if self.useSplice:
+				pipes = {localConn: splice.createPipe(), conn: splice.createPipe()}
+
 			# Forward the connection between the two sockets
 			socketList = [localConn, conn]
 			shouldCloseSocket = False
@@ -315,21 +539,23 @@ class NetmaskClient(packets.ProtocolHandler):
 				for currentSocket in readSockets:
 					oppositeSocket = socketList[1] if currentSocket == socketList[0] else socketList[0]
 
-					data = currentSocket.recv(PACKET_BUFFER)
-					if not data or data == b"":
+					if pipes != None:
+						length = splice.spliceBlocking(currentSocket, oppositeSocket, pipes[currentSocket])
+					else:
+						data = currentSocket.recv(PACKET_BUFFER)
+						length = len(data)
+
+					if length == 0:
 						shouldCloseSocket = True
 						break
 
 					if currentSocket == localConn:
-						if self.gui != None:
-							self.downloadedBytesBuffer += len(data)
-						connClass.downloadedBytes += len(data)
+						connClass.downloadedBytes += length
 					else:
-						if self.gui != None:
-							self.uploadedBytesBuffer += len(data)
-						connClass.uploadedBytes += len(data)
+						connClass.uploadedBytes += length
 
-					oppositeSocket.sendall(data)
+					if pipes == None:
+						oppositeSocket.sendall(data)
 		except KeyboardInterrupt:
 			if self.gui != None:
 				while True:
@@ -340,14 +566,64 @@ class NetmaskClient(packets.ProtocolHandler):
 			else:
 				os._exit(0)
 		finally:
+			if pipes != None:
+				for pipe in pipes.values():
+					splice.closePipe(pipe)
+
 			self.connections.remove(connClass)
 
-	def forwardingThreadUDP(self, uid):
+	def forwardCompressed(self, localConn, conn, connClass):
+		algorithm, level = self.compressionSettings
+		connClass.compressionStats = compression.CompressionStats()
+		compressor = compression.StreamCompressor(algorithm, level, connClass.compressionStats)
+		decompressor = compression.StreamDecompressor(algorithm, connClass.compressionStats)
+
+		# Flushes already decide when to send, don't let Nagle hold the small flushed pieces back
+		conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+		socketList = [localConn, conn]
+		shouldCloseSocket = False
+		while not shouldCloseSocket:
+			readSockets, writeSockets, errorSockets = select.select(socketList, [], socketList, 5000)
+			if errorSockets or not readSockets:
+				break
+			for currentSocket in readSockets:
+				data = currentSocket.recv(PACKET_BUFFER)
+				if not data:
+					# The local service is done, what the compressor still holds has to reach the server first
+					# (its EOF made it readable, so the last chunk wasn't flushed)
+					if currentSocket == localConn:
+						output = compressor.compress(b"", True)
+						if output:
+							conn.sendall(output)
+
+					shouldCloseSocket = True
+					break
+
+				if currentSocket == localConn:
+					connClass.downloadedBytes += len(data)
+
+					# Flush once the local service has nothing more to read, so small exchanges aren't held back in the compressor
+					isIdle = not select.select([localConn], [], [], 0)[0]
+					output = compressor.compress(data, isIdle)
+					if output:
+						conn.sendall(output)
+				else:
+					for output in decompressor.decompressChunks(data, DECOMPRESS_CHUNK):
+						connClass.uploadedBytes += len(output)
+						localConn.sendall(output)
+
+		self.reportCompression(connClass)
+
+	def reportCompression(self, connClass):
+		if self.verbose:
+			stats = connClass.compressionStats
+			print("[CLIENT] Connection "+str(connClass.connectionID)+" compressed "+str(stats.rawBytes)+" B to "+str(stats.compressedBytes)+" B (ratio "+str(round(stats.ratio(), 3))+", "+str(round(stats.seconds * 1000, 1))+" ms)")
+
+	def forwardingThreadUDP(self, uid, bind):
 		# Make connection class
-		self.connectionCounter += 1
 		connClass = self.Connection()
-		connClass.connectionID = self.connectionCounter
-		self.connections.append(connClass)
+		self.connections.add(connClass)
 
 		try:
 			if ipaddress.ip_network(self.localHost).version == 6:
@@ -377,20 +653,16 @@ class NetmaskClient(packets.ProtocolHandler):
 
 			# Forward the connection between the two sockets
 			if self.verbose:
-				print("[CLIENT] Connecting to "+self.localHost+":"+str(self.localPort))
+				print("[CLIENT] Connecting to "+self.localHost+":"+str(bind.localPort))
 
 			while True:
 				data, address = conn.recvfrom(PACKET_BUFFER)
 
 				if address == (self.host, self.port):
-					conn.sendto(data, (self.localHost, self.localPort))
-					if self.gui != None:
-						self.downloadedBytesBuffer += len(data)
+					conn.sendto(data, (self.localHost, bind.localPort))
 					connClass.downloadedBytes += len(data)
-				elif address == (self.localHost, self.localPort):
+				elif address == (self.localHost, bind.localPort):
 					conn.sendto(data, (self.host, self.port))
-					if self.gui != None:
-						self.uploadedBytesBuffer += len(data)
 					connClass.uploadedBytes += len(data)
 		except KeyboardInterrupt:
 			if self.gui != None:
@@ -404,12 +676,238 @@ class NetmaskClient(packets.ProtocolHandler):
 		finally:
 			self.connections.remove(connClass)
 
-	def connect(self, host, port):
+	def streamWriterThread(self, stream, localConn, connClass):
+		# Writes the data received from the server to the local socket, then gives the window back
+		try:
+			while True:
+				data = stream.incoming.get()
+				if data == None:
+					break
+
+				localConn.sendall(data)
+
+				connClass.uploadedBytes += len(data)
+
+				windowPacket = packets.StreamWindowUpdate()
+				windowPacket.streamId = stream.streamId
+				windowPacket.increment = len(data)
+				self.sendPacket(windowPacket)
+		except OSError:
+			pass
+		finally:
+			# Unblock the reading side
+			try:
+				localConn.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+
+	def forwardingThreadStream(self, stream):
+		# Make connection class
+		connClass = self.Connection()
+		self.connections.add(connClass)
+
 		try:
+			if self.verbose:
+				print("[CLIENT] Connecting to "+self.localHost+":"+str(self.localPort))
+
+			if ipaddress.ip_network(self.localHost).version == 6:
+				localConn = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+			else:
+				localConn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+			try:
+				localConn.connect((self.localHost, self.localPort))
+			except:
+				if self.verbose:
+					print("[SYSTEM] Connection to "+self.localHost+":"+str(self.localPort)+" failed")
+
+				closePacket = packets.StreamClose()
+				closePacket.streamId = stream.streamId
+				self.sendPacket(closePacket)
+				return
+
+			threading.Thread(target=self.streamWriterThread, args=(stream, localConn, connClass)).start()
+
+			while True:
+				# Wait until the server allows us to send more data on this stream
+				with stream.windowCondition:
+					while stream.sendWindow <= 0 and not stream.closed:
+						stream.windowCondition.wait()
+					readSize = min(packets.STREAM_CHUNK, stream.sendWindow)
+
+				if stream.closed:
+					break
+
+				try:
+					data = localConn.recv(readSize)
+				except OSError:
+					data = b""
+
+				if not data:
+					if not stream.closed:
+						closePacket = packets.StreamClose()
+						closePacket.streamId = stream.streamId
+						self.sendPacket(closePacket)
+					stream.incoming.put(None)
+					break
+
+				with stream.windowCondition:
+					stream.sendWindow -= len(data)
+
+				connClass.downloadedBytes += len(data)
+
+				dataPacket = packets.StreamData()
+				dataPacket.streamId = stream.streamId
+				dataPacket.data = data
+				self.sendPacket(dataPacket)
+		except KeyboardInterrupt:
 			if self.gui != None:
-				self.downloadedBytesBuffer = 0
-				self.uploadedBytesBuffer = 0
+				while True:
+					try:
+						self.gui.quitProgram()
+					except:
+						pass
+			else:
+				os._exit(0)
+		finally:
+			self.streams.pop(stream.streamId, None)
+			self.connections.remove(connClass)
+
+	def multiplexLoop(self):
+		while True:
+			packet = self.recvPacket()
+
+			if isinstance(packet, packets.SStreamOpen):
+				# Register the stream before any of its data can arrive
+				stream = self.Stream(packet.streamId)
+				self.streams[packet.streamId] = stream
+				threading.Thread(target=self.forwardingThreadStream, args=(stream,)).start()
+				continue
+
+			if not isinstance(packet, (packets.StreamData, packets.StreamWindowUpdate, packets.StreamClose)):
+				self.terminateConnection()
+				return
+
+			stream = self.streams.get(packet.streamId, None)
+			if stream == None:
+				continue
+
+			if isinstance(packet, packets.StreamData):
+				stream.incoming.put(packet.data)
+			elif isinstance(packet, packets.StreamWindowUpdate):
+				with stream.windowCondition:
+					stream.sendWindow += packet.increment
+					stream.windowCondition.notify()
+			else:
+				with stream.windowCondition:
+					stream.closed = True
+					stream.windowCondition.notify()
+				stream.incoming.put(None)
+
+	def getBind(self, connectionPacket):
+		# Visitors of a client with a single bind aren't tagged
+		bindId = connectionPacket.bindId if connectionPacket.bindId != None else 0
+		return self.binds[bindId] if bindId < len(self.binds) else None
+
+	def sendBindRequest(self, bindIndex):
+		bind = self.binds[bindIndex]
+		isCompressible = self.compressionSettings != None and bind.bindMode == 0
+
+		# Every request but the last one tells the server that another one follows
+		BindRequest = packets.CBindRequest()
+		BindRequest.bindMode = bind.bindMode
+		BindRequest.ipVersion = bind.ipVersion
+		if self.multiplex or self.udpDemux or isCompressible or len(self.binds) > 1 or self.resume:
+			BindRequest.flags = (packets.BIND_FLAG_MULTIPLEX if self.multiplex else 0) | (packets.BIND_FLAG_UDP_DEMUX if self.udpDemux else 0) | (packets.BIND_FLAG_COMPRESS if isCompressible else 0) | (packets.BIND_FLAG_MORE if bindIndex + 1 < len(self.binds) else 0) | (packets.BIND_FLAG_RESUME if self.resume else 0)
+		if isCompressible:
+			BindRequest.compression = compression.packSettings(*self.compressionSettings)
+		self.sendPacket(BindRequest)
+
+	def recvBindResponse(self, bindIndex):
+		bind = self.binds[bindIndex]
+		BindResponse = self.recvPacket(packets.SBindResponse)
+		flags = BindResponse.flags if BindResponse.flags != None else 0
+
+		# An older server only answers the first request
+		if bindIndex + 1 < len(self.binds) and flags & packets.BIND_FLAG_MORE == 0:
+			raise Exception("The server doesn't support several binds on one connection")
+
+		self.isMultiplexed = flags & packets.BIND_FLAG_MULTIPLEX != 0
+		self.isResumable = flags & packets.BIND_FLAG_RESUME != 0
+		bind.isCompressed = flags & packets.BIND_FLAG_COMPRESS != 0
+		if self.compressionSettings != None and bind.bindMode == 0 and not bind.isCompressed and self.verbose:
+			print("[CLIENT] The server doesn't compress this tunnel, forwarding uncompressed")
+
+		if flags & packets.BIND_FLAG_UDP_DEMUX != 0:
+			bind.demultiplexer = UDPDemultiplexer(self, bind.localPort)
+
+		bind.bindedAddress = BindResponse.serverIP+":"+str(BindResponse.serverPort)
+
+		if self.verbose:
+			print("[CLIENT] Binded on "+bind.bindedAddress+(" for local port "+str(bind.localPort) if len(self.binds) > 1 else ""))
+		else:
+			print(bind.bindedAddress)
+
+	def resumeSession(self):
+		# The control connection dropped, come back to the same binds with the token while the server keeps them
+		lostTime = time.perf_counter()
+		self.isConnected = False
+		self.socket.close()
+
+		if self.verbose:
+			print("[CLIENT] Connection with server lost, resuming the session")
+
+		retryDelay = RESUME_RETRY
+		while time.perf_counter() - lostTime < self.resumeGrace:
+			conn = self.openDataConnection()
+			if conn != None:
+				# A new connection starts over from the communication key
+				conn.settimeout(0.5)
+				packets.disableNagle(conn)
+				super().__init__(self.communicationKey, conn)
+
+				try:
+					conn.sendall(b"\x02")
+
+					resumeRequest = packets.CResumeRequest()
+					resumeRequest.token = self.resumeToken
+					self.sendPacket(resumeRequest)
+
+					tokenPacket = self.recvPacket()
+				except (packets.ConnectionInterrupted, OSError):
+					conn.close()
+					tokenPacket = None
+
+				if tokenPacket != None:
+					# Anything but a new token means the server doesn't know the session anymore
+					if not isinstance(tokenPacket, packets.SSessionToken):
+						break
+
+					self.acceptToken(tokenPacket)
+					self.isConnected = True
+
+					self.resumeCount += 1
+					self.lastResumeTime = time.perf_counter() - lostTime
+					timers.record("resume", self.lastResumeTime)
+
+					if self.verbose:
+						print("[CLIENT] Session resumed in "+str(round(self.lastResumeTime * 1000, 1))+" ms")
+					return
+
+			time.sleep(retryDelay)
+			retryDelay = min(retryDelay * 2, RESUME_RETRY_MAX)
+
+		raise Exception("The session with the server was lost")
+
+	def acceptToken(self, tokenPacket):
+		self.resumeToken = tokenPacket.token
+		self.resumeGrace = tokenPacket.grace
 
+		# Notice a control connection that died silently, instead of waiting on it forever
+		packets.enableKeepalive(self.socket)
+
+	def connect(self, host, port):
+		try:
 			# Resolve the domain
 			try:
 				host = socket.gethostbyname(host)
@@ -432,6 +930,7 @@ class NetmaskClient(packets.ProtocolHandler):
 			conn.settimeout(0.5)
 
 			conn.connect((host, port))
+			packets.disableNagle(conn)
 
 			super().__init__(self.communicationKey, conn)
 			self.socket = conn
@@ -459,30 +958,59 @@ class NetmaskClient(packets.ProtocolHandler):
 			if self.verbose:
 				print("[CLIENT] Connection with server established successfully!")
 
-			BindRequest = packets.CBindRequest()
-			BindRequest.bindMode = self.bindMode
-			BindRequest.ipVersion = self.ipVersion
-			self.sendPacket(BindRequest)
-
-			BindResponse = self.recvPacket(packets.SBindResponse)
-
-			self.bindedAddress = BindResponse.serverIP+":"+str(BindResponse.serverPort)
+			# The first bind is answered before the others are requested, both directions then get their own
+			# rolling key and the other requests are sent at once, the server answers them in the same order
+			self.sendBindRequest(0)
+			self.recvBindResponse(0)
+
+			if len(self.binds) > 1:
+				self.splitEncryption()
+				for bindIndex in range(1, len(self.binds)):
+					self.sendBindRequest(bindIndex)
+				for bindIndex in range(1, len(self.binds)):
+					self.recvBindResponse(bindIndex)
+
+			# The token of a resumable session comes right after the binds
+			if self.isResumable:
+				self.acceptToken(self.recvPacket(packets.SSessionToken))
+			elif self.resume and self.verbose:
+				print("[CLIENT] The server doesn't keep the binds of this session, it can't be resumed")
+
+			self.isCompressed = any(bind.isCompressed for bind in self.binds)
+			self.bindedAddress = ", ".join(bind.bindedAddress for bind in self.binds)
 			self.isConnected = True
 
-			if self.verbose:
-				print("[CLIENT] Binded on "+self.bindedAddress)
+			for bind in self.binds:
+				if bind.demultiplexer != None:
+					bind.demultiplexer.start()
+
+			if self.isMultiplexed:
+				self.splitEncryption()
+				self.multiplexLoop()
+			elif self.engine == "asyncio":
+				AsyncForwardingEngine(self).run()
 			else:
-				print(self.bindedAddress)
+				if self.poolSize > 0 and any(bind.bindMode == 0 for bind in self.binds):
+					self.connectionPool = DataConnectionPool(self, self.poolSize, self.poolRefillRate)
+					threading.Thread(target=self.connectionPool.refillThread, daemon=True).start()
 
-			if BindRequest.bindMode == 0:
-				while True:
-					connectionPacket = self.recvPacket(packets.SConnection)
-					threading.Thread(target=self.forwardingThreadTCP, args=(connectionPacket.uid,)).start()
-			elif BindRequest.bindMode == 1:
 				while True:
-					connectionPacket = self.recvPacket(packets.SConnection)
-					threading.Thread(target=self.forwardingThreadUDP, args=(connectionPacket.uid,)).start()
-			
+					try:
+						connectionPacket = self.recvPacket(packets.SConnection)
+					except packets.ConnectionInterrupted:
+						self.resumeSession()
+						continue
+
+					bind = self.getBind(connectionPacket)
+					if bind == None:
+						self.terminateConnection()
+					elif bind.demultiplexer != None:
+						bind.demultiplexer.addSession(connectionPacket.uid)
+					elif bind.bindMode == 0:
+						threading.Thread(target=self.forwardingThreadTCP, args=(connectionPacket.uid, bind)).start()
+					else:
+						threading.Thread(target=self.forwardingThreadUDP, args=(connectionPacket.uid, bind)).start()
+
 		except Exception as e:
 			if self.gui != None:
 				while True:
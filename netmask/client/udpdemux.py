@@ -0,0 +1,180 @@
+import netmask.impl.packets as packets
+import selectors
+import ipaddress
+import threading
+import socket
+import queue
+import time
+
+# Variables
+PACKET_BUFFER = 65536
+RECV_BATCH = 64
+UDP_IDLE_TIMEOUT = 60
+UDP_REGISTER_RETRIES = 5
+
+class UDPDemultiplexer:
+	# Forwards every UDP session of one of a NetmaskClient's binds on one thread, through a single socket to the server
+
+	class Session:
+		def __init__(self, tag, uid, localSocket, connClass):
+			self.tag = tag
+			self.uid = uid
+			self.localSocket = localSocket
+			self.connClass = connClass
+			self.isForwarding = False
+			self.registerAttempts = 0
+			self.lastActive = time.monotonic()
+
+	def __init__(self, client, localPort):
+		self.client = client
+		self.serverAddress = (client.host, client.port)
+		self.localAddress = (client.localHost, localPort)
+
+		if ipaddress.ip_network(client.host).version == 6:
+			self.serverSocket = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+		else:
+			self.serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.serverSocket.setblocking(False)
+
+		self.localFamily = socket.AF_INET6 if ipaddress.ip_network(client.localHost).version == 6 else socket.AF_INET
+
+		# Session tag -> Session
+		self.sessions = {}
+		self.tagCounter = 0
+
+		# New UIDs are handed over from the control thread, the socket pair wakes up the selector
+		self.newSessions = queue.Queue()
+		self.wakeupReader, self.wakeupWriter = socket.socketpair()
+		self.wakeupReader.setblocking(False)
+
+		self.selector = selectors.DefaultSelector()
+		self.selector.register(self.serverSocket, selectors.EVENT_READ, None)
+		self.selector.register(self.wakeupReader, selectors.EVENT_READ, None)
+
+	def addSession(self, uid):
+		# Called from the control thread for every SConnection
+		self.newSessions.put(uid)
+		try:
+			self.wakeupWriter.send(b"\x00")
+		except BlockingIOError:
+			pass
+
+	def sendRegistration(self, session):
+		session.registerAttempts += 1
+		self.serverSocket.sendto(bytes([packets.UDP_DEMUX_REGISTER]) + session.tag + session.uid, self.serverAddress)
+
+	def openSessions(self):
+		while True:
+			try:
+				uid = self.newSessions.get_nowait()
+			except queue.Empty:
+				return
+
+			tag = self.tagCounter.to_bytes(4, byteorder='big')
+			self.tagCounter = (self.tagCounter + 1) % 2**32
+
+			# Each session needs its own local socket, so the local service can tell the peers apart
+			localSocket = socket.socket(self.localFamily, socket.SOCK_DGRAM)
+			localSocket.setblocking(False)
+			localSocket.connect(self.localAddress)
+
+			connClass = self.client.Connection()
+			self.client.connections.add(connClass)
+
+			session = self.Session(tag, uid, localSocket, connClass)
+			self.sessions[tag] = session
+			self.selector.register(localSocket, selectors.EVENT_READ, session)
+			self.sendRegistration(session)
+
+	def closeSession(self, session):
+		self.sessions.pop(session.tag, None)
+		self.selector.unregister(session.localSocket)
+		session.localSocket.close()
+
+		self.client.connections.remove(session.connClass)
+
+	def receiveFromServer(self):
+		# Drain as many datagrams as are available in one wakeup
+		for _ in range(RECV_BATCH):
+			try:
+				data, address = self.serverSocket.recvfrom(PACKET_BUFFER)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				continue
+
+			if address[:2] != self.serverAddress or len(data) < 5:
+				continue
+
+			session = self.sessions.get(data[1:5], None)
+			if session == None:
+				continue
+
+			if data[0] == packets.UDP_DEMUX_DATA:
+				try:
+					session.localSocket.send(data[5:])
+				except OSError:
+					continue
+
+				session.lastActive = time.monotonic()
+				session.connClass.downloadedBytes += len(data) - 5
+			elif data[0] == packets.UDP_DEMUX_ACK:
+				session.isForwarding = True
+				session.lastActive = time.monotonic()
+			elif data[0] == packets.UDP_DEMUX_REJECT:
+				if self.client.verbose:
+					print("[CLIENT] Forwarding socket failed.")
+				self.closeSession(session)
+
+	def receiveFromLocal(self, session):
+		for _ in range(RECV_BATCH):
+			try:
+				data = session.localSocket.recv(PACKET_BUFFER)
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError:
+				# Nothing is listening locally (ICMP port unreachable), keep the session until it expires
+				return
+
+			# Datagrams from the local service are dropped until the server acknowledged the session
+			if not session.isForwarding:
+				continue
+
+			self.serverSocket.sendto(bytes([packets.UDP_DEMUX_DATA]) + session.tag + data, self.serverAddress)
+
+			session.lastActive = time.monotonic()
+			session.connClass.uploadedBytes += len(data)
+
+	def expireSessions(self):
+		currentTime = time.monotonic()
+		for session in list(self.sessions.values()):
+			if session.isForwarding:
+				if session.lastActive + UDP_IDLE_TIMEOUT <= currentTime:
+					self.closeSession(session)
+			elif session.registerAttempts >= UDP_REGISTER_RETRIES:
+				self.closeSession(session)
+			else:
+				# The registration datagram or its acknowledgement may have been lost
+				self.sendRegistration(session)
+
+	def run(self):
+		lastExpiry = time.monotonic()
+		while True:
+			for key, _events in self.selector.select(1):
+				if key.fileobj is self.wakeupReader:
+					try:
+						self.wakeupReader.recv(4096)
+					except BlockingIOError:
+						pass
+					self.openSessions()
+				elif key.fileobj is self.serverSocket:
+					self.receiveFromServer()
+				else:
+					self.receiveFromLocal(key.data)
+
+			if lastExpiry + 1 <= time.monotonic():
+				self.expireSessions()
+				lastExpiry = time.monotonic()
+
+	def start(self):
+		threading.Thread(target=self.run, daemon=True).start()
@@ -1,13 +1,109 @@
 from netmask.utils.encryption import NetmaskEncryption
+from netmask.utils.profiling import timers
+import threading
 import hashlib
+import secrets
+import struct
+import asyncio
 import socket
+import time
 import sys
 import os
 
+# Variables
+STREAM_WINDOW = 262144
+STREAM_CHUNK = 16384
+
+# Packets sent on an event loop are coalesced into a single write, flushed once the loop gets back to them
+# (or PACKET_FLUSH_DELAY seconds later when above 0) or as soon as PACKET_FLUSH_SIZE bytes are queued
+PACKET_FLUSH_DELAY = 0
+PACKET_FLUSH_SIZE = 65536
+
+# recvPacket reads as much as the socket has into a buffer of this size, the packets past the first one are
+# parsed from it by the next calls without another read (it grows to fit a packet if ever needed)
+RECV_BUFFER = 65536
+
+# Precompiled wire formats, everything is big endian
+HEADER = struct.Struct(">BH")
+STREAM_ID = struct.Struct(">I")
+WINDOW_UPDATE = struct.Struct(">II")
+BIND_REQUEST = struct.Struct(">BB")
+BIND_REQUEST_FLAGS = struct.Struct(">BBB")
+BIND_REQUEST_COMPRESSION = struct.Struct(">BBBB")
+PORT = struct.Struct(">H")
+GRACE = struct.Struct(">H")
+FLAGS = struct.Struct(">B")
+BIND_ID = struct.Struct(">B")
+BIND_MODES = (0, 1)
+IP_VERSIONS = (4, 6)
+
+# CBindRequest/SBindResponse flags
+BIND_FLAG_MULTIPLEX = 0x01
+BIND_FLAG_UDP_DEMUX = 0x02
+BIND_FLAG_COMPRESS = 0x04
+
+# Another bind request follows on the same control connection, SConnection packets then carry the bind ID
+BIND_FLAG_MORE = 0x08
+
+# Binds a client can request over one control connection, their IDs are a single byte
+SESSION_MAX_BINDS = 64
+
+# The client can come back to its binds with a token if the control connection drops
+BIND_FLAG_RESUME = 0x10
+
+# Resumable control connections are probed while idle, so one that silently died is noticed in about
+# KEEPALIVE_IDLE + KEEPALIVE_INTERVAL * KEEPALIVE_COUNT seconds
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Demultiplexed UDP datagrams between client and server: 1 byte type, 4 bytes session tag, then the payload
+UDP_DEMUX_DATA = 0
+UDP_DEMUX_ACK = 1
+UDP_DEMUX_REGISTER = 2
+UDP_DEMUX_REJECT = 3
+
+# A UID sent alone on the main UDP port is told apart from the datagrams above by its first byte, which never
+# is one of their types
+UID_FIRST_BYTE = UDP_DEMUX_REJECT + 1
+
+class ConnectionInterrupted(Exception):
+	# Raised instead of closing the program when a resumable connection fails, whoever reads it resumes the session
+	pass
+
+def newUID(length = 32):
+	return bytes([UID_FIRST_BYTE + secrets.randbelow(256 - UID_FIRST_BYTE)]) + os.urandom(length - 1)
+
+def disableNagle(sock):
+	# Control packets are already coalesced by sendPacket and sendPacketAsync, Nagle would only hold the small
+	# ones back until the peer's delayed ACK
+	sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def enableKeepalive(sock):
+	sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+	# Not every platform lets the timings be changed
+	for option, value in [("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT)]:
+		if hasattr(socket, option):
+			sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
 class ProtocolHandler():
 	client = None
 	verbose = None
 
+	# Set once the session can be resumed, connection failures then raise ConnectionInterrupted
+	resumeToken = None
+
+	# asyncio streams of the connection, only set when packets are handled on an event loop
+	reader = None
+	writer = None
+	drainLock = None
+
+	# Encrypted packets waiting for the next flush, everything sent on the loop goes through them to keep the order
+	pendingPackets = None
+	pendingSize = 0
+	flushHandle = None
+
 	def __init__(self, communicationKey, socket):
 		self.communicationKey = communicationKey
 		self.socket = socket
@@ -17,15 +113,64 @@ class ProtocolHandler():
 
 		self.encryption = NetmaskEncryption(self.communicationKey.encode())
 
-	def recv(self, length):
-		while True:
+		# Both directions share the same rolling key until splitEncryption is called
+		self.sendEncryption = self.encryption
+		self.recvEncryption = self.encryption
+
+		# Packets can be sent from multiple threads once streams are multiplexed, the first thread to get
+		# the send lock writes everything queued by then in one call
+		self.sendLock = threading.Lock()
+		self.queueLock = threading.Lock()
+		self.sendQueue = []
+
+		# Received bytes that weren't parsed yet are between recvStart and recvEnd, the buffer is only allocated by
+		# the first read (handlers that only read through asyncio streams never need it)
+		self.recvBuffer = bytearray()
+		self.recvView = memoryview(self.recvBuffer)
+		self.recvStart = 0
+		self.recvEnd = 0
+
+	def encryptions(self):
+		# Every rolling key of the connection, the shared one is kept after splitEncryption
+		return list({id(encryption): encryption for encryption in [self.encryption, self.sendEncryption, self.recvEncryption]}.values())
+
+	def splitEncryption(self):
+		# Derive an independent rolling key per direction, so both sides can send at the same time
+		baseKey = self.encryption.rollingKey
+		clientToServer = NetmaskEncryption(baseKey + b"\x00")
+		serverToClient = NetmaskEncryption(baseKey + b"\x01")
+
+		if self.client:
+			self.sendEncryption, self.recvEncryption = clientToServer, serverToClient
+		else:
+			self.sendEncryption, self.recvEncryption = serverToClient, clientToServer
+
+	def fillBuffer(self, length):
+		# Read until at least length bytes are buffered, each read takes everything the socket has that fits
+		while self.recvEnd - self.recvStart < length:
+			if self.recvStart + length > len(self.recvBuffer):
+				# Move the partial packet to the front, in a larger buffer if it doesn't fit otherwise
+				pending = bytes(self.recvView[self.recvStart:self.recvEnd])
+				if length > len(self.recvBuffer):
+					self.recvBuffer = bytearray(max(length, RECV_BUFFER))
+					self.recvView = memoryview(self.recvBuffer)
+				self.recvBuffer[:len(pending)] = pending
+				self.recvStart = 0
+				self.recvEnd = len(pending)
+
 			try:
-				rawData = self.socket.recv(length)
-				if rawData != b"":
-					break
+				received = self.socket.recv_into(self.recvView[self.recvEnd:])
+				if received == 0:
+					raise ConnectionResetError()
+				self.recvEnd += received
 			except TimeoutError:
+				# The connection is idle, use the time to refill the rolling key cache
+				self.recvEncryption.refill()
+				self.sendEncryption.refill()
 				continue
 			except:
+				self.connectionFailed()
+
 				if self.verbose:
 					__import__("traceback").print_exc()
 					print("[HANDLER] Socket got closed unexpectedly, closing connection.")
@@ -35,42 +180,87 @@ class ProtocolHandler():
 
 				sys.exit()
 
-		return self.encryption.encryptDecrypt(rawData)
+	def recv(self, length):
+		# Decrypts straight from the buffer, the bytes are only copied once they are decrypted
+		self.fillBuffer(length)
+		data = self.recvView[self.recvStart:self.recvStart + length]
+		self.recvStart += length
+		if self.recvStart == self.recvEnd:
+			self.recvStart = self.recvEnd = 0
+
+		return self.recvEncryption.encryptDecrypt(data)
+
+	def takeBuffered(self):
+		# Bytes already read past the last packet, for whoever reads the socket from now on
+		pending = bytes(self.recvView[self.recvStart:self.recvEnd])
+		self.recvStart = self.recvEnd = 0
+		return pending
 
 	def recvPacket(self, expectedPacket = None):
 		try:
-			self.encryption.rollKey()
+			self.recvEncryption.rollKey()
 			rawData = self.recv(3)
 
+			# Only time the packet from its header on, not the wait for it
+			startTime = time.perf_counter()
+
 			# Parse packet data
-			packetId = rawData[0]
-			packetLength = int.from_bytes(rawData[1:3], byteorder='big')
+			packetId, packetLength = HEADER.unpack(rawData)
+			packetData = b""
 			if packetLength != 0:
 				packetData = self.recv(packetLength)
-			packet = packetList.get(packetId, None)
 
-			# If packet ID doesn't exist, terminate connection
-			if packet == None:
+			# If the packet is unknown, unexpected or invalid, terminate connection
+			packetInstance = self.decodePacket(packetId, packetLength, packetData, expectedPacket)
+			if packetInstance == None:
 				self.terminateConnection()
 				return
 
-			# If packet isn't the expected packet, terminate connection
-			if expectedPacket != None and packet != expectedPacket:
-				self.terminateConnection()
-				return
+			timers.record("recvPacket", time.perf_counter() - startTime)
+			return packetInstance
+		except SystemExit:
+			sys.exit()
+		except:
+			self.connectionFailed()
+
+			if self.verbose:
+				__import__("traceback").print_exc()
+				print("[FATAL] Couldn't recieve packet, is the communication key correct?")
+
+			if self.client and self.gui != None:
+				self.gui.quitProgram()
+
+			self.terminateConnection()
+			return
 
-			# Create the packet instance
-			packetInstance = packet()
+	async def recvPacketAsync(self, expectedPacket = None):
+		try:
+			self.recvEncryption.rollKey()
+			rawData = self.recvEncryption.encryptDecrypt(await self.reader.readexactly(3))
+			startTime = time.perf_counter()
+
+			# Parse packet data
+			packetId, packetLength = HEADER.unpack(rawData)
+			packetData = b""
+			if packetLength != 0:
+				packetData = self.recvEncryption.encryptDecrypt(await self.reader.readexactly(packetLength))
 
-			# If the packet data is invalid, terminate connection
-			if packetLength != 0 and not packetInstance.unpackBuffer(packetData):
+			# If the packet is unknown, unexpected or invalid, terminate connection
+			packetInstance = self.decodePacket(packetId, packetLength, packetData, expectedPacket)
+			if packetInstance == None:
 				self.terminateConnection()
 				return
 
+			# Refill the rolling key cache once the connection is idle
+			self.recvEncryption.scheduleRefill(asyncio.get_event_loop())
+
+			timers.record("recvPacket", time.perf_counter() - startTime)
 			return packetInstance
 		except SystemExit:
 			sys.exit()
 		except:
+			self.connectionFailed()
+
 			if self.verbose:
 				__import__("traceback").print_exc()
 				print("[FATAL] Couldn't recieve packet, is the communication key correct?")
@@ -81,10 +271,31 @@ class ProtocolHandler():
 			self.terminateConnection()
 			return
 
+	def decodePacket(self, packetId, packetLength, packetData, expectedPacket):
+		packet = packetList.get(packetId, None)
+
+		# If packet ID doesn't exist or isn't the expected packet, it's invalid
+		if packet == None or (expectedPacket != None and packet != expectedPacket):
+			return None
+
+		# Create the packet instance
+		packetInstance = packet()
+
+		if packetLength != 0 and not packetInstance.unpackBuffer(packetData):
+			return None
+
+		return packetInstance
+
 	def send(self, data):
+		return self.sendEncrypted(self.sendEncryption.encryptDecrypt(data))
+
+	def sendEncrypted(self, data):
 		try:
-			return self.socket.send(self.encryption.encryptDecrypt(data))
+			self.socket.sendall(data)
+			return len(data)
 		except:
+			self.connectionFailed()
+
 			if self.verbose:
 				__import__("traceback").print_exc()
 				print("[HANDLER] Socket got closed unexpectedly, closing connection.")
@@ -94,18 +305,33 @@ class ProtocolHandler():
 
 			sys.exit()
 
+	def encodePacket(self, packet):
+		# Roll the key and encrypt the whole packet, the caller keeps packets in the order they were encoded
+		self.sendEncryption.rollKey()
+		return self.sendEncryption.encryptPacket(packet.packMetadata(), packet.packBuffer())
+
 	def sendPacket(self, packet):
 		try:
-			self.encryption.rollKey()
+			startTime = time.perf_counter()
+			with self.queueLock:
+				self.sendQueue.append(self.encodePacket(packet))
+
+			with self.sendLock:
+				with self.queueLock:
+					queuedPackets = self.sendQueue
+					self.sendQueue = []
+
+				# Another thread may have sent this packet along with its own already
+				if queuedPackets:
+					self.sendEncrypted(b"".join(queuedPackets))
 
-			bytesSent = self.send(packet.packMetadata())
-			buffer = packet.packBuffer()
-			if buffer != b"":
-				bytesSent += self.send(buffer)
+			timers.record("sendPacket", time.perf_counter() - startTime)
 			return
 		except SystemExit:
 			sys.exit()
 		except:
+			self.connectionFailed()
+
 			if self.verbose:
 				__import__("traceback").print_exc()
 				print("[FATAL] Couldn't send packet, is the communication key correct?")
@@ -116,24 +342,75 @@ class ProtocolHandler():
 			self.terminateConnection()
 			return
 
+	async def sendPacketAsync(self, packet):
+		# Encrypt and queue the whole packet before yielding, so other coroutines can't interleave with it
+		startTime = time.perf_counter()
+		encodedPacket = self.encodePacket(packet)
+		timers.record("sendPacket", time.perf_counter() - startTime)
+
+		if self.pendingPackets == None:
+			self.pendingPackets = []
+		self.pendingPackets.append(encodedPacket)
+		self.pendingSize += len(encodedPacket)
+
+		if self.pendingSize >= PACKET_FLUSH_SIZE:
+			self.flushPackets()
+		elif self.flushHandle == None:
+			if PACKET_FLUSH_DELAY > 0:
+				self.flushHandle = asyncio.get_event_loop().call_later(PACKET_FLUSH_DELAY, self.flushPackets)
+			else:
+				self.flushHandle = asyncio.get_event_loop().call_soon(self.flushPackets)
+
+		# Concurrent drain() calls aren't supported on older Python versions
+		if self.drainLock == None:
+			self.drainLock = asyncio.Lock()
+
+		async with self.drainLock:
+			await self.writer.drain()
+
+	def flushPackets(self):
+		# Hand everything queued on the loop to the transport in one write
+		if self.flushHandle != None:
+			self.flushHandle.cancel()
+			self.flushHandle = None
+
+		if self.pendingPackets == None:
+			return
+
+		pendingPackets = self.pendingPackets
+		self.pendingPackets = None
+		self.pendingSize = 0
+		self.writer.writelines(pendingPackets)
+
+	def connectionFailed(self):
+		# Called first whenever the connection fails, a resumable one is left to whoever resumes it
+		if self.resumeToken != None:
+			raise ConnectionInterrupted()
+
 	def terminateConnection(self):
 		# To be overwritten
 		pass
 
 class Packet():
+	# Fields live in __slots__ (set in each packet's __init__), the constants below stay on the class
+	__slots__ = ()
 	packetId = 0
 	packetLength = 0
+
 	def packMetadata(self):
-		return self.packetId.to_bytes(1, byteorder='big') + self.packetLength.to_bytes(2, byteorder='big')
+		return HEADER.pack(self.packetId, self.packetLength)
 	def unpackBuffer(self, buffer):
 		return b""
 	def packBuffer(self):
 		return b""
 
 class CHandshakeRequest(Packet):
+	__slots__ = ("encryptionKey",)
 	packetId = 1
 	packetLength = 32
-	encryptionKey = None
+
+	def __init__(self):
+		self.encryptionKey = None
 
 	def unpackBuffer(self, buffer):
 		if len(buffer) != self.packetLength:
@@ -147,9 +424,12 @@ class CHandshakeRequest(Packet):
 		return self.encryptionKey
 
 class SPOERequest(Packet):
+	__slots__ = ("proofOfEncryptionRequest",)
 	packetId = 2
 	packetLength = 32
-	proofOfEncryptionRequest = None
+
+	def __init__(self):
+		self.proofOfEncryptionRequest = None
 
 	def unpackBuffer(self, buffer):
 		if len(buffer) != self.packetLength:
@@ -163,9 +443,12 @@ class SPOERequest(Packet):
 		return self.proofOfEncryptionRequest
 
 class CPOEResponse(Packet):
+	__slots__ = ("proofOfEncryptionResult",)
 	packetId = 3
 	packetLength = 32
-	proofOfEncryptionResult = None
+
+	def __init__(self):
+		self.proofOfEncryptionResult = None
 
 	def unpackBuffer(self, buffer):
 		if len(buffer) != self.packetLength:
@@ -179,98 +462,140 @@ class CPOEResponse(Packet):
 		return self.proofOfEncryptionResult
 
 class SHandshakeResponse(Packet):
+	__slots__ = ()
 	packetId = 4
 	packetLength = 0
 
 class CBindRequest(Packet):
+	__slots__ = ("bindMode", "ipVersion", "flags", "compression")
 	packetId = 5
 	packetLength = 2
-	
-	# 1 byte: 0 for TCP, 1 for UDP
-	bindMode = None
 
-	# 1 byte: 4 for IPv4, 6 for IPv6
-	ipVersion = None
+	def __init__(self):
+		# 1 byte: 0 for TCP, 1 for UDP
+		self.bindMode = None
+
+		# 1 byte: 4 for IPv4, 6 for IPv6
+		self.ipVersion = None
+
+		# 1 byte (optional): BIND_FLAG_* bitfield, only sent when not None
+		self.flags = None
+
+		# 1 byte (optional): compression settings (see netmask.utils.compression), only sent with BIND_FLAG_COMPRESS set
+		self.compression = None
+
+	def packMetadata(self):
+		optionalLength = 0 if self.flags == None else (2 if self.flags & BIND_FLAG_COMPRESS else 1)
+		return HEADER.pack(self.packetId, self.packetLength + optionalLength)
 
 	def unpackBuffer(self, buffer):
-		if len(buffer) != self.packetLength:
+		bufferLength = len(buffer)
+		if bufferLength == self.packetLength:
+			self.bindMode, self.ipVersion = BIND_REQUEST.unpack(buffer)
+		elif bufferLength == self.packetLength + 1 and not buffer[2] & BIND_FLAG_COMPRESS:
+			self.bindMode, self.ipVersion, self.flags = BIND_REQUEST_FLAGS.unpack(buffer)
+		elif bufferLength == self.packetLength + 2 and buffer[2] & BIND_FLAG_COMPRESS:
+			self.bindMode, self.ipVersion, self.flags, self.compression = BIND_REQUEST_COMPRESSION.unpack(buffer)
+		else:
 			return False
-		self.bindMode = buffer[0]
-		self.ipVersion = buffer[1]
 
 		# If bindmode isn't TCP or UDP, packet is invalid
-		if self.bindMode not in [0,1]:
+		if self.bindMode not in BIND_MODES:
 			return False
 
 		# If IP version isn't 4 or 6, packet is invalid
-		if self.ipVersion not in [4,6]:
+		if self.ipVersion not in IP_VERSIONS:
 			return False
 		return True
 
 	def packBuffer(self):
-		if self.bindMode not in [0,1]:
+		if self.bindMode not in BIND_MODES:
 			return False
 
-		if self.ipVersion not in [4,6]:
+		if self.ipVersion not in IP_VERSIONS:
 			return False
 
-		return self.bindMode.to_bytes(1, byteorder='big') + self.ipVersion.to_bytes(1, byteorder='big')
+		if self.flags == None:
+			return BIND_REQUEST.pack(self.bindMode, self.ipVersion)
+		elif self.flags & BIND_FLAG_COMPRESS:
+			return BIND_REQUEST_COMPRESSION.pack(self.bindMode, self.ipVersion, self.flags, self.compression)
+		return BIND_REQUEST_FLAGS.pack(self.bindMode, self.ipVersion, self.flags)
 
 
 class SBindResponse(Packet):
+	__slots__ = ("serverIP", "serverPort", "ipVersion", "flags")
 	packetId = 6
 	packetLength = 0
 
-	# 4 bytes if IPv4 and 16 bytes if IPv6
-	serverIP = None
+	def __init__(self):
+		# 4 bytes if IPv4 and 16 bytes if IPv6
+		self.serverIP = None
 
-	# 2 bytes
-	serverPort = None
+		# 2 bytes
+		self.serverPort = None
 
-	# 4 for IPv4, 6 for IPv6, doesn't get sent
-	ipVersion = 0
+		# 4 for IPv4, 6 for IPv6, doesn't get sent
+		self.ipVersion = 0
+
+		# 1 byte (optional): accepted BIND_FLAG_* bitfield, only sent in response to a request with flags
+		self.flags = None
 
 	def packMetadata(self):
 		if self.serverIP == None:
-			return self.packetId.to_bytes(1, byteorder='big') + self.packetLength.to_bytes(2, byteorder='big')
+			return HEADER.pack(self.packetId, self.packetLength)
 
-		return self.packetId.to_bytes(1, byteorder='big') + ((4 if self.ipVersion == 4 else 16) + 2).to_bytes(2, byteorder='big')
+		return HEADER.pack(self.packetId, (4 if self.ipVersion == 4 else 16) + 2 + (0 if self.flags == None else 1))
 
 	def unpackBuffer(self, buffer):
-		if len(buffer) == 6:
-			ipVersion = 4
-			self.serverIP = socket.inet_ntop(socket.AF_INET, buffer[2:])
-		elif len(buffer) == 18:
-			ipVersion = 6
-			self.serverIP = socket.inet_ntop(socket.AF_INET6, buffer[2:])
+		bufferLength = len(buffer)
+		if bufferLength in (7, 19):
+			self.flags = buffer[-1]
+			bufferLength -= 1
+
+		if bufferLength == 6:
+			self.serverIP = socket.inet_ntop(socket.AF_INET, buffer[2:6])
+		elif bufferLength == 18:
+			self.serverIP = socket.inet_ntop(socket.AF_INET6, buffer[2:18])
 		else:
 			return False
 
-		self.serverPort = int.from_bytes(buffer[:2], byteorder='big')
+		self.serverPort, = PORT.unpack_from(buffer)
 
 		return True
 
 	def packBuffer(self):
-		buffer = self.serverPort.to_bytes(2, byteorder='big')
-
 		if self.ipVersion == 4:
-			buffer += socket.inet_pton(socket.AF_INET, self.serverIP)
+			address = socket.inet_pton(socket.AF_INET, self.serverIP)
 		elif self.ipVersion == 6:
-			buffer += socket.inet_pton(socket.AF_INET6, self.serverIP)
+			address = socket.inet_pton(socket.AF_INET6, self.serverIP)
 		else:
 			return False
 
-		return buffer
+		if self.flags != None:
+			return PORT.pack(self.serverPort) + address + FLAGS.pack(self.flags)
+		return PORT.pack(self.serverPort) + address
 
 class SConnection(Packet):
+	__slots__ = ("uid", "bindId")
 	packetId = 7
 	packetLength = 32
 
-	# 32 bytes
-	uid = None
+	def __init__(self):
+		# 32 bytes
+		self.uid = None
+
+		# 1 byte (optional): the bind the visitor arrived on, in the order they were requested, only sent when the client requested several
+		self.bindId = None
+
+	def packMetadata(self):
+		return HEADER.pack(self.packetId, self.packetLength + (0 if self.bindId == None else 1))
 
 	def unpackBuffer(self, buffer):
-		if len(buffer) != self.packetLength:
+		bufferLength = len(buffer)
+		if bufferLength == self.packetLength + 1:
+			self.bindId = buffer[-1]
+			buffer = buffer[:-1]
+		elif bufferLength != self.packetLength:
 			return False
 		self.uid = buffer
 		return True
@@ -278,9 +603,139 @@ class SConnection(Packet):
 	def packBuffer(self):
 		if len(self.uid) != self.packetLength:
 			return False
+
+		if self.bindId != None:
+			return self.uid + BIND_ID.pack(self.bindId)
 		return self.uid
 
+class SStreamOpen(Packet):
+	__slots__ = ("streamId",)
+	packetId = 8
+	packetLength = 4
+
+	def __init__(self):
+		# 4 bytes
+		self.streamId = None
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) != self.packetLength:
+			return False
+		self.streamId, = STREAM_ID.unpack(buffer)
+		return True
+
+	def packBuffer(self):
+		return STREAM_ID.pack(self.streamId)
+
+class StreamData(Packet):
+	__slots__ = ("streamId", "data")
+	packetId = 9
+	packetLength = 4
+
+	def __init__(self):
+		# 4 bytes
+		self.streamId = None
+
+		# Up to STREAM_CHUNK bytes, a memoryview of the received packet once unpacked
+		self.data = None
+
+	def packMetadata(self):
+		return HEADER.pack(self.packetId, self.packetLength + len(self.data))
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) <= self.packetLength:
+			return False
+		self.streamId, = STREAM_ID.unpack_from(buffer)
+		self.data = memoryview(buffer)[4:]
+		return True
+
+	def packBuffer(self):
+		return STREAM_ID.pack(self.streamId) + self.data
+
+class StreamWindowUpdate(Packet):
+	__slots__ = ("streamId", "increment")
+	packetId = 10
+	packetLength = 8
+
+	def __init__(self):
+		# 4 bytes
+		self.streamId = None
+
+		# 4 bytes: how many more bytes the peer is allowed to send on this stream
+		self.increment = None
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) != self.packetLength:
+			return False
+		self.streamId, self.increment = WINDOW_UPDATE.unpack(buffer)
+		return True
+
+	def packBuffer(self):
+		return WINDOW_UPDATE.pack(self.streamId, self.increment)
+
+class StreamClose(Packet):
+	__slots__ = ("streamId",)
+	packetId = 11
+	packetLength = 4
+
+	def __init__(self):
+		# 4 bytes
+		self.streamId = None
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) != self.packetLength:
+			return False
+		self.streamId, = STREAM_ID.unpack(buffer)
+		return True
+
+	def packBuffer(self):
+		return STREAM_ID.pack(self.streamId)
+
+class CResumeRequest(Packet):
+	__slots__ = ("token",)
+	packetId = 12
+	packetLength = 32
+
+	def __init__(self):
+		# 32 bytes: the last token the server gave
+		self.token = None
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) != self.packetLength:
+			return False
+		self.token = buffer
+		return True
+
+	def packBuffer(self):
+		if len(self.token) != self.packetLength:
+			return False
+		return self.token
+
+class SSessionToken(Packet):
+	__slots__ = ("token", "grace")
+	packetId = 13
+	packetLength = 34
+
+	def __init__(self):
+		# 32 bytes: only valid once, a new one is given with every resumption
+		self.token = None
+
+		# 2 bytes: seconds the server keeps the binds after the control connection dropped
+		self.grace = None
+
+	def unpackBuffer(self, buffer):
+		if len(buffer) != self.packetLength:
+			return False
+		self.token = buffer[:32]
+		self.grace, = GRACE.unpack_from(buffer, 32)
+		return True
+
+	def packBuffer(self):
+		if len(self.token) != 32:
+			return False
+		return self.token + GRACE.pack(self.grace)
+
 class SKick(Packet):
+	__slots__ = ()
 	packetId = 255
 	packetLength = 0
 
@@ -294,5 +749,11 @@ packetList = {
 	5: CBindRequest,
 	6: SBindResponse,
 	7: SConnection,
+	8: SStreamOpen,
+	9: StreamData,
+	10: StreamWindowUpdate,
+	11: StreamClose,
+	12: CResumeRequest,
+	13: SSessionToken,
 	255: SKick
 }
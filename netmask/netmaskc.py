@@ -1,8 +1,28 @@
 from netmask.client.main import NetmaskClient, NetmaskClientGUI
+from netmask.utils.profiling import timers, Profiler
+import netmask.impl.packets as packets
 import threading
 import argparse
+import signal
 import os
 
+def parseBind(text):
+	# PROTOCOL:PORT:IPVERSION, like the positional arguments (example: udp:53:6)
+	try:
+		bindMode, port, ipVersion = text.strip().split(":")
+		bind = ({"tcp": 0, "udp": 1}[bindMode.lower()], int(port), int(ipVersion))
+	except (ValueError, KeyError):
+		raise argparse.ArgumentTypeError("invalid bind \""+text.strip()+"\", expected PROTOCOL:PORT:IPVERSION (example: tcp:443:4)")
+
+	if not 0 < bind[1] < 65536 or bind[2] not in [4,6]:
+		raise argparse.ArgumentTypeError("invalid bind \""+text.strip()+"\", the port must be between 1 and 65535 and the IP version 4 or 6")
+	return bind
+
+def readBindFile(path):
+	# One bind per line, empty lines and lines starting with # are skipped
+	with open(path, "r") as bindFile:
+		return [parseBind(line) for line in bindFile if line.strip() != "" and not line.strip().startswith("#")]
+
 def main():
 	parser = argparse.ArgumentParser(description="Netmask client interface.")
 	parser.add_argument("bindMode", type=str, choices=["tcp","udp"], help="The bind mode.")
@@ -12,6 +32,19 @@ def main():
 	parser.add_argument("--key", type=str, default="0", help="The communication key (default: 0).")
 	parser.add_argument("--verbose", action="store_true", help="Enable verbose mode.")
 	parser.add_argument("--nogui", action="store_true", help="Disable GUI in verbose mode.")
+	parser.add_argument("--multiplex", action="store_true", help="Carry TCP connections over the control connection.")
+	parser.add_argument("--pool-size", type=int, default=0, help="Number of pre-opened TCP data connections to keep (default: 0).")
+	parser.add_argument("--udp-demux", action="store_true", help="Forward every UDP peer through a single socket to the server.")
+	parser.add_argument("--engine", type=str, choices=["threads","asyncio"], default="threads", help="Forward connections on a thread each or all on one event loop (default: threads).")
+	parser.add_argument("--splice", action="store_true", help="Relay TCP connections with zero-copy splice (Linux only).")
+	parser.add_argument("--pool-refill-rate", type=float, default=10, help="Pre-opened data connections opened per second at most (default: 10).")
+	parser.add_argument("--compress", type=str, choices=["zlib","lzma"], default=None, help="Compress the TCP data connections to the server.")
+	parser.add_argument("--compress-level", type=int, choices=range(10), default=6, metavar="{0-9}", help="The compression level (default: 6).")
+	parser.add_argument("--bind", type=parseBind, action="append", default=[], metavar="PROTOCOL:PORT:IPVERSION", help="Another bind on the same connection to the server, can be repeated (example: udp:53:6).")
+	parser.add_argument("--bind-file", type=str, default=None, help="A file with another bind on the same connection to the server per line, written like --bind.")
+	parser.add_argument("--resume", action="store_true", help="Have the server keep the binds when the connection drops, and reconnect to them.")
+	parser.add_argument("--gui-refresh", type=float, default=4, help="GUI frames drawn per second (default: 4).")
+	parser.add_argument("--profile", type=float, default=None, help="Profile every thread for this many seconds after connecting, into netmaskc-<pid>.pstats.")
 	
 	args = parser.parse_args()
 
@@ -22,15 +55,45 @@ def main():
 		parser.print_help()
 		os._exit(1)
 	
+	extraBinds = args.bind
+	if args.bind_file != None:
+		try:
+			extraBinds += readBindFile(args.bind_file)
+		except (OSError, argparse.ArgumentTypeError) as e:
+			parser.error("--bind-file: "+str(e))
+
 	if args.verbose and not args.nogui:
 		parser.error("Verbose mode requires --nogui to be specified.")
 
-	server = NetmaskClient(args.key, args.port, 0 if args.bindMode == "tcp" else 1, args.ipVersion, verbose=args.verbose)
+	if args.engine == "asyncio" and (args.multiplex or args.pool_size > 0 or args.splice):
+		parser.error("The asyncio engine can't be combined with --multiplex, --pool-size or --splice.")
+
+	# The server kicks a client asking for more, before it could tell why
+	if 1 + len(extraBinds) > packets.SESSION_MAX_BINDS:
+		parser.error("At most "+str(packets.SESSION_MAX_BINDS)+" binds can share a connection to the server, "+str(1 + len(extraBinds))+" were given.")
+
+	if args.multiplex and extraBinds:
+		parser.error("--multiplex can't be combined with --bind or --bind-file.")
+
+	if args.resume and args.multiplex:
+		parser.error("--resume can't be combined with --multiplex.")
+
+	if args.compress != None and ((args.bindMode != "tcp" and all(bind[0] != 0 for bind in extraBinds)) or args.multiplex):
+		parser.error("--compress only applies to TCP tunnels without --multiplex.")
+
+	server = NetmaskClient(args.key, args.port, 0 if args.bindMode == "tcp" else 1, args.ipVersion, verbose=args.verbose, multiplex=args.multiplex, poolSize=args.pool_size, poolRefillRate=args.pool_refill_rate, useSplice=args.splice, engine=args.engine, udpDemux=args.udp_demux, compress=args.compress, compressLevel=args.compress_level, extraBinds=extraBinds, resume=args.resume)
 	
+	# kill -USR1 <pid> prints the hot path timers
+	if hasattr(signal, "SIGUSR1"):
+		signal.signal(signal.SIGUSR1, lambda signalNumber, frame: print(timers.dump()))
+
+	if args.profile != None:
+		Profiler("netmaskc", args.profile).startWindow()
+
 	if not args.nogui:
-		gui = NetmaskClientGUI(server)
+		gui = NetmaskClientGUI(server, max(args.gui_refresh, 0.1))
 		server.gui = gui
-		threading.Thread(target=NetmaskClientGUI(server).displayGUI).start()
+		threading.Thread(target=gui.displayGUI).start()
 	
 	server.connect(host, port)
 
@@ -1,6 +1,8 @@
 from netmask.server.main import NetmaskServer
+from netmask.utils.profiling import timers
 import threading
 import argparse
+import signal
 import os
 
 def CTRLCHandler():
@@ -19,13 +21,24 @@ def main():
 	parser.add_argument("--port", type=int, default=1024, help="The IPv4 listener interface's IP. (default: 1024)")
 	parser.add_argument("--key", type=str, default="0", help="The communication key. (default: 0)")
 	parser.add_argument("--verbose", action="store_true", help="Enable verbose mode.")
+	parser.add_argument("--splice", action="store_true", help="Relay TCP tunnels with zero-copy splice (Linux only).")
+	parser.add_argument("--workers", type=int, default=1, help="Number of worker processes sharing the listeners (Unix only). (default: 1)")
+	parser.add_argument("--public-ipv4", type=str, default=None, help="The public IPv4 address given to clients, skips discovering it. (to set to none, use -)")
+	parser.add_argument("--public-ipv6", type=str, default=None, help="The public IPv6 address given to clients, skips discovering it. (to set to none, use -)")
+	parser.add_argument("--metrics-port", type=int, default=None, help="Serve Prometheus metrics on this localhost port, workers use the following ports.")
+	parser.add_argument("--profile", type=float, default=None, help="Profile the server for this many seconds after starting, into netmasks-<pid>.pstats.")
+	parser.add_argument("--resume-grace", type=int, default=30, help="Seconds the binds of a resumable client are kept after its connection dropped, 0 disables resumption. (default: 30)")
 	
 	args = parser.parse_args()
 
 	threading.Thread(target=CTRLCHandler).start()
 
+	# kill -USR1 <pid> prints the hot path timers of that process
+	if hasattr(signal, "SIGUSR1"):
+		signal.signal(signal.SIGUSR1, lambda signalNumber, frame: print(timers.dump()))
+
 	try:
-		server = NetmaskServer(args.key, args.verbose).start(args.listener4, args.listener6, args.port)
+		server = NetmaskServer(args.key, args.verbose, args.splice, args.workers, args.public_ipv4, args.public_ipv6, metricsPort=args.metrics_port, profileDuration=args.profile, resumeGrace=args.resume_grace).start(args.listener4, args.listener6, args.port)
 	except:
 		pass
 
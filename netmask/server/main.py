@@ -1,69 +1,170 @@
 import netmask.impl.packets as packets
-import threading
+from netmask.utils.timerwheel import TimerWheel
+import netmask.server.workers as workers
+import netmask.server.metrics as metrics
+from netmask.utils.profiling import timers, Profiler
+import netmask.utils.compression as compression
+import netmask.utils.splice as splice
+import collections
 import hashlib
 import asyncio
+import json
 import socket
 import select
 import time
-import sys
 import os
 
 # Variables
 MAX_TIMEOUT = 5
 PACKET_BUFFER = 2048
 
-# Helper function for asyncio
-def _runInThreadsafeLoop(coro):
-	return asyncio.run_coroutine_threadsafe(coro, loop).result()
+# Handshakes run on the loop, so bursts of clients are only limited by how many can wait to be accepted
+LISTEN_BACKLOG = 1024
+
+# Relay buffering per tunnel direction, reads grow from PACKET_BUFFER up to RELAY_READ_MAX while saturated
+RELAY_READ_MAX = 262144
+RELAY_HIGH_WATER = 262144
+RELAY_LOW_WATER = 65536
+DATA_CONNECTION_IDLE = 60
+
+# Seconds the binds of a resumable client are kept after its control connection dropped (0 disables resumption)
+RESUME_GRACE = 30
+
+# UDP session table limits, per bind (idle sessions are evicted after one to two UDP_IDLE_TIMEOUT periods)
+UDP_IDLE_TIMEOUT = 60
+UDP_MAX_SESSIONS = 4096
+UDP_PENDING_DATAGRAMS = 64
+UDP_PENDING_DROP_OLDEST = False
+
+# Discovered public addresses are cached on disk, and rediscovered in the background once they are older than the TTL
+PUBLIC_ADDRESS_CACHE = os.path.join(os.path.expanduser("~"), ".netmask", "addresses.json")
+PUBLIC_ADDRESS_TTL = 3600
+PUBLIC_ADDRESS_RETRY = 60
+PUBLIC_ADDRESS_WAIT = 5
 
 class AsyncTCPSocket:
+	# Pairs the asyncio streams of a connection, everything using them runs on the loop
 	def __init__(self, reader, writer):
 		self.reader = reader
 		self.writer = writer
 
-	def send(self, buffer):
-		return _runInThreadsafeLoop(self._asyncSend(buffer))
-
-	def recv(self, length):
-		return _runInThreadsafeLoop(self._asyncRecv(length))
-
 	def close(self):
 		self.writer.close()
 
-	async def _asyncSend(self, buffer):
-		self.writer.write(buffer)
-		await self.writer.drain()
-		return len(buffer)
-
-	async def _asyncRecv(self, length):
-		return await self.reader.read(length)
-
 class NetmaskBind:
 	def __init__(self, connectionClass, bindMode, bindPort):
 		self.serverSocket = None
 		self.connectionClass = connectionClass
+		self.serverClass = connectionClass.serverClass
 		self.bindMode = bindMode
 		self.bindPort = bindPort
-		self.connectedTCPClients = []
+
+		# UID -> TCPProtocol of every visitor on this bind
+		self.connectedTCPClients = {}
 		self.UDPServers = []
 
+		# Multiplexed streams (TCP only), carried over the control connection instead of a data connection
+		self.multiplexed = False
+		self.streams = {}
+		self.streamCounter = 0
+		self.streamsReady = None
+
+		# Bytes from and to visitors, summed up by the metrics endpoint when scraped
+		self.receivedBytes = 0
+		self.sentBytes = 0
+		self.isStopped = False
+
+		# (algorithm, level) when the client's data connections are compressed, TCP binds without multiplexing only
+		self.compression = None
+		self.compressionStats = compression.CompressionStats()
+
+		# Position of this bind among the ones the client requested, None when it requested only this one
+		self.bindId = None
+
 	class TCPProtocol:
 		def __init__(self, bindClass):
 			self.server = None
 			self.isForwarding = False
-			self.uid = os.urandom(32)
+			self.uid = bindClass.serverClass.newUID()
 			self.bindClass = bindClass
 
 			self.reader = None
 			self.writer = None
 
-		async def forward(self, reader, writer):
+			# Completed by setServer once the client's data connection arrives
+			self.serverConnected = None
+
+			# Only used on multiplexed binds
+			self.streamId = None
+			self.sendWindow = packets.STREAM_WINDOW
+			self.windowEvent = None
+			self.incoming = None
+
+		async def forward(self, reader, writer, fromVisitor):
+			bindClass = self.bindClass
+			readSize = PACKET_BUFFER
 			try:
 				while True:
-					data = await reader.read(PACKET_BUFFER)
+					data = await reader.read(readSize)
 					if not data:
 						break
 					writer.write(data)
+
+					if fromVisitor:
+						bindClass.receivedBytes += len(data)
+					else:
+						bindClass.sentBytes += len(data)
+
+					# Grow reads while the pipe is saturated, shrink them back once it isn't
+					if len(data) == readSize:
+						readSize = min(readSize * 2, RELAY_READ_MAX)
+					elif len(data) < readSize // 4:
+						readSize = max(readSize // 2, PACKET_BUFFER)
+
+					# Stop reading while the peer is slow, this only blocks above the high water mark
+					await writer.drain()
+			finally:
+				writer.close()
+
+		async def compressForward(self, reader, writer):
+			# Visitor to client, compressed on the way
+			bindClass = self.bindClass
+			algorithm, level = bindClass.compression
+			compressor = compression.StreamCompressor(algorithm, level, bindClass.compressionStats)
+			try:
+				while True:
+					data = await reader.read(RELAY_READ_MAX)
+					if not data:
+						# The visitor is done, what the compressor still holds has to reach the client first
+						output = compressor.compress(b"", True)
+						if output:
+							writer.write(output)
+							await writer.drain()
+						break
+					bindClass.receivedBytes += len(data)
+
+					# Flush once the visitor has nothing more buffered, so small exchanges aren't held back in the compressor
+					output = compressor.compress(data, compression.isDrained(reader))
+					if output:
+						writer.write(output)
+						await writer.drain()
+			finally:
+				writer.close()
+
+		async def decompressForward(self, reader, writer):
+			# Client to visitor, decompressed in bounded chunks so a small input can't expand past the write buffer limits
+			bindClass = self.bindClass
+			decompressor = compression.StreamDecompressor(bindClass.compression[0], bindClass.compressionStats)
+			try:
+				while True:
+					data = await reader.read(RELAY_READ_MAX)
+					if not data:
+						break
+
+					for output in decompressor.decompressChunks(data, RELAY_READ_MAX):
+						writer.write(output)
+						bindClass.sentBytes += len(output)
+						await writer.drain()
 			finally:
 				writer.close()
 
@@ -71,35 +172,146 @@ class NetmaskBind:
 			writer.write(b"\x01")
 			self.server = AsyncTCPSocket(reader, writer)
 
+			if self.serverConnected != None and not self.serverConnected.done():
+				self.serverConnected.set_result(True)
+
+		async def spliceRelay(self):
+			# Hand both sockets over to the zero-copy relay, returns False if they can't be taken over
+			if not splice.canTakeStreamSocket(self.reader, self.writer) or not splice.canTakeStreamSocket(self.server.reader, self.server.writer):
+				return False
+
+			visitorSocket, visitorPending = splice.takeStreamSocket(self.reader, self.writer)
+			clientSocket, clientPending = splice.takeStreamSocket(self.server.reader, self.server.writer)
+			try:
+				receivedBytes, sentBytes = await asyncio.gather(splice.spliceForward(visitorSocket, clientSocket, visitorPending), splice.spliceForward(clientSocket, visitorSocket, clientPending))
+				self.bindClass.receivedBytes += receivedBytes
+				self.bindClass.sentBytes += sentBytes
+			finally:
+				visitorSocket.close()
+				clientSocket.close()
+
+			return True
+
 		async def killConnection(self):
 			self.writer.close()
 			await self.writer.wait_closed()
 
+		async def streamUpload(self):
+			connectionClass = self.bindClass.connectionClass
+			while True:
+				# Wait until the client allows us to send more data on this stream
+				while self.sendWindow <= 0:
+					self.windowEvent.clear()
+					await self.windowEvent.wait()
+
+				data = await self.reader.read(min(packets.STREAM_CHUNK, self.sendWindow))
+				if not data:
+					closePacket = packets.StreamClose()
+					closePacket.streamId = self.streamId
+					await connectionClass.sendPacketAsync(closePacket)
+					return
+
+				self.sendWindow -= len(data)
+				self.bindClass.receivedBytes += len(data)
+
+				dataPacket = packets.StreamData()
+				dataPacket.streamId = self.streamId
+				dataPacket.data = data
+				await connectionClass.sendPacketAsync(dataPacket)
+
+		async def streamDownload(self):
+			connectionClass = self.bindClass.connectionClass
+			while True:
+				data = await self.incoming.get()
+				if data == None:
+					return
+
+				self.writer.write(data)
+				self.bindClass.sentBytes += len(data)
+				await self.writer.drain()
+
+				# Give the consumed bytes back to the client
+				windowPacket = packets.StreamWindowUpdate()
+				windowPacket.streamId = self.streamId
+				windowPacket.increment = len(data)
+				await connectionClass.sendPacketAsync(windowPacket)
+
+		async def handleStream(self):
+			bindClass = self.bindClass
+
+			# Don't open streams until both sides switched to the split encryption
+			setupStart = time.perf_counter()
+			await bindClass.streamsReady.wait()
+
+			self.streamId = bindClass.streamCounter
+			bindClass.streamCounter = (bindClass.streamCounter + 1) % 2**32
+			self.windowEvent = asyncio.Event()
+			self.incoming = asyncio.Queue()
+			bindClass.streams[self.streamId] = self
+
+			try:
+				openPacket = packets.SStreamOpen()
+				openPacket.streamId = self.streamId
+				await bindClass.connectionClass.sendPacketAsync(openPacket)
+
+				bindClass.serverClass.metrics.tcpSetupDuration.observe(time.perf_counter() - setupStart)
+				self.isForwarding = True
+
+				# Forward until either side closes, then stop the other direction
+				tasks = [asyncio.ensure_future(self.streamUpload()), asyncio.ensure_future(self.streamDownload())]
+				done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+				for task in pending:
+					task.cancel()
+
+				# A side that dropped ends the stream like one that closed, take its error so it isn't logged as never retrieved
+				for task in done:
+					if not task.cancelled():
+						task.exception()
+			finally:
+				bindClass.streams.pop(self.streamId, None)
+
 		async def handleClient(self, reader, writer):
 			self.reader = reader
 			self.writer = writer
 			try:
-				if not await self.bindClass.connectionClass.connectionHandler(self.uid):
+				if self.bindClass.multiplexed:
+					await self.handleStream()
 					return
 
-				timeoutCounter = 0
-				while self.server == None:
-					# Sleep for 10ms until we get a connection from the client
-					await asyncio.sleep(0.01)
+				setupStart = time.perf_counter()
+				self.serverConnected = loop.create_future()
+
+				if not await self.bindClass.connectionClass.connectionHandler(self.uid, self.bindClass.bindId):
+					return
 
-					# If timeout is reached, break and close connection
-					if timeoutCounter >= round(MAX_TIMEOUT / 0.01):
+				# Wait until we get a connection from the client, if timeout is reached, close connection
+				if self.server == None:
+					rendezvousStart = time.perf_counter()
+					try:
+						await asyncio.wait_for(self.serverConnected, MAX_TIMEOUT)
+					except asyncio.TimeoutError:
 						return
-					timeoutCounter += 1
+					timers.record("rendezvous", time.perf_counter() - rendezvousStart)
+
+				# Bound how much data can pile up for a slow peer
+				for relayWriter in [self.writer, self.server.writer]:
+					relayWriter.transport.set_write_buffer_limits(RELAY_HIGH_WATER, RELAY_LOW_WATER)
 
 				# Forward forever
+				self.bindClass.serverClass.metrics.tcpSetupDuration.observe(time.perf_counter() - setupStart)
 				self.isForwarding = True
-				await asyncio.gather(self.forward(self.reader, self.server.writer), self.forward(self.server.reader, self.writer))
+				if self.bindClass.compression != None:
+					await asyncio.gather(self.compressForward(self.reader, self.server.writer), self.decompressForward(self.server.reader, self.writer))
+				elif not (self.bindClass.serverClass.useSplice and await self.spliceRelay()):
+					await asyncio.gather(self.forward(self.reader, self.server.writer, True), self.forward(self.server.reader, self.writer, False))
 			finally:
+				self.bindClass.serverClass.pendingTCPConnections.pop(self.uid, None)
 				self.writer.close()
 				if self.server != None:
 					self.server.writer.close()
-				if not self.isForwarding:
+				# Without a data connection the client is taken for gone, unless it's resumable (then its local
+				# service may only be down for a moment, and a drop of the client is noticed by its control connection)
+				if not self.isForwarding and self.bindClass.connectionClass.resumeToken == None:
 					await self.bindClass._stopServer()
 
 	class UDPHandler(asyncio.DatagramProtocol):
@@ -107,91 +319,170 @@ class NetmaskBind:
 			def __init__(self, handlerClass, address):
 				self.address = address
 				self.handlerClass = handlerClass
-				self.uid = os.urandom(32)
-				self.buffer = []
+				self.uid = handlerClass.bindClass.serverClass.newUID()
 				self.isForwarding = False
 
-				# To be gotten on server connection
+				# Datagrams received before the client connected, replayed in order
+				self.buffer = collections.deque()
+
+				# To be gotten on server connection, the tag is only set for demultiplexed clients
 				self.forwardTransport = None
 				self.forwardAddress = None
+				self.forwardTag = None
+
+				# Register the UID so the client's data address can be matched to it
+				serverClass = self.handlerClass.bindClass.serverClass
+				serverClass.pendingUDPConnections[self.uid] = self
 
-				# Create the timeout handler
-				loop.create_task(self.timeoutHandler())
+				# If the client doesn't connect in time, evict the session
+				self.timerWheel = serverClass.udpTimerWheel
+				self.timerWheel.add(self, MAX_TIMEOUT, self.timeoutHandler)
 
-			async def timeoutHandler(self):
-				timeoutCounter = 0
-				while not self.isForwarding:
-					# Sleep for 10ms until we get a connection from the client
-					await asyncio.sleep(0.01)
+				# Set by every forwarded datagram, so the hot path never touches the timer
+				self.isActive = False
+				self.createdTime = time.perf_counter()
+
+			def timeoutHandler(self):
+				# Pending sessions are evicted right away, forwarding ones once a whole idle period passed without traffic
+				if not self.isForwarding or not self.isActive:
+					self.handlerClass.evictClient(self)
+					return
 
-					# If timeout is reached, close the connection
-					if timeoutCounter >= round(MAX_TIMEOUT / 0.01):
-						await self.handlerClass.bindClass._stopServer()
+				self.isActive = False
+				self.timerWheel.add(self, UDP_IDLE_TIMEOUT, self.timeoutHandler)
+
+			def bufferDatagram(self, data):
+				handlerClass = self.handlerClass
+				if len(self.buffer) >= UDP_PENDING_DATAGRAMS:
+					handlerClass.droppedDatagrams += 1
+					if not UDP_PENDING_DROP_OLDEST:
 						return
-					timeoutCounter += 1
+					self.buffer.popleft()
+
+				self.buffer.append(data)
+
+			def setServer(self, forwardTransport, forwardAddress, forwardTag = None):
+				self.forwardTransport = forwardTransport
+				self.forwardAddress = forwardAddress
+				self.forwardTag = forwardTag
 
-			def setServer(self, forwardTransport, forwardAddress):
 				# Make client acknowledge connection was successful
-				forwardTransport.sendto(b"\x01", forwardAddress)
+				if forwardTag != None:
+					forwardTransport.sendto(bytes([packets.UDP_DEMUX_ACK]) + forwardTag, forwardAddress)
+				else:
+					forwardTransport.sendto(b"\x01", forwardAddress)
 
 				# Send buffer (if any)
 				while len(self.buffer) != 0:
-					forwardTransport.sendto(self.buffer.pop(), forwardAddress)
-
-				self.forwardTransport = forwardTransport
-				self.forwardAddress = forwardAddress
+					self.forward(self.buffer.popleft())
 
 				# Set the forwarding state to true
+				self.handlerClass.bindClass.serverClass.metrics.udpSetupDuration.observe(time.perf_counter() - self.createdTime)
 				self.isForwarding = True
+				self.isActive = True
+				self.timerWheel.add(self, UDP_IDLE_TIMEOUT, self.timeoutHandler)
+
+			def forward(self, data):
+				self.handlerClass.bindClass.receivedBytes += len(data)
+				if self.forwardTag != None:
+					self.forwardTransport.sendto(bytes([packets.UDP_DEMUX_DATA]) + self.forwardTag + data, self.forwardAddress)
+				else:
+					self.forwardTransport.sendto(data, self.forwardAddress)
 
 		def __init__(self, bindClass):
-			# List of UDPClients
-			self.clients = []
+			# Visitor address -> UDPProtocol
+			self.clients = {}
 
 			# Counter self (if we are IPv4, this is going to be IPv6, and if we are IPv6, this is going to be IPv4)
 			self.counterSelf = None
 
 			self.bindClass = bindClass
 
+			# Datagrams dropped because a pending session's buffer was full or the session table was full
+			self.droppedDatagrams = 0
+			self.droppedSessions = 0
+			self.evictedSessions = 0
+
 		def connection_made(self, transport):
 			self.transport = transport
 
 		def datagram_received(self, data, address):
-			for client in self.clients:
-				if client.address == address:
-					if client.isForwarding:
-						client.forwardTransport.sendto(data, client.forwardAddress)
-					else:
-						client.buffer.append(data)
-					return
+			client = self.clients.get(address, None)
+			if client != None:
+				if client.isForwarding:
+					client.isActive = True
+					client.forward(data)
+				else:
+					client.bufferDatagram(data)
+				return
+
+			# Don't let a flood of (possibly spoofed) sources grow the table without bound
+			if len(self.clients) >= UDP_MAX_SESSIONS:
+				self.droppedSessions += 1
+				self.droppedDatagrams += 1
+				return
 
 			newClient = self.UDPProtocol(self, address)
-			newClient.buffer.append(data)
-			self.clients.append(newClient)
-			asyncio.create_task(self.bindClass.connectionClass.connectionHandler(newClient.uid))
+			newClient.bufferDatagram(data)
+			self.clients[address] = newClient
+			asyncio.ensure_future(self.bindClass.connectionClass.connectionHandler(newClient.uid, self.bindClass.bindId))
+
+		def unregisterClient(self, client):
+			serverClass = self.bindClass.serverClass
+			client.timerWheel.remove(client)
+			serverClass.pendingUDPConnections.pop(client.uid, None)
+			if client.forwardTag != None:
+				serverClass.forwardingUDPSessions.pop((client.forwardAddress, client.forwardTag), None)
+			elif client.forwardAddress != None and serverClass.forwardingUDPAddresses.get(client.forwardAddress, None) is client:
+				del serverClass.forwardingUDPAddresses[client.forwardAddress]
+
+		def evictClient(self, client):
+			if self.clients.get(client.address, None) is client:
+				del self.clients[client.address]
+			self.unregisterClient(client)
+			self.evictedSessions += 1
 
 		def killServer(self):
+			# Unregister every session of this handler
+			for client in self.clients.values():
+				self.unregisterClient(client)
+
+			self.clients = {}
+
 			if self.transport != None:
 				self.transport.close()
 
 			if self.counterSelf != None:
 				self.counterSelf.transport.close()
 
+	def handleStreamPacket(self, packet):
+		stream = self.streams.get(packet.streamId, None)
+		if stream == None:
+			return
+
+		if isinstance(packet, packets.StreamData):
+			stream.incoming.put_nowait(packet.data)
+		elif isinstance(packet, packets.StreamWindowUpdate):
+			stream.sendWindow += packet.increment
+			stream.windowEvent.set()
+		elif isinstance(packet, packets.StreamClose):
+			stream.incoming.put_nowait(None)
+
 	async def handleTCPConnection(self, reader, writer):
 		try:
 			tcpProtocolClass = self.TCPProtocol(self)
-			self.connectedTCPClients.append(tcpProtocolClass)
+			self.connectedTCPClients[tcpProtocolClass.uid] = tcpProtocolClass
+			if not self.multiplexed:
+				self.serverClass.pendingTCPConnections[tcpProtocolClass.uid] = tcpProtocolClass
 			return await tcpProtocolClass.handleClient(reader, writer)
 		except:
 			pass
-
-	def startServer(self):
-		return _runInThreadsafeLoop(self._startServer())
-
-	def stopServer(self):
-		return _runInThreadsafeLoop(self._stopServer())
+		finally:
+			self.connectedTCPClients.pop(tcpProtocolClass.uid, None)
 
 	async def _startServer(self):
+		self.streamsReady = asyncio.Event()
+
 		if self.bindMode == 0:
 			# TCP
 			sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
@@ -204,7 +495,8 @@ class NetmaskBind:
 			sock.listen(5)
 			sock.setblocking(False)
 
-			self.serverSocket = await asyncio.start_server(self.handleTCPConnection, sock=sock)
+			self.serverSocket = await asyncio.start_server(self.handleTCPConnection, sock=sock, limit=RELAY_READ_MAX)
+			self.bindPort = self.serverSocket.sockets[0].getsockname()[1]
 			return self.serverSocket.sockets[0].getsockname()
 		elif self.bindMode == 1:
 			# UDP
@@ -214,8 +506,11 @@ class NetmaskBind:
 				_coroutine4, udpServer4 = await loop.create_datagram_endpoint(lambda: self.UDPHandler(self), local_addr=('0.0.0.0', 0))
 				self.UDPServers.append(udpServer4)
 
-				# Start IPv6 server
-				_coroutine6, udpServer6 = await loop.create_datagram_endpoint(lambda: self.UDPHandler(self), local_addr=('::', _coroutine4.get_extra_info('sockname')[1]))
+				# Start IPv6 server, IPv6 only since the IPv4 one already holds the port
+				sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+				sock6.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+				sock6.bind(('::', _coroutine4.get_extra_info('sockname')[1]))
+				_coroutine6, udpServer6 = await loop.create_datagram_endpoint(lambda: self.UDPHandler(self), sock=sock6)
 				self.UDPServers.append(udpServer6)
 
 				# Define each UDP server's callbacks
@@ -224,15 +519,26 @@ class NetmaskBind:
 			except:
 				pass
  
+			self.bindPort = _coroutine4.get_extra_info('sockname')[1]
 			return _coroutine4.get_extra_info('sockname')
 
 
 	async def _stopServer(self):
+		# Both a failed visitor and the client leaving may stop the bind, only do it once
+		if self.isStopped:
+			return
+		self.isStopped = True
+
+		# Keep this bind's counters in the server's totals, and remove it from the server's bindings
+		self.serverClass.metrics.retireBind(self)
+		self.connectionClass.bindings.remove(self)
+
 		# Kill and clear every connected TCP client
-		for client in self.connectedTCPClients:
+		for client in list(self.connectedTCPClients.values()):
+			self.serverClass.pendingTCPConnections.pop(client.uid, None)
 			await client.killConnection()
 
-		self.connectedTCPClients = []
+		self.connectedTCPClients = {}
 
 		# Shutdown and clear every UDP server
 		for server in self.UDPServers:
@@ -240,11 +546,14 @@ class NetmaskBind:
 
 		self.UDPServers = []
 
-		# Remove from server's bindings
-		self.connectionClass.bindings.remove(self)
+		# A resumable client would come back to nothing, end its session instead
+		if self.connectionClass.resumeToken != None:
+			self.connectionClass.endSession()
 
-		# Close the server class connection
+		# Close the server class connection, the other binds of the client go along with it
 		self.connectionClass.socket.close()
+		for binding in self.connectionClass.bindings.copy():
+			asyncio.ensure_future(binding._stopServer())
 
 		# Close server socket
 		if self.serverSocket:
@@ -259,37 +568,180 @@ class ServerConnection(packets.ProtocolHandler):
 
 		super().__init__(self.serverClass.communicationKey, socket)
 
+		# The control connection's streams, used to send packets from the loop
+		if socket != None:
+			self.reader = socket.reader
+			self.writer = socket.writer
+
+		# While a resumable client is away: when it left, the grace period's timer, and a future
+		# resolved with the connection it came back on (or None once the grace period is over)
+		self.detachedTime = None
+		self.expiryHandle = None
+		self.resumed = None
+
 	def terminateConnection(self):
+		# Always called on the loop, the bindings are stopped right after
+		for encryption in self.encryptions():
+			encryption.cancelRefill()
+
 		try:
 			try:
-				self.socket.send(packets.SKick().packBuffer())
+				# Packets still waiting for their flush go out before the kick
+				self.flushPackets()
+				self.writer.write(packets.SKick().packBuffer())
 			finally:
-				self.socket.close()
+				self.writer.close()
 
 			self.serverClass.clients.remove(self)
+			self.serverClass.metrics.retireConnection(self)
 
 			for binding in self.bindings.copy():
-				binding.stopServer()
+				asyncio.ensure_future(binding._stopServer())
 		except:
 			pass
 
-		sys.exit()
+	def detachConnection(self):
+		# The binds keep listening, visitors arriving meanwhile wait for the client to come back
+		if self.resumed != None:
+			return
+
+		self.detachedTime = time.perf_counter()
+		self.expiryHandle = loop.call_later(self.serverClass.resumeGrace, self.expireSession)
+		self.resumed = loop.create_future()
+
+		# Packets queued for the lost connection can't be delivered anymore
+		if self.flushHandle != None:
+			self.flushHandle.cancel()
+			self.flushHandle = None
+		self.pendingPackets = None
+		self.pendingSize = 0
+
+		self.writer.close()
+
+		if self.verbose:
+			print("[SERVER] Client went away, keeping its binds for "+str(self.serverClass.resumeGrace)+" seconds")
+
+	def expireSession(self):
+		self.serverClass.metrics.expiredSessions += 1
+		self.endSession()
+
+	def endSession(self):
+		# The session can't be resumed anymore, visitors waiting for the client give up and a connected client is kicked
+		self.serverClass.resumableSessions.pop(self.resumeToken, None)
+		self.resumeToken = None
+
+		if self.resumed == None:
+			# Encrypted, so the client knows not to resume (the kick written by terminateConnection is empty)
+			try:
+				self.flushPackets()
+				self.writer.write(self.encodePacket(packets.SKick()))
+			except:
+				pass
+		else:
+			self.expiryHandle.cancel()
+			if not self.resumed.done():
+				self.resumed.set_result(None)
 
-	async def connectionHandler(self, uid):
-		# Tell the client the UID
+		self.terminateConnection()
+
+	async def resumeSession(self, connection):
+		# The client came back on a new connection, hand every bind over to it
+		self.detachConnection()
+		self.expiryHandle.cancel()
+		self.serverClass.resumableSessions.pop(self.resumeToken, None)
+		self.resumeToken = None
+
+		connection.bindings = self.bindings
+		self.bindings = []
+		for binding in connection.bindings:
+			binding.connectionClass = connection
+
+		if self in self.serverClass.clients:
+			self.serverClass.clients.remove(self)
+			self.serverClass.metrics.retireConnection(self)
+		self.serverClass.clients.append(connection)
+
+		# The new token answers the resume request, then every visitor still waiting on these binds is announced
+		# again, the ones that arrived meanwhile and the ones announced right before the drop that may have been lost
+		await connection.issueToken()
+		self.resumed.set_result(connection)
+
+		serverClass = self.serverClass
+		waiting = [(uid, client.bindClass) for uid, client in serverClass.pendingTCPConnections.items()]
+		waiting += [(uid, client.handlerClass.bindClass) for uid, client in serverClass.pendingUDPConnections.items()]
+		for uid, binding in waiting:
+			if binding.connectionClass is connection:
+				await connection.connectionHandler(uid, binding.bindId)
+
+		self.serverClass.metrics.resumes += 1
+		self.serverClass.metrics.resumeDowntime.observe(time.perf_counter() - self.detachedTime)
+		await connection.controlLoop()
+
+	async def issueToken(self):
+		# Each token is only used once, like UIDs it ends with the worker owning the session
+		self.resumeToken = self.serverClass.newUID()
+		self.serverClass.resumableSessions[self.resumeToken] = self
+		packets.enableKeepalive(self.writer.get_extra_info("socket"))
+
+		tokenPacket = packets.SSessionToken()
+		tokenPacket.token = self.resumeToken
+		tokenPacket.grace = self.serverClass.resumeGrace
+		await self.sendPacketAsync(tokenPacket)
+
+	async def controlLoop(self):
+		# Nothing is expected from a resumable client past its binds, reading only tells when it goes away (a packet
+		# isn't read, that would roll the rolling key shared with the packets sent meanwhile)
+		try:
+			data = await self.reader.read(1)
+		except ConnectionError:
+			data = b""
+
+		# The session may have ended meanwhile, its binds being gone closed the connection
+		if self.resumeToken == None:
+			return
+
+		if data == b"":
+			self.detachConnection()
+			return
+
+		# Anything it sends ends the session
+		self.endSession()
+
+	async def connectionHandler(self, uid, bindId = None):
+		# While a resumable client is away, the visitor waits for it to come back and be announced to it then
+		if self.resumed != None:
+			return await asyncio.shield(self.resumed) != None
+
+		startTime = time.perf_counter()
+
+		# Tell the client the UID, and which of its binds the visitor arrived on
 		connectionPacket = packets.SConnection()
 		connectionPacket.uid = uid
+		connectionPacket.bindId = bindId
 		
-		# Send packet raw because of async
-		self.encryption.rollKey()
-		await self.socket._asyncSend(self.encryption.encryptDecrypt(connectionPacket.packMetadata()))
-		await self.socket._asyncSend(self.encryption.encryptDecrypt(connectionPacket.packBuffer()))
+		# Send packet on the loop because of async
+		try:
+			await self.sendPacketAsync(connectionPacket)
+		except OSError:
+			if self.resumeToken == None:
+				raise
 
+			self.detachConnection()
+			return await asyncio.shield(self.resumed) != None
+
+		# Refill the rolling key cache once the connection is idle, after this packet is already on its way
+		self.sendEncryption.scheduleRefill(loop)
+
+		timers.record("connectionHandler", time.perf_counter() - startTime)
 		return True
 
-	def connectionThread(self):
+	async def handleConnection(self):
+		handshakeStart = time.perf_counter()
+		isBound = False
 		try:
-			cHandshake = self.recvPacket(packets.CHandshakeRequest)
+			cHandshake = await self.recvPacketAsync(packets.CHandshakeRequest)
+			if cHandshake == None:
+				return
 
 			# If the encryption key doesn't match, kick the client
 			if cHandshake.encryptionKey != self.encryptionKey:
@@ -300,10 +752,12 @@ class ServerConnection(packets.ProtocolHandler):
 			proofOfEncryption = os.urandom(32)
 			POERequest = packets.SPOERequest()
 			POERequest.proofOfEncryptionRequest = proofOfEncryption
-			self.sendPacket(POERequest)
+			await self.sendPacketAsync(POERequest)
 
 			# Get the POE response
-			POEResponse = self.recvPacket(packets.CPOEResponse)
+			POEResponse = await self.recvPacketAsync(packets.CPOEResponse)
+			if POEResponse == None:
+				return
 
 			# Check if the proof of encryption matches with the server
 			if hashlib.sha256(proofOfEncryption).digest() != POEResponse.proofOfEncryptionResult:
@@ -311,73 +765,315 @@ class ServerConnection(packets.ProtocolHandler):
 				return
 
 			# Send handshake response
-			self.sendPacket(packets.SHandshakeResponse())
+			await self.sendPacketAsync(packets.SHandshakeResponse())
 
 			if self.verbose:
 				print("[SERVER] Connection with client established successfully!")
 
-			# Recieve the binding request
+			# Recieve the binding requests, every one but the last has BIND_FLAG_MORE set and they are answered in order
+			bindCount = 0
+			hasMore = True
+			while hasMore:
+				BindRequest = await self.recvPacketAsync(packets.CBindRequest)
+				if BindRequest == None:
+					return
 
-			BindRequest = self.recvPacket(packets.CBindRequest)
+				hasMore = BindRequest.flags != None and BindRequest.flags & packets.BIND_FLAG_MORE != 0
+				isSession = hasMore or bindCount != 0
 
-			# If the server doesn't have the specified IP version and if IP version is invalid, terminate connection
-			if (BindRequest.ipVersion == 4 and self.serverClass.publicIPv4 == None) or (BindRequest.ipVersion == 6 and self.serverClass.publicIPv6 == None) or (BindRequest.ipVersion not in [4,6]):
-				self.terminateConnection()
-				return
+				# Whether the client can resume is decided by its first request
+				if bindCount == 0:
+					resumable = BindRequest.flags != None and BindRequest.flags & packets.BIND_FLAG_RESUME != 0 and self.serverClass.resumeGrace > 0
 
-			# NetmaskBind will take care of both TCP and UDP
-			binding = NetmaskBind(self, BindRequest.bindMode, 0)
-			self.bindings.append(binding)
-			bindAddress = binding.startServer()
+				# If the server doesn't have the specified IP version and if IP version is invalid, terminate connection
+				publicAddress = await self.serverClass.getPublicAddress(BindRequest.ipVersion) if BindRequest.ipVersion in [4,6] else None
+				if publicAddress == None or bindCount >= packets.SESSION_MAX_BINDS:
+					self.terminateConnection()
+					return
 
-			BindResponse = packets.SBindResponse()
-			BindResponse.ipVersion = BindRequest.ipVersion
-			BindResponse.serverIP = self.serverClass.publicIPv4 if BindRequest.ipVersion == 4 else self.serverClass.publicIPv6
-			BindResponse.serverPort = bindAddress[1]
-			self.sendPacket(BindResponse)
+				# Streams can only be multiplexed on TCP binds requested alone, and UDP sessions only demultiplexed on UDP binds
+				multiplexed = BindRequest.flags != None and BindRequest.flags & packets.BIND_FLAG_MULTIPLEX != 0 and BindRequest.bindMode == 0 and not isSession
+				demultiplexed = BindRequest.flags != None and BindRequest.flags & packets.BIND_FLAG_UDP_DEMUX != 0 and BindRequest.bindMode == 1
+
+				# Streams are carried over the control connection, they can't outlive it
+				resumable = resumable and not multiplexed
+
+				# Compression only applies to the data connections of TCP binds, unknown settings are refused by not echoing the flag
+				compressionSettings = None
+				if BindRequest.compression != None and BindRequest.bindMode == 0 and not multiplexed:
+					compressionSettings = compression.unpackSettings(BindRequest.compression)
+
+				# NetmaskBind will take care of both TCP and UDP
+				binding = NetmaskBind(self, BindRequest.bindMode, 0)
+				binding.multiplexed = multiplexed
+				binding.compression = compressionSettings
+				binding.bindId = bindCount if isSession else None
+				self.bindings.append(binding)
+				bindAddress = await binding._startServer()
+				bindCount += 1
+
+				BindResponse = packets.SBindResponse()
+				BindResponse.ipVersion = BindRequest.ipVersion
+				BindResponse.serverIP = publicAddress
+				BindResponse.serverPort = bindAddress[1]
+				if BindRequest.flags != None:
+					BindResponse.flags = (packets.BIND_FLAG_MULTIPLEX if multiplexed else 0) | (packets.BIND_FLAG_UDP_DEMUX if demultiplexed else 0) | (packets.BIND_FLAG_COMPRESS if compressionSettings != None else 0) | (packets.BIND_FLAG_MORE if hasMore else 0) | (packets.BIND_FLAG_RESUME if resumable else 0)
+				await self.sendPacketAsync(BindResponse)
+
+				# The client waits for the first answer before sending the other requests at once, which needs a rolling key per direction
+				if hasMore and bindCount == 1:
+					self.splitEncryption()
+
+			isBound = True
+			self.serverClass.metrics.handshakes += 1
+			self.serverClass.metrics.handshakeDuration.observe(time.perf_counter() - handshakeStart)
+
+			if multiplexed:
+				self.splitEncryption()
+				binding.streamsReady.set()
+				await self.streamReceiveLoop(binding)
+			elif resumable:
+				await self.issueToken()
+				await self.controlLoop()
 		except:
 			self.terminateConnection()
 			return
+		finally:
+			if not isBound:
+				self.serverClass.metrics.handshakeFailures += 1
+
+	async def streamReceiveLoop(self, binding):
+		while True:
+			packet = await self.recvPacketAsync()
+			if packet == None:
+				return
+
+			# Only stream packets are allowed after a multiplexed bind
+			if not isinstance(packet, (packets.StreamData, packets.StreamWindowUpdate, packets.StreamClose)):
+				self.terminateConnection()
+				return
+
+			binding.handleStreamPacket(packet)
 
 class NetmaskServer:
 	class UDPServer:
-		def __init__(self, netmaskServer):
-			self.connectedAddresses = {}
+		def __init__(self, netmaskServer, family = socket.AF_INET):
 			self.netmaskServer = netmaskServer
+			self.family = family
 
 		def connection_made(self, transport):
 			self.transport = transport
+			self.netmaskServer.udpServers[self.family] = self
 
 		def datagram_received(self, data, address):
-			if address not in self.connectedAddresses.keys() and len(data) == 32:
-				# Iterate through every UID
-				for client in self.netmaskServer.clients:
-					for binding in client.bindings:
-						for udpServer in binding.UDPServers:
-							for udpClient in udpServer.clients:
-								if udpClient.uid == data:
-									self.connectedAddresses[address] = udpClient
-									udpClient.setServer(self.transport, address)
-									udpServer.transport.sendto(data, address)
-									return
+			# With workers, the kernel may have balanced this client to a worker that doesn't own its sessions
+			router = self.netmaskServer.router
+			if router != None:
+				workerID = router.routeDatagram(data, address)
+				if workerID != router.workerID:
+					router.relayDatagram(workerID, self.family, data, address)
+					return
+
+			self.handleDatagram(data, address)
+
+		def handleDatagram(self, data, address):
+			udpClient = self.netmaskServer.forwardingUDPAddresses.get(address, None)
+			if udpClient != None:
+				udpClient.isActive = True
+				udpClient.handlerClass.transport.sendto(data, udpClient.address)
+				udpClient.handlerClass.bindClass.sentBytes += len(data)
+			elif len(data) >= 5 and data[0] == packets.UDP_DEMUX_DATA:
+				# Demultiplexed client, many sessions share its address and are told apart by their tag
+				udpClient = self.netmaskServer.forwardingUDPSessions.get((address, data[1:5]), None)
+				if udpClient != None:
+					udpClient.isActive = True
+					udpClient.handlerClass.transport.sendto(data[5:], udpClient.address)
+					udpClient.handlerClass.bindClass.sentBytes += len(data) - 5
+			elif len(data) == 37 and data[0] == packets.UDP_DEMUX_REGISTER:
+				tag = data[1:5]
+
+				# The acknowledgement got lost and the client registered again
+				udpClient = self.netmaskServer.forwardingUDPSessions.get((address, tag), None)
+				if udpClient != None and udpClient.uid == data[5:]:
+					self.transport.sendto(bytes([packets.UDP_DEMUX_ACK]) + tag, address)
+					return
+
+				startTime = time.perf_counter()
+				udpClient = self.netmaskServer.pendingUDPConnections.pop(data[5:], None)
+				timers.record("uidLookup", time.perf_counter() - startTime)
+				if udpClient != None:
+					self.netmaskServer.forwardingUDPSessions[(address, tag)] = udpClient
+					udpClient.setServer(self.transport, address, tag)
+					return
+
+				self.transport.sendto(bytes([packets.UDP_DEMUX_REJECT]) + tag, address)
+			elif len(data) == 32:
+				startTime = time.perf_counter()
+				udpClient = self.netmaskServer.pendingUDPConnections.pop(data, None)
+				timers.record("uidLookup", time.perf_counter() - startTime)
+				if udpClient != None:
+					self.netmaskServer.forwardingUDPAddresses[address] = udpClient
+					udpClient.setServer(self.transport, address)
+					udpClient.handlerClass.transport.sendto(data, address)
+					return
 				
 				# UID not found, close connection
 				self.transport.sendto(b"\x00", address)
-			elif address in self.connectedAddresses.keys():
-				self.connectedAddresses[address].handlerClass.transport.sendto(data, self.connectedAddresses[address].address)
 
-	def __init__(self, communicationKey = 0, verbose = False):
+	def __init__(self, communicationKey = 0, verbose = False, useSplice = False, workerCount = 1, publicIPv4 = None, publicIPv6 = None, addressCache = PUBLIC_ADDRESS_CACHE, metricsPort = None, profileDuration = None, resumeGrace = RESUME_GRACE):
 		self.client = False
 		self.verbose = verbose
 
+		# Resumable clients that drop keep their binds for this many seconds, their ServerConnection by current token
+		self.resumeGrace = min(max(0, int(resumeGrace)), 65535)
+		self.resumableSessions = {}
+
+		# Fork this many processes sharing the listeners with SO_REUSEPORT, UIDs are limited to 256 owners
+		self.workerCount = min(max(1, workerCount), 256)
+		if self.workerCount > 1 and not workers.isAvailable():
+			print("[SYSTEM] Worker processes aren't available on this platform, running a single process")
+			self.workerCount = 1
+		self.router = None
+
+		# Relay TCP tunnels with os.splice when the platform supports it
+		self.useSplice = useSplice and splice.isAvailable()
+		if useSplice and not self.useSplice:
+			print("[SYSTEM] Zero-copy relay isn't available on this platform, falling back to copying")
+
 		# List of all the clients connected
 		self.clients = []
-		self.publicIPv4 = self.getPublicIPv4()
-		self.publicIPv6 = self.getPublicIPv4()
+
+		# Registries of pending and forwarding sessions across every binding
+		self.pendingTCPConnections = {}
+		self.pendingUDPConnections = {}
+		self.forwardingUDPAddresses = {}
+		self.forwardingUDPSessions = {}
+
+		# Address family -> UDPServer listening on the main port
+		self.udpServers = {}
+
+		# Pending and idle timeouts of every UDP session share one timer
+		self.udpTimerWheel = TimerWheel()
+
+		# Served over HTTP on localhost when a port is given, every worker uses the next port after the previous one's
+		self.metrics = metrics.ServerMetrics(self)
+		self.metricsPort = metricsPort
+
+		# Profile every worker's loop for this many seconds after starting
+		self.profileDuration = profileDuration
+
+		# Given addresses are used as they are ("-" disables that IP version), the others are discovered once the server started
+		self.publicIPv4 = publicIPv4 if publicIPv4 != "-" else None
+		self.publicIPv6 = publicIPv6 if publicIPv6 != "-" else None
+		self.discoveredVersions = [ipVersion for ipVersion, address in [(4, publicIPv4), (6, publicIPv6)] if address == None]
+
+		# Time each discovered address was found at, the cache may already have fresh enough ones
+		self.addressCache = addressCache
+		self.addressTimes = {}
+
+		# Time a version whose lookup failed is looked up again at, so it doesn't keep the found ones expiring
+		self.addressRetries = {}
+		self.addressDiscovery = None
+		self.addressRefresh = None
+		self.loadAddressCache()
 
 		self.communicationKey = str(communicationKey)
 		print("[SERVER] Communication key is "+self.communicationKey)
 
+	def loadAddressCache(self):
+		if self.addressCache == None:
+			return
+
+		try:
+			with open(self.addressCache, "r") as cacheFile:
+				cache = json.load(cacheFile)
+		except (OSError, ValueError):
+			return
+
+		# Stale addresses are still better than none while they are being rediscovered
+		for ipVersion in self.discoveredVersions:
+			entry = cache.get("ipv"+str(ipVersion), None)
+			if isinstance(entry, dict) and entry.get("address", None) != None:
+				setattr(self, "publicIPv"+str(ipVersion), entry["address"])
+				self.addressTimes[ipVersion] = entry.get("time", 0)
+
+	def saveAddressCache(self):
+		if self.addressCache == None:
+			return
+
+		cache = {}
+		for ipVersion, addressTime in self.addressTimes.items():
+			cache["ipv"+str(ipVersion)] = {"address": getattr(self, "publicIPv"+str(ipVersion)), "time": addressTime}
+
+		# Write next to the cache and rename over it, so workers never read a partial file
+		try:
+			os.makedirs(os.path.dirname(self.addressCache), exist_ok=True)
+			temporaryPath = self.addressCache+"."+str(os.getpid())
+			with open(temporaryPath, "w") as cacheFile:
+				json.dump(cache, cacheFile)
+			os.replace(temporaryPath, self.addressCache)
+		except OSError:
+			pass
+
+	def addressExpiresAt(self, ipVersion):
+		if ipVersion in self.addressRetries:
+			return self.addressRetries[ipVersion]
+
+		return self.addressTimes.get(ipVersion, 0) + PUBLIC_ADDRESS_TTL
+
+	def addressesExpireIn(self):
+		return min([self.addressExpiresAt(ipVersion) for ipVersion in self.discoveredVersions]) - time.time()
+
+	def expiredVersions(self):
+		currentTime = time.time()
+		return [ipVersion for ipVersion in self.discoveredVersions if self.addressExpiresAt(ipVersion) <= currentTime]
+
+	async def discoverPublicAddresses(self, ipVersions):
+		# The lookups block, run them in threads at the same time
+		getters = {4: self.getPublicIPv4, 6: self.getPublicIPv6}
+		addresses = await asyncio.gather(*[loop.run_in_executor(None, getters[ipVersion]) for ipVersion in ipVersions])
+
+		for ipVersion, address in zip(ipVersions, addresses):
+			# A failed lookup keeps the previous address and is retried on its own
+			if address == None:
+				self.addressRetries[ipVersion] = time.time() + PUBLIC_ADDRESS_RETRY
+				continue
+
+			self.addressRetries.pop(ipVersion, None)
+
+			setattr(self, "publicIPv"+str(ipVersion), address)
+			self.addressTimes[ipVersion] = time.time()
+
+			if self.verbose:
+				print("[SYSTEM] Public IPv"+str(ipVersion)+" address is "+address)
+
+		self.saveAddressCache()
+
+	async def refreshPublicAddresses(self):
+		while True:
+			if self.addressDiscovery != None:
+				await self.addressDiscovery
+
+			# Only the versions that expired are looked up again, failed ones wait out their retry
+			await asyncio.sleep(max(self.addressesExpireIn(), 0))
+			expiredVersions = self.expiredVersions()
+			if expiredVersions:
+				self.addressDiscovery = asyncio.ensure_future(self.discoverPublicAddresses(expiredVersions))
+
+	async def getPublicAddress(self, ipVersion):
+		address = self.publicIPv4 if ipVersion == 4 else self.publicIPv6
+
+		# Right after startup the address may still be being discovered, wait for it instead of failing the bind
+		if address == None and self.addressDiscovery != None and not self.addressDiscovery.done():
+			try:
+				await asyncio.wait_for(asyncio.shield(self.addressDiscovery), PUBLIC_ADDRESS_WAIT)
+			except asyncio.TimeoutError:
+				pass
+
+			address = self.publicIPv4 if ipVersion == 4 else self.publicIPv6
+
+		return address
+
 	def getPublicIPv4(self):
 		try:
 			sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -413,72 +1109,174 @@ class NetmaskServer:
 		except:
 			return None
 
+	def newUID(self):
+		if self.router != None:
+			return self.router.newUID()
+		return packets.newUID()
+
+	def acceptDataConnection(self, uid, reader, writer):
+		startTime = time.perf_counter()
+		connectedClient = self.pendingTCPConnections.pop(uid, None)
+		timers.record("uidLookup", time.perf_counter() - startTime)
+		if connectedClient != None:
+			connectedClient.setServer(reader, writer)
+			return
+
+		writer.close()
+
+	async def acceptHandoff(self, sock, uid, pending):
+		# A data connection another worker accepted for one of our sessions
+		try:
+			reader, writer = await asyncio.open_connection(sock=sock, limit=RELAY_READ_MAX)
+		except OSError:
+			sock.close()
+			return
+
+		if pending:
+			reader.feed_data(pending)
+
+		# A resumption we own, its request is still in the pending data
+		if uid in self.resumableSessions:
+			await self.acceptResume(reader, writer)
+			return
+
+		self.acceptDataConnection(uid, reader, writer)
+
+	async def acceptResume(self, reader, writer):
+		# Read the request whole first, it's handed over as it came if another worker owns the session
+		try:
+			rawRequest = await asyncio.wait_for(reader.readexactly(packets.HEADER.size + packets.CResumeRequest.packetLength), MAX_TIMEOUT)
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+			writer.close()
+			return
+
+		packets.disableNagle(writer.get_extra_info("socket"))
+		connection = ServerConnection(self, AsyncTCPSocket(reader, writer))
+		connection.reader = asyncio.StreamReader()
+		connection.reader.feed_data(rawRequest)
+		resumeRequest = await connection.recvPacketAsync(packets.CResumeRequest)
+		connection.reader = reader
+
+		# A wrong key or packet already got the connection kicked
+		if resumeRequest == None:
+			self.metrics.resumeFailures += 1
+			return
+
+		if self.router != None and self.router.ownerOf(resumeRequest.token) != self.router.workerID:
+			await self.router.handoffConnection(resumeRequest.token, reader, writer, rawRequest)
+			return
+
+		session = self.resumableSessions.get(resumeRequest.token, None)
+		if session == None:
+			# The grace period is over or the server restarted, an encrypted kick tells the client to stop retrying
+			self.metrics.resumeFailures += 1
+			try:
+				await connection.sendPacketAsync(packets.SKick())
+			except:
+				pass
+			connection.terminateConnection()
+			return
+
+		if self.verbose:
+			print("[SERVER] Client came back, resuming its session")
+
+		await session.resumeSession(connection)
+
 	async def handleAsyncConnection(self, reader, writer):
 		mode = await reader.read(1)
 
 		# Detect if user is trying to connect or is recieving a connection
 		if mode == b"\x00":
-			# Call the connectionThread function in ServerConnection with a new thread that uses the AsyncTCPSocket class, which is just an emulated socket
+			# The handshake and the bind run on the loop, like every other connection
+			packets.disableNagle(writer.get_extra_info("socket"))
 			newClient = ServerConnection(self, AsyncTCPSocket(reader, writer))
 			self.clients.append(newClient)
-			threading.Thread(target=newClient.connectionThread).start()
+			await newClient.handleConnection()
 		elif mode == b"\x01":
-			# Here the user connects to recieve a connection
-			uid = await reader.read(32)
-
-			# Iterate through every UID
-			for client in self.clients:
-				for binding in client.bindings:
-					for connectedClient in binding.connectedTCPClients:
-						if connectedClient.uid == uid:
-							connectedClient.setServer(reader, writer)
-							return
-			
-			writer.close()
+			# Here the user connects to recieve a connection, pooled connections send the UID only once a visitor arrives
+			try:
+				uid = await asyncio.wait_for(reader.readexactly(32), DATA_CONNECTION_IDLE)
+			except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+				writer.close()
+				return
+
+			if self.router != None and self.router.ownerOf(uid) != self.router.workerID:
+				await self.router.handoffConnection(uid, reader, writer)
+				return
+
+			self.acceptDataConnection(uid, reader, writer)
+		elif mode == b"\x02":
+			# A resumable client coming back after its control connection dropped
+			await self.acceptResume(reader, writer)
 		else:
 			writer.close()
 		
 	async def startAsync(self, ipv4host, ipv6host, port):
+		# Discover public addresses while the listeners start up, unless the cached ones are still fresh
+		if self.discoveredVersions:
+			expiredVersions = self.expiredVersions()
+			if expiredVersions:
+				self.addressDiscovery = asyncio.ensure_future(self.discoverPublicAddresses(expiredVersions))
+			self.addressRefresh = asyncio.ensure_future(self.refreshPublicAddresses())
+
+		if self.metricsPort != None:
+			await self.metrics.start("127.0.0.1", self.metricsPort + (self.router.workerID if self.router != None else 0))
+
 		# Create IPv4 socket
 		if ipv4host != "-":
 			sock4 = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 			sock4.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+			if self.router != None:
+				sock4.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 			sock4.bind((ipv4host, port))
-			sock4.listen(5)
+			sock4.listen(LISTEN_BACKLOG)
 			sock4.setblocking(False)
 
 			print("[SYSTEM] Started listening for TCP on "+ipv4host+":"+str(port))
 
-			await asyncio.start_server(self.handleAsyncConnection, sock=sock4)
+			await asyncio.start_server(self.handleAsyncConnection, sock=sock4, limit=RELAY_READ_MAX, backlog=LISTEN_BACKLOG)
 
 		# Create IPv6 socket
 		if ipv6host != "-":
 			sock6 = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
 			sock6.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 			sock6.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+			if self.router != None:
+				sock6.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 			sock6.bind((ipv6host, port))
-			sock6.listen(5)
+			sock6.listen(LISTEN_BACKLOG)
 			sock6.setblocking(False)
 
 			print("[SYSTEM] Started listening for TCP on "+ipv6host+":"+str(port))
 
-			await asyncio.start_server(self.handleAsyncConnection, sock=sock6)
+			await asyncio.start_server(self.handleAsyncConnection, sock=sock6, limit=RELAY_READ_MAX, backlog=LISTEN_BACKLOG)
 
 		try:
 			# Start IPv4 UDP server
 			if ipv4host != "-":
-				_coroutine4, udpServer4 = await loop.create_datagram_endpoint(lambda: self.UDPServer(self), local_addr=(ipv4host, port))
+				_coroutine4, udpServer4 = await loop.create_datagram_endpoint(lambda: self.UDPServer(self, socket.AF_INET), local_addr=(ipv4host, port), reuse_port=self.router != None)
 				print("[SYSTEM] Started listening for UDP on "+ipv4host+":"+str(port))
 
 			# Start IPv6 UDP server
 			if ipv6host != "-":
-				_coroutine6, udpServer6 = await loop.create_datagram_endpoint(lambda: self.UDPServer(self), local_addr=(ipv6host, port))
+				_coroutine6, udpServer6 = await loop.create_datagram_endpoint(lambda: self.UDPServer(self, socket.AF_INET6), local_addr=(ipv6host, port), reuse_port=self.router != None)
 				print("[SYSTEM] Started listening for UDP on "+ipv6host+":"+str(port))
 		except:
 			pass
 
 	def start(self, ipv4host, ipv6host, port):
 		global loop
+
+		# Fork before any loop exists, every worker then runs its own loop and listeners
+		if self.workerCount > 1:
+			self.router = workers.WorkerRouter(self, self.workerCount)
+			self.router.fork()
+			print("[SYSTEM] Started worker "+str(self.router.workerID)+" (PID "+str(os.getpid())+")")
+
 		loop = asyncio.get_event_loop()
+		if self.profileDuration != None:
+			Profiler("netmasks", self.profileDuration).startWindow(loop)
+		if self.router != None:
+			loop.run_until_complete(self.router.start())
 		loop.run_until_complete(self.startAsync(ipv4host, ipv6host, port))
 		loop.run_forever()
\ No newline at end of file
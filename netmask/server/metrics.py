@@ -0,0 +1,210 @@
+import netmask.utils.compression as compression
+from netmask.utils.profiling import timers
+import asyncio
+import bisect
+
+# Variables
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5]
+DOWNTIME_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+SCRAPE_TIMEOUT = 5
+
+class Histogram:
+	# Observing only bumps one bucket, the cumulative counts Prometheus expects are built when scraped
+
+	def __init__(self, buckets = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0
+
+	def observe(self, value):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.sum += value
+
+	def render(self, name, description, lines):
+		lines.append("# HELP "+name+" "+description)
+		lines.append("# TYPE "+name+" histogram")
+
+		cumulative = 0
+		for bucket, count in zip(self.buckets, self.counts):
+			cumulative += count
+			lines.append(name+"_bucket{le=\""+str(bucket)+"\"} "+str(cumulative))
+
+		cumulative += self.counts[-1]
+		lines.append(name+"_bucket{le=\"+Inf\"} "+str(cumulative))
+		lines.append(name+"_sum "+str(self.sum))
+		lines.append(name+"_count "+str(cumulative))
+
+class ServerMetrics:
+	# Counters are plain attributes bumped on the loop, everything else is collected from the server's state on scrape
+
+	def __init__(self, netmaskServer):
+		self.netmaskServer = netmaskServer
+
+		self.handshakes = 0
+		self.handshakeFailures = 0
+
+		# Resumable clients that came back, that were refused, and that didn't come back in time
+		self.resumes = 0
+		self.resumeFailures = 0
+		self.expiredSessions = 0
+
+		# Totals of binds that already stopped, live binds are added on scrape
+		self.stoppedReceivedBytes = 0
+		self.stoppedSentBytes = 0
+		self.stoppedDroppedDatagrams = 0
+		self.stoppedDroppedSessions = 0
+		self.stoppedEvictedSessions = 0
+		self.stoppedCompressionStats = compression.CompressionStats()
+
+		# Rolling key cache counters of control connections that already closed, connected clients are added on scrape
+		self.stoppedKeyCache = {"hits": 0, "misses": 0, "refills": 0, "refillTime": 0.0}
+
+		self.handshakeDuration = Histogram()
+		self.tcpSetupDuration = Histogram()
+		self.udpSetupDuration = Histogram()
+		self.resumeDowntime = Histogram(DOWNTIME_BUCKETS)
+
+	def retireBind(self, binding):
+		self.stoppedReceivedBytes += binding.receivedBytes
+		self.stoppedSentBytes += binding.sentBytes
+		self.stoppedCompressionStats.merge(binding.compressionStats)
+
+		for handler in binding.UDPServers:
+			self.stoppedDroppedDatagrams += handler.droppedDatagrams
+			self.stoppedDroppedSessions += handler.droppedSessions
+			self.stoppedEvictedSessions += handler.evictedSessions
+
+	def retireConnection(self, connection):
+		self.addKeyCache(self.stoppedKeyCache, connection)
+
+	def addKeyCache(self, totals, connection):
+		for encryption in connection.encryptions():
+			stats = encryption.cacheStats()
+			for key in totals:
+				totals[key] += stats[key]
+
+	def addMetric(self, lines, name, kind, description, samples):
+		lines.append("# HELP "+name+" "+description)
+		lines.append("# TYPE "+name+" "+kind)
+		for labels, value in samples:
+			if labels:
+				lines.append(name+"{"+",".join(key+"=\""+str(labelValue)+"\"" for key, labelValue in labels)+"} "+str(value))
+			else:
+				lines.append(name+" "+str(value))
+
+	def render(self):
+		netmaskServer = self.netmaskServer
+		bindings = [binding for client in netmaskServer.clients for binding in client.bindings]
+
+		bindCounts = {0: 0, 1: 0}
+		tcpConnections = {"pending": 0, "forwarding": 0}
+		udpSessions = {"pending": 0, "forwarding": 0}
+		receivedBytes = self.stoppedReceivedBytes
+		sentBytes = self.stoppedSentBytes
+		droppedDatagrams = self.stoppedDroppedDatagrams
+		droppedSessions = self.stoppedDroppedSessions
+		evictedSessions = self.stoppedEvictedSessions
+		bindReceived = []
+		bindSent = []
+		compressionTotals = compression.CompressionStats()
+		compressionTotals.merge(self.stoppedCompressionStats)
+		bindRaw = []
+		bindCompressed = []
+		bindCompressionSeconds = []
+		keyCache = dict(self.stoppedKeyCache)
+
+		for client in netmaskServer.clients:
+			self.addKeyCache(keyCache, client)
+
+		for binding in bindings:
+			bindCounts[binding.bindMode] = bindCounts.get(binding.bindMode, 0) + 1
+			receivedBytes += binding.receivedBytes
+			sentBytes += binding.sentBytes
+
+			labels = [("mode", "tcp" if binding.bindMode == 0 else "udp"), ("port", binding.bindPort)]
+			bindReceived.append((labels, binding.receivedBytes))
+			bindSent.append((labels, binding.sentBytes))
+
+			if binding.compression != None:
+				stats = binding.compressionStats
+				compressionTotals.merge(stats)
+				bindRaw.append((labels, stats.rawBytes))
+				bindCompressed.append((labels, stats.compressedBytes))
+				bindCompressionSeconds.append((labels, stats.seconds))
+
+			for connection in binding.connectedTCPClients.values():
+				tcpConnections["forwarding" if connection.isForwarding else "pending"] += 1
+
+			for handler in binding.UDPServers:
+				droppedDatagrams += handler.droppedDatagrams
+				droppedSessions += handler.droppedSessions
+				evictedSessions += handler.evictedSessions
+				for session in handler.clients.values():
+					udpSessions["forwarding" if session.isForwarding else "pending"] += 1
+
+		lines = []
+		self.addMetric(lines, "netmask_control_sessions", "gauge", "Connected clients.", [([], len(netmaskServer.clients))])
+		self.addMetric(lines, "netmask_detached_sessions", "gauge", "Resumable clients whose control connection dropped, their binds are kept until they come back.", [([], len([client for client in netmaskServer.clients if client.resumed != None and not client.resumed.done()]))])
+		self.addMetric(lines, "netmask_binds", "gauge", "Active binds.", [([("mode", "tcp")], bindCounts[0]), ([("mode", "udp")], bindCounts[1])])
+		self.addMetric(lines, "netmask_tcp_connections", "gauge", "Visitor TCP connections, waiting for the client or forwarding.", [([("state", state)], count) for state, count in tcpConnections.items()])
+		self.addMetric(lines, "netmask_udp_sessions", "gauge", "Visitor UDP sessions, waiting for the client or forwarding.", [([("state", state)], count) for state, count in udpSessions.items()])
+		self.addMetric(lines, "netmask_received_bytes_total", "counter", "Bytes received from visitors.", [([], receivedBytes)])
+		self.addMetric(lines, "netmask_sent_bytes_total", "counter", "Bytes sent to visitors.", [([], sentBytes)])
+		self.addMetric(lines, "netmask_bind_received_bytes_total", "counter", "Bytes received from visitors, per active bind.", bindReceived)
+		self.addMetric(lines, "netmask_bind_sent_bytes_total", "counter", "Bytes sent to visitors, per active bind.", bindSent)
+		self.addMetric(lines, "netmask_compression_raw_bytes_total", "counter", "Bytes of compressed tunnels before compression, both directions.", [([], compressionTotals.rawBytes)])
+		self.addMetric(lines, "netmask_compression_compressed_bytes_total", "counter", "Bytes of compressed tunnels on their data connections, both directions.", [([], compressionTotals.compressedBytes)])
+		self.addMetric(lines, "netmask_compression_seconds_total", "counter", "Time spent compressing and decompressing.", [([], compressionTotals.seconds)])
+		self.addMetric(lines, "netmask_bind_compression_raw_bytes_total", "counter", "Bytes before compression, per active compressed bind.", bindRaw)
+		self.addMetric(lines, "netmask_bind_compression_compressed_bytes_total", "counter", "Bytes after compression, per active compressed bind.", bindCompressed)
+		self.addMetric(lines, "netmask_bind_compression_seconds_total", "counter", "Time spent compressing and decompressing, per active compressed bind.", bindCompressionSeconds)
+		self.addMetric(lines, "netmask_handshakes_total", "counter", "Clients that completed the handshake and the bind.", [([], self.handshakes)])
+		self.addMetric(lines, "netmask_handshake_failures_total", "counter", "Control connections that were closed before they were bound.", [([], self.handshakeFailures)])
+		self.addMetric(lines, "netmask_session_resumes_total", "counter", "Resumable clients that came back to their binds.", [([], self.resumes)])
+		self.addMetric(lines, "netmask_session_resume_failures_total", "counter", "Resumption requests refused, with a wrong key or an unknown or expired token.", [([], self.resumeFailures)])
+		self.addMetric(lines, "netmask_session_expired_total", "counter", "Resumable clients that didn't come back within the grace period.", [([], self.expiredSessions)])
+		self.addMetric(lines, "netmask_key_cache_hits_total", "counter", "Rolling keys taken from the look-ahead cache of the control connections.", [([], keyCache["hits"])])
+		self.addMetric(lines, "netmask_key_cache_misses_total", "counter", "Rolling keys derived when rolled, because the cache was empty.", [([], keyCache["misses"])])
+		self.addMetric(lines, "netmask_key_cache_refills_total", "counter", "Look-ahead cache refills of idle control connections.", [([], keyCache["refills"])])
+		self.addMetric(lines, "netmask_key_cache_refill_seconds_total", "counter", "Time spent refilling the look-ahead caches.", [([], keyCache["refillTime"])])
+		self.addMetric(lines, "netmask_udp_dropped_datagrams_total", "counter", "Datagrams dropped because a pending session's buffer or the session table was full.", [([], droppedDatagrams)])
+		self.addMetric(lines, "netmask_udp_dropped_sessions_total", "counter", "UDP sessions refused because the session table was full.", [([], droppedSessions)])
+		self.addMetric(lines, "netmask_udp_evicted_sessions_total", "counter", "UDP sessions evicted after being idle or never connected.", [([], evictedSessions)])
+
+		router = netmaskServer.router
+		if router != None:
+			workerLabels = [("worker", router.workerID)]
+			self.addMetric(lines, "netmask_worker_handoffs_total", "counter", "Data connections handed over to the worker owning their session.", [(workerLabels, router.handedOffConnections)])
+			self.addMetric(lines, "netmask_worker_relayed_datagrams_total", "counter", "Datagrams relayed to the worker owning their session.", [(workerLabels, router.relayedDatagrams)])
+			self.addMetric(lines, "netmask_worker_dropped_datagrams_total", "counter", "Datagrams dropped because the owning worker fell behind.", [(workerLabels, router.droppedDatagrams)])
+
+		self.handshakeDuration.render("netmask_handshake_duration_seconds", "Time from accepting a control connection to answering its bind.", lines)
+		self.tcpSetupDuration.render("netmask_tcp_setup_duration_seconds", "Time from accepting a visitor to its data connection or stream being ready.", lines)
+		self.udpSetupDuration.render("netmask_udp_setup_duration_seconds", "Time from a visitor's first datagram to the client's data address registering.", lines)
+		self.resumeDowntime.render("netmask_session_downtime_seconds", "Time resumed clients were away, visitors arriving meanwhile waited for them.", lines)
+
+		return "\n".join(lines) + "\n"
+
+	async def handleScrape(self, reader, writer):
+		try:
+			request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SCRAPE_TIMEOUT)
+			path = request.split(b" ")[1] if request.count(b" ") >= 2 else b""
+
+			if path.split(b"?")[0] == b"/metrics":
+				body = self.render().encode()
+				writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: "+str(len(body)).encode()+b"\r\nConnection: close\r\n\r\n"+body)
+			elif path.split(b"?")[0] == b"/debug/timers":
+				body = (timers.dump()+"\n").encode()
+				writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: "+str(len(body)).encode()+b"\r\nConnection: close\r\n\r\n"+body)
+			else:
+				writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+
+			await writer.drain()
+		except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+			pass
+		finally:
+			writer.close()
+
+	async def start(self, host, port):
+		await asyncio.start_server(self.handleScrape, host, port)
+		print("[SYSTEM] Serving metrics on http://"+host+":"+str(port)+"/metrics")
@@ -0,0 +1,214 @@
+import netmask.impl.packets as packets
+import threading
+import asyncio
+import pickle
+import struct
+import socket
+import array
+import time
+import os
+
+# Variables
+HANDOFF_BUFFER = 65536
+RELAY_HIGH_WATER = 1048576
+ROUTE_IDLE_TIMEOUT = 60
+
+def isAvailable():
+	# Workers need fork, SO_REUSEPORT and descriptor passing over Unix sockets
+	return hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT") and hasattr(socket, "AF_UNIX") and hasattr(socket, "SCM_RIGHTS")
+
+class WorkerRouter:
+	# Forwards data connections, resumptions and datagrams that the kernel balanced to the wrong worker to the one owning their session.
+	# Every UID ends with the index of the worker that created it, so the owner is known without any shared state.
+
+	class UDPRoute:
+		def __init__(self, router, address, workerID):
+			self.router = router
+			self.address = address
+			self.workerID = workerID
+			self.isActive = True
+
+		def timeoutHandler(self):
+			if not self.isActive:
+				self.router.remoteUDPAddresses.pop(self.address, None)
+				return
+
+			self.isActive = False
+			self.router.netmaskServer.udpTimerWheel.add(self, ROUTE_IDLE_TIMEOUT, self.timeoutHandler)
+
+	def __init__(self, netmaskServer, workerCount):
+		self.netmaskServer = netmaskServer
+		self.workerCount = workerCount
+		self.workerID = 0
+		self.parentPID = os.getpid()
+
+		# Data connections are handed over as descriptors, through one datagram inbox per worker
+		self.inboxes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workerCount)]
+
+		# Datagrams are relayed over a stream socket per pair of workers, datagram inboxes only queue a handful of messages
+		self.relaySockets = {}
+		for first in range(workerCount):
+			for second in range(first + 1, workerCount):
+				self.relaySockets[(first, second)], self.relaySockets[(second, first)] = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+		# Worker index -> stream writer, once the relay is started
+		self.relayWriters = {}
+
+		# Client UDP address -> UDPRoute, for clients the kernel keeps sending to this worker while another one owns them
+		self.remoteUDPAddresses = {}
+
+		self.relayedDatagrams = 0
+		self.droppedDatagrams = 0
+		self.handedOffConnections = 0
+
+	def fork(self):
+		# Returns in every worker, the original process becomes worker 0
+		for workerID in range(1, self.workerCount):
+			if os.fork() == 0:
+				self.workerID = workerID
+				break
+
+		# Only keep the sockets this worker uses
+		for workerID, inbox in enumerate(self.inboxes):
+			inbox[1].setblocking(False)
+			if workerID != self.workerID:
+				inbox[0].close()
+
+		for (first, second), sock in self.relaySockets.items():
+			if first != self.workerID:
+				sock.close()
+
+		if self.workerID != 0:
+			threading.Thread(target=self.parentWatcher, daemon=True).start()
+
+	def parentWatcher(self):
+		# Workers don't outlive the main process
+		while True:
+			time.sleep(1)
+			if os.getppid() != self.parentPID:
+				os._exit(0)
+
+	def newUID(self):
+		# The first byte is left to packets.newUID, the main UDP port tells datagram types apart by it
+		return packets.newUID(31) + bytes([self.workerID])
+
+	def ownerOf(self, uid):
+		return uid[-1] if uid[-1] < self.workerCount else self.workerID
+
+	async def start(self):
+		loop = asyncio.get_event_loop()
+
+		inbox = self.inboxes[self.workerID][0]
+		inbox.setblocking(False)
+		loop.add_reader(inbox.fileno(), self.receiveHandoffs)
+
+		for (first, second), sock in self.relaySockets.items():
+			if first == self.workerID:
+				reader, writer = await asyncio.open_unix_connection(sock=sock)
+				self.relayWriters[second] = writer
+				asyncio.ensure_future(self.receiveRelay(reader))
+
+	async def handoffConnection(self, uid, reader, writer, consumed = b""):
+		# The connection belongs to another worker, pass its descriptor over along with anything it already sent
+		transportSocket = writer.get_extra_info("socket")
+		writer.transport.pause_reading()
+
+		pending = consumed + bytes(reader._buffer)
+		reader._buffer.clear()
+
+		message = bytes([transportSocket.family]) + uid + pending
+		descriptors = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [transportSocket.fileno()]))]
+
+		# The inbox may be full, wait for the owner to catch up instead of blocking the loop
+		outbox = self.inboxes[self.ownerOf(uid)][1]
+		loop = asyncio.get_event_loop()
+		try:
+			while True:
+				try:
+					outbox.sendmsg([message], descriptors)
+					self.handedOffConnections += 1
+					break
+				except BlockingIOError:
+					future = loop.create_future()
+					loop.add_writer(outbox.fileno(), lambda: future.done() or future.set_result(None))
+					try:
+						await asyncio.wait_for(future, 1)
+					except asyncio.TimeoutError:
+						break
+					finally:
+						loop.remove_writer(outbox.fileno())
+		except OSError:
+			pass
+		finally:
+			# The owner holds its own descriptor now, closing ours doesn't end the connection
+			writer.close()
+
+	def receiveHandoffs(self):
+		inbox = self.inboxes[self.workerID][0]
+		while True:
+			try:
+				message, ancillary, _flags, _address = inbox.recvmsg(HANDOFF_BUFFER, socket.CMSG_LEN(array.array("i").itemsize))
+			except (BlockingIOError, InterruptedError):
+				return
+
+			descriptors = array.array("i")
+			for level, kind, data in ancillary:
+				if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+					descriptors.frombytes(data[:len(data) - (len(data) % descriptors.itemsize)])
+
+			if len(descriptors) != 1 or len(message) < 33:
+				for descriptor in descriptors:
+					os.close(descriptor)
+				continue
+
+			sock = socket.socket(message[0], socket.SOCK_STREAM, 0, descriptors[0])
+			sock.setblocking(False)
+			asyncio.ensure_future(self.netmaskServer.acceptHandoff(sock, message[1:33], message[33:]))
+
+	def routeDatagram(self, data, address):
+		# Returns the worker that has to handle this datagram
+		route = self.remoteUDPAddresses.get(address, None)
+		if route != None:
+			route.isActive = True
+			return route.workerID
+
+		if len(data) == 32:
+			uid = data
+		elif len(data) == 37 and data[0] == packets.UDP_DEMUX_REGISTER:
+			uid = data[5:]
+		else:
+			return self.workerID
+
+		workerID = self.ownerOf(uid)
+		if workerID != self.workerID and address not in self.netmaskServer.forwardingUDPAddresses:
+			route = self.UDPRoute(self, address, workerID)
+			self.remoteUDPAddresses[address] = route
+			self.netmaskServer.udpTimerWheel.add(route, ROUTE_IDLE_TIMEOUT, route.timeoutHandler)
+			return workerID
+
+		return self.workerID
+
+	def relayDatagram(self, workerID, family, data, address):
+		writer = self.relayWriters.get(workerID, None)
+
+		# Like any UDP hop, drop instead of queueing without bound when the owner falls behind
+		if writer == None or writer.transport.get_write_buffer_size() > RELAY_HIGH_WATER:
+			self.droppedDatagrams += 1
+			return
+
+		header = pickle.dumps((family, address))
+		writer.write(struct.pack(">HI", len(header), len(data)) + header + data)
+		self.relayedDatagrams += 1
+
+	async def receiveRelay(self, reader):
+		try:
+			while True:
+				headerLength, dataLength = struct.unpack(">HI", await reader.readexactly(6))
+				family, address = pickle.loads(await reader.readexactly(headerLength))
+				data = await reader.readexactly(dataLength)
+
+				udpServer = self.netmaskServer.udpServers.get(family, None)
+				if udpServer != None:
+					udpServer.handleDatagram(data, address)
+		except (asyncio.IncompleteReadError, OSError):
+			pass
@@ -0,0 +1,114 @@
+import threading
+import zlib
+import lzma
+import time
+
+# Variables
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+ALGORITHMS = {"zlib": COMPRESSION_ZLIB, "lzma": COMPRESSION_LZMA}
+DEFAULT_LEVEL = 6
+
+def packSettings(algorithm, level):
+	# One byte on the wire: the algorithm in the high nibble, the level (0-9) in the low one
+	return (algorithm << 4) | level
+
+def unpackSettings(settings):
+	algorithm, level = settings >> 4, settings & 0x0F
+	if algorithm not in ALGORITHMS.values() or level > 9:
+		return None
+	return algorithm, level
+
+def isDrained(reader):
+	# Whether an asyncio stream has nothing more buffered, a flush is only worth it then. StreamReader has no
+	# public way to tell without awaiting, so this is the only place looking at its buffer
+	return not reader._buffer
+
+class CompressionStats:
+	# Bytes before and after compression and the time spent on it, both directions together
+	def __init__(self):
+		self.rawBytes = 0
+		self.compressedBytes = 0
+		self.seconds = 0
+		self.lock = threading.Lock()
+
+	def merge(self, other):
+		with self.lock:
+			self.rawBytes += other.rawBytes
+			self.compressedBytes += other.compressedBytes
+			self.seconds += other.seconds
+
+	def ratio(self):
+		return self.compressedBytes / self.rawBytes if self.rawBytes != 0 else 1.0
+
+class StreamCompressor:
+	# Compresses a stream, flushing lets the peer decompress everything written so far
+
+	def __init__(self, algorithm, level, stats):
+		self.algorithm = algorithm
+		self.level = level
+		self.stats = stats
+		self.compressor = self.newCompressor()
+
+	def newCompressor(self):
+		if self.algorithm == COMPRESSION_LZMA:
+			return lzma.LZMACompressor(format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=self.level)
+		return zlib.compressobj(self.level)
+
+	def compress(self, data, flush):
+		startTime = time.perf_counter()
+		output = self.compressor.compress(data)
+
+		if flush:
+			if self.algorithm == COMPRESSION_LZMA:
+				# LZMA can't flush in the middle of a stream, finish it and start the next one
+				output += self.compressor.flush()
+				self.compressor = self.newCompressor()
+			else:
+				output += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+		self.stats.rawBytes += len(data)
+		self.stats.compressedBytes += len(output)
+		self.stats.seconds += time.perf_counter() - startTime
+		return output
+
+class StreamDecompressor:
+	def __init__(self, algorithm, stats):
+		self.algorithm = algorithm
+		self.stats = stats
+		self.decompressor = self.newDecompressor()
+
+	def newDecompressor(self):
+		if self.algorithm == COMPRESSION_LZMA:
+			return lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+		return zlib.decompressobj()
+
+	def decompressChunks(self, data, maxLength):
+		# Yields the output in pieces of at most maxLength, so a small input can't expand into one huge buffer
+		self.stats.compressedBytes += len(data)
+
+		while True:
+			startTime = time.perf_counter()
+			if self.algorithm == COMPRESSION_LZMA:
+				output = self.decompressor.decompress(data, maxLength)
+				data = b""
+
+				# Every flush ended a stream, the next one starts right after it
+				if self.decompressor.eof:
+					data = self.decompressor.unused_data
+					self.decompressor = self.newDecompressor()
+				hasMore = data != b"" or not self.decompressor.needs_input
+			else:
+				output = self.decompressor.decompress(data, maxLength)
+				data = self.decompressor.unconsumed_tail
+
+				# A full output may have left some of it inside zlib, even with all the input consumed
+				hasMore = data != b"" or len(output) == maxLength
+			self.stats.seconds += time.perf_counter() - startTime
+
+			if output:
+				self.stats.rawBytes += len(output)
+				yield output
+
+			if not hasMore:
+				return
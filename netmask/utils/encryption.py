@@ -1,17 +1,133 @@
+import collections
+import threading
 import hashlib
+import time
+
+# Variables
+KEY_LOOKAHEAD = 32
+KEYSTREAM_PREFIX = 64
+
+# Seconds a connection on an event loop has to go without rolling a key before its cache is refilled
+REFILL_IDLE = 0.05
 
 class NetmaskEncryption:
-	def __init__(self, communicationKey):
+	def __init__(self, communicationKey, keyLookahead = KEY_LOOKAHEAD, keystreamPrefix = KEYSTREAM_PREFIX):
 		self.communicationKey = communicationKey
 
 		# The rolling key will change for each packet either sent by client or server
 		self.rollingKeyID = 0
 		self.rollingKey = hashlib.sha256(self.communicationKey).digest()
 
+		# Look-ahead cache of the next rolling keys along with the start of their keystream, the tail is the last
+		# key that has been derived (either cached or rolled). It starts empty and is only filled while idle, so a
+		# connection that never gets past the handshake doesn't pay for it
+		self.keyLookahead = keyLookahead
+		self.keystreamPrefix = keystreamPrefix
+		self.keySchedule = collections.deque()
+		self.keyScheduleTail = self.rollingKey
+		self.currentKeystream = None
+		self.keyScheduleLock = threading.Lock()
+
+		# Cache counters
+		self.cacheHits = 0
+		self.cacheMisses = 0
+		self.refillCount = 0
+		self.refillTime = 0.0
+
+		# Pending refill on an event loop, see scheduleRefill
+		self.refillHandle = None
+
 	def rollKey(self):
-		self.rollingKeyID += 1
-		self.rollingKey = hashlib.sha256(self.rollingKey).digest()
+		with self.keyScheduleLock:
+			self.rollingKeyID += 1
+
+			if self.keySchedule:
+				self.rollingKey, self.currentKeystream = self.keySchedule.popleft()
+				self.cacheHits += 1
+			else:
+				self.rollingKey = hashlib.sha256(self.rollingKey).digest()
+				self.currentKeystream = None
+				self.keyScheduleTail = self.rollingKey
+				self.cacheMisses += 1
+
+	def refill(self):
+		# Derive keys until the look-ahead cache is full, this is meant to be called while the connection is idle
+		startTime = time.perf_counter()
+		while True:
+			with self.keyScheduleLock:
+				if len(self.keySchedule) >= self.keyLookahead:
+					break
+				tail = self.keyScheduleTail
+
+			# Hash outside of the lock so rollKey never waits on a refill
+			nextKey = hashlib.sha256(tail).digest()
+			keystream = hashlib.shake_256(nextKey).digest(self.keystreamPrefix)
+
+			with self.keyScheduleLock:
+				# If a key got rolled past the tail in the meantime, this result is stale
+				if self.keyScheduleTail is tail:
+					self.keySchedule.append((nextKey, keystream))
+					self.keyScheduleTail = nextKey
+
+		self.refillCount += 1
+		self.refillTime += time.perf_counter() - startTime
+
+	def scheduleRefill(self, loop):
+		# Refill once no key was rolled for REFILL_IDLE seconds, instead of right after every packet on the same loop
+		if self.refillHandle == None:
+			self.refillHandle = loop.call_later(REFILL_IDLE, self.refillWhenIdle, loop, self.rollingKeyID)
+
+	def refillWhenIdle(self, loop, rollingKeyID):
+		self.refillHandle = None
+
+		# Still busy, look again later
+		if self.rollingKeyID != rollingKeyID:
+			self.scheduleRefill(loop)
+			return
+
+		self.refill()
+
+	def cancelRefill(self):
+		if self.refillHandle != None:
+			self.refillHandle.cancel()
+			self.refillHandle = None
+
+	def cacheStats(self):
+		rolls = self.cacheHits + self.cacheMisses
+		return {
+			"hits": self.cacheHits,
+			"misses": self.cacheMisses,
+			"hitRate": self.cacheHits / rolls if rolls != 0 else 0.0,
+			"refills": self.refillCount,
+			"refillTime": self.refillTime,
+			"cached": len(self.keySchedule)
+		}
 		
+	def keystream(self, length):
+		# SHAKE-256 is an XOF, so the cached prefix is identical to a shorter digest of the same key
+		keystream = self.currentKeystream
+		if keystream is not None and length <= len(keystream):
+			return keystream[:length]
+
+		# Keep the prefix of a key that wasn't cached, a packet's metadata and buffer are decrypted with the same one
+		keystream = hashlib.shake_256(self.rollingKey).digest(max(length, self.keystreamPrefix))
+		self.currentKeystream = keystream
+		return keystream[:length]
+
 	def encryptDecrypt(self, data):
-		encryptionKey = hashlib.shake_256(self.rollingKey).digest(len(data))
-		return bytes([data[i] ^ encryptionKey[i % len(encryptionKey)] for i in range(len(data))])
\ No newline at end of file
+		dataLength = len(data)
+		if dataLength == 0:
+			return b""
+
+		encryptionKey = self.keystream(dataLength)
+
+		# XOR the whole buffer at once as a big integer instead of byte by byte
+		return (int.from_bytes(data, byteorder='big') ^ int.from_bytes(encryptionKey, byteorder='big')).to_bytes(dataLength, byteorder='big')
+
+	def encryptPacket(self, metadata, buffer):
+		# The metadata and the buffer are each encrypted from the start of the keystream, do both in a single XOR
+		keystream = self.keystream(max(len(metadata), len(buffer)))
+		data = metadata + buffer
+		encryptionKey = keystream[:len(metadata)] + keystream[:len(buffer)]
+
+		return (int.from_bytes(data, byteorder='big') ^ int.from_bytes(encryptionKey, byteorder='big')).to_bytes(len(data), byteorder='big')
@@ -0,0 +1,143 @@
+import threading
+import cProfile
+import pstats
+import sys
+import os
+
+class StageTimers:
+	# Always-on timers for the hot stages, every thread adds to its own totals and they are only summed up when dumped
+
+	def __init__(self):
+		self.local = threading.local()
+
+		# (thread, stage -> [count, total, max]) of every thread that recorded something, dead ones get merged away
+		self.threadTotals = []
+		self.retiredTotals = {}
+		self.compactAt = 64
+		self.lock = threading.Lock()
+
+	def record(self, stage, seconds):
+		try:
+			totals = self.local.totals
+		except AttributeError:
+			totals = self.local.totals = {}
+			self.registerThread(totals)
+
+		entry = totals.get(stage, None)
+		if entry == None:
+			totals[stage] = [1, seconds, seconds]
+			return
+
+		entry[0] += 1
+		entry[1] += seconds
+		if seconds > entry[2]:
+			entry[2] = seconds
+
+	def registerThread(self, totals):
+		with self.lock:
+			self.threadTotals.append((threading.current_thread(), totals))
+
+			# The client runs a thread per connection, don't keep one table per thread that ever lived
+			if len(self.threadTotals) >= self.compactAt:
+				self.compact()
+				self.compactAt = len(self.threadTotals) * 2 + 64
+
+	def compact(self):
+		alive = []
+		for thread, totals in self.threadTotals:
+			if thread.is_alive():
+				alive.append((thread, totals))
+			else:
+				self.merge(self.retiredTotals, totals)
+		self.threadTotals = alive
+
+	def merge(self, destination, totals):
+		for stage, (count, total, maximum) in list(totals.items()):
+			entry = destination.setdefault(stage, [0, 0, 0])
+			entry[0] += count
+			entry[1] += total
+			entry[2] = max(entry[2], maximum)
+
+	def snapshot(self):
+		with self.lock:
+			self.compact()
+			merged = {}
+			self.merge(merged, self.retiredTotals)
+			for _thread, totals in self.threadTotals:
+				self.merge(merged, totals)
+		return merged
+
+	def dump(self):
+		lines = ["stage".ljust(24) + "count".rjust(10) + "total ms".rjust(12) + "avg us".rjust(10) + "max us".rjust(10)]
+		for stage, (count, total, maximum) in sorted(self.snapshot().items()):
+			lines.append(stage.ljust(24) + str(count).rjust(10) + str(round(total * 1e3, 1)).rjust(12) + str(round(total / count * 1e6, 1)).rjust(10) + str(round(maximum * 1e6, 1)).rjust(10))
+		return "\n".join(lines)
+
+class Profiler:
+	# cProfile for a fixed window, in the thread it's started from (the server's loop) and in every thread started meanwhile
+
+	def __init__(self, prefix, duration, directory = "."):
+		self.prefix = prefix
+		self.duration = duration
+		self.directory = directory
+		self.profiles = []
+		self.lock = threading.Lock()
+
+	def start(self):
+		self.profileThread()
+		threading.setprofile(self.threadHook)
+
+	def threadHook(self, frame, event, arg):
+		# Only runs for the first event of a new thread, enabling cProfile replaces this hook
+		self.profileThread()
+
+	def profileThread(self):
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			# Since Python 3.12 there is a single profiler for the whole process, and it already sees this thread
+			sys.setprofile(None)
+			return
+
+		with self.lock:
+			self.profiles.append(profile)
+
+	def stop(self):
+		# Returns the path of the profile, other threads still running keep their hook until they exit but it isn't read anymore
+		threading.setprofile(None)
+		with self.lock:
+			profiles = self.profiles
+			self.profiles = []
+
+		# Creating the stats disables each profile, threads that never ran anything have none
+		for profile in profiles:
+			profile.create_stats()
+		profiles = [profile for profile in profiles if profile.stats]
+		if not profiles:
+			return None
+
+		basePath = os.path.join(self.directory, self.prefix+"-"+str(os.getpid()))
+		pstats.Stats(*profiles).dump_stats(basePath+".pstats")
+		with open(basePath+"-timers.txt", "w") as timersFile:
+			timersFile.write(timers.dump()+"\n")
+
+		return basePath+".pstats"
+
+	def startWindow(self, loop = None):
+		# Stops on the loop when there is one, so the loop's own profile is disabled from its thread
+		self.start()
+		if loop != None:
+			loop.call_later(self.duration, self.finishWindow)
+		else:
+			timer = threading.Timer(self.duration, self.finishWindow)
+			timer.daemon = True
+			timer.start()
+
+	def finishWindow(self):
+		path = self.stop()
+		if path != None:
+			print("[SYSTEM] Wrote the profile to "+path)
+
+# Shared by everything in this process
+timers = StageTimers()
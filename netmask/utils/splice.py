@@ -0,0 +1,111 @@
+import asyncio
+import socket
+import os
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# Variables
+SPLICE_PIPE_SIZE = 262144
+
+def isAvailable():
+	# os.splice only exists on Linux with Python 3.10 or above
+	return hasattr(os, "splice")
+
+def createPipe():
+	readFd, writeFd = os.pipe()
+
+	# Try to grow the pipe, so each splice can move more data at once
+	pipeSize = 65536
+	if fcntl != None and hasattr(fcntl, "F_SETPIPE_SZ"):
+		try:
+			fcntl.fcntl(writeFd, fcntl.F_SETPIPE_SZ, SPLICE_PIPE_SIZE)
+			pipeSize = fcntl.fcntl(writeFd, fcntl.F_GETPIPE_SZ)
+		except OSError:
+			pass
+
+	return readFd, writeFd, pipeSize
+
+def closePipe(pipe):
+	for fd in pipe[:2]:
+		try:
+			os.close(fd)
+		except OSError:
+			pass
+
+def spliceBlocking(source, destination, pipe):
+	# Moves whatever is readable on source to destination through the pipe, returns 0 on EOF
+	readFd, writeFd, pipeSize = pipe
+	length = os.splice(source.fileno(), writeFd, pipeSize, flags=os.SPLICE_F_MOVE)
+
+	remaining = length
+	while remaining > 0:
+		remaining -= os.splice(readFd, destination.fileno(), remaining, flags=os.SPLICE_F_MOVE)
+
+	return length
+
+def canTakeStreamSocket(reader, writer):
+	# A stream can't be handed over once it saw EOF or while it still has unsent data
+	return writer.get_extra_info("socket") != None and not reader.at_eof() and writer.transport.get_write_buffer_size() == 0
+
+def takeStreamSocket(reader, writer):
+	# Gets a duplicate of the socket behind an asyncio stream along with the data it already buffered
+	transportSocket = writer.get_extra_info("socket")
+	writer.transport.pause_reading()
+
+	# StreamReader has no public way to take its buffer without awaiting
+	pending = bytes(reader._buffer)
+	reader._buffer.clear()
+
+	sock = socket.fromfd(transportSocket.fileno(), transportSocket.family, transportSocket.type)
+	sock.setblocking(False)
+	return sock, pending
+
+async def _waitFd(addHandler, removeHandler, fd):
+	future = asyncio.get_event_loop().create_future()
+	addHandler(fd, lambda: future.done() or future.set_result(None))
+	try:
+		await future
+	finally:
+		removeHandler(fd)
+
+async def spliceForward(source, destination, pending = b""):
+	# Relays source to destination (both non-blocking sockets) without the data entering Python, returns the bytes moved
+	loop = asyncio.get_event_loop()
+	pipe = createPipe()
+	readFd, writeFd, pipeSize = pipe
+	movedBytes = len(pending)
+	try:
+		if pending:
+			await loop.sock_sendall(destination, pending)
+
+		while True:
+			try:
+				length = os.splice(source.fileno(), writeFd, pipeSize, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+			except BlockingIOError:
+				await _waitFd(loop.add_reader, loop.remove_reader, source.fileno())
+				continue
+
+			if length == 0:
+				break
+
+			movedBytes += length
+			while length > 0:
+				try:
+					length -= os.splice(readFd, destination.fileno(), length, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+				except BlockingIOError:
+					await _waitFd(loop.add_writer, loop.remove_writer, destination.fileno())
+	except OSError:
+		pass
+	finally:
+		closePipe(pipe)
+
+		# Like the copy path, once one side is done the whole tunnel goes down
+		try:
+			destination.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+
+	return movedBytes
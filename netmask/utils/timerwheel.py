@@ -0,0 +1,59 @@
+import asyncio
+import math
+
+class TimerWheel:
+	# Hashed timer wheel: many coarse timeouts share one loop timer instead of one handle or task each
+
+	def __init__(self, tickInterval = 1, slotCount = 64):
+		self.tickInterval = tickInterval
+		self.slotCount = slotCount
+		self.slots = [{} for _ in range(slotCount)]
+
+		# Key -> slot index, so timers can be moved or cancelled in O(1)
+		self.keySlots = {}
+
+		# Ticks since the wheel was created, usable as a cheap coarse clock
+		self.currentTick = 0
+
+		self.loop = None
+		self.tickHandle = None
+
+	def add(self, key, delay, callback):
+		# Timers further away than one turn of the wheel fire early, callbacks are expected to reschedule themselves
+		ticks = min(max(1, math.ceil(delay / self.tickInterval)), self.slotCount - 1)
+
+		self.remove(key)
+		slotIndex = (self.currentTick + ticks) % self.slotCount
+		self.slots[slotIndex][key] = callback
+		self.keySlots[key] = slotIndex
+
+		if self.tickHandle == None:
+			if self.loop == None:
+				self.loop = asyncio.get_event_loop()
+			self.tickHandle = self.loop.call_later(self.tickInterval, self.tick)
+
+	def remove(self, key):
+		slotIndex = self.keySlots.pop(key, None)
+		if slotIndex != None:
+			del self.slots[slotIndex][key]
+
+	def tick(self):
+		self.currentTick += 1
+		slotIndex = self.currentTick % self.slotCount
+
+		expired = self.slots[slotIndex]
+		self.slots[slotIndex] = {}
+		for key in expired:
+			del self.keySlots[key]
+
+		for callback in expired.values():
+			callback()
+
+		# Only keep ticking while there are timers left
+		if self.keySlots:
+			self.tickHandle = self.loop.call_later(self.tickInterval, self.tick)
+		else:
+			self.tickHandle = None
+
+	def __len__(self):
+		return len(self.keySlots)